@@ -20,23 +20,50 @@ import os
 import shutil
 import optparse
 import tarfile
+import collections
 import six
 
 from mpi4py import MPI
 
 from soma_workflow import scheduler, constants
+from soma_workflow.configuration import cpu_count
+from soma_workflow.client import TemporaryPath
 
 
 def slave_loop(communicator,
                logger=None,
                epd_to_deploy=None,
-               untar_directory='/tmp'):
+               untar_directory='/tmp',
+               slots=1,
+               poll_interval=0.05,
+               max_no_job_delay=1.):
+    '''
+    Run the jobs sent by the master (MPIScheduler), up to "slots" jobs at the
+    same time, until the master sends EXIT_SIGNAL.
+
+    The master may send more jobs than free slots: the extra jobs wait in
+    the slave until a slot is free, and the master can ask for them back
+    (JOB_STEAL) to give them to an idle slave.
+
+    The ended jobs are reported to the master as soon as they are detected,
+    and new jobs are requested as long as some slots are free or no job is
+    waiting. When the master has no job to give, the delay before the next
+    request doubles up to max_no_job_delay.
+
+    * slots *int*
+        Maximum number of jobs run at the same time.
+
+    * poll_interval *float*
+        Delay (in seconds) between two tests of the jobs termination.
+
+    * max_no_job_delay *float*
+        Maximum delay (in seconds) between two job requests.
+    '''
     status = MPI.Status()
     rank = communicator.Get_rank()
 
     if not logger:
         logger = logging.getLogger("testMPI.slave")
-    commands = {}
 
     if epd_to_deploy != None:
         lock_file_path = os.path.join(untar_directory, "sw_deploy_lock")
@@ -48,107 +75,121 @@ def slave_loop(communicator,
                 epd_tar = tarfile.open(epd_to_deploy)
                 epd_tar.extractall(path=untar_directory)
                 # logger.debug('extract %s' %(epd_to_deploy))
-            except IOError, e:
+            except IOError as e:
                 logger.error("Could not deploy epd: %s" % (e))
                 pass
 
-    max_nb_jobs = 1
-
-    ret_value = 0
-    slave_on_hold = False
+    # job_id -> (subprocess.Popen, start time)
+    processes = {}
+    # jobs waiting for a free slot
+    waiting_jobs = []
+    request_pending = False
+    no_job_delay = poll_interval
+    next_request_time = 0
     while True:
-        ended_jobs_info = {}  # job_id -> (job_status, job_exit_status)
-        t = None
-        if len(commands) < max_nb_jobs:
-            communicator.send(dest=0,
-                              tag=MPIScheduler.JOB_REQUEST)
+        # job_id -> (job_status, exit_info)
+        ended_jobs_info = {}
+        for job_id, (process, start_time) in six.iteritems(processes):
+            ret_value, rusage = scheduler.LocalScheduler._poll_process(process)
+            if ret_value != None:
+                resource_usage = scheduler.LocalScheduler.format_resource_usage(
+                    None, start_time, time.time(), rusage)
+                ended_jobs_info[job_id] = (constants.DONE,
+                                           (constants.FINISHED_REGULARLY,
+                                            ret_value, None, resource_usage))
+        for job_id in ended_jobs_info:
+            del processes[job_id]
+
+        while waiting_jobs and len(processes) < slots:
+            j = waiting_jobs.pop(0)
+            logger.debug("Slave " + repr(rank) + " RUNS JOB"
+                         + repr(j.job_id) + " "
+                         + repr(j.plain_command()))
+            process = scheduler.LocalScheduler.create_process(j)
+            if process is None:
+                ended_jobs_info[j.job_id] = (
+                    constants.FAILED,
+                    (constants.EXIT_ABORTED, None, None, None))
+            else:
+                processes[j.job_id] = (process, time.time())
 
+        free_slots = slots - len(processes)
+        if (free_slots > 0 or not waiting_jobs) and not request_pending \
+                and time.time() >= next_request_time:
             # logger.debug("Slave " + repr(rank) + " job request")
-            communicator.Probe(source=MPI.ANY_SOURCE,
-                               tag=MPI.ANY_TAG, status=status)
-            t = status.Get_tag()
-        elif communicator.Iprobe(source=MPI.ANY_SOURCE,
-                                 tag=MPI.ANY_TAG, status=status):
+            communicator.send({"slots": slots, "free_slots": free_slots},
+                              dest=0,
+                              tag=MPIScheduler.JOB_REQUEST)
+            request_pending = True
+
+        stop = False
+        received = False
+        while communicator.Iprobe(source=0, tag=MPI.ANY_TAG, status=status):
+            received = True
             t = status.Get_tag()
-        if t != None:
             if t == MPIScheduler.JOB_SENDING:
                 job_list = communicator.recv(source=0, tag=t)
+                request_pending = False
+                no_job_delay = poll_interval
                 for j in job_list:
-                    # process = scheduler.LocalScheduler.create_process(j)
-                    separator = " "
-                    if not j.command:  # barrier job
-                        command = None
+                    if not j.command:
+                        # barrier job
+                        ended_jobs_info[j.job_id] = (
+                            constants.DONE,
+                            (constants.FINISHED_REGULARLY, None, None, None))
                     else:
-                        command = ""
-                        for command_el in j.plain_command():
-                            command = command + "\'" + command_el + "\' "
-                    # command = separator.join(j.plain_command())
-                    logger.debug(
-                        "Slave " + repr(rank) + " RUNS JOB" + repr(j.job_id) + " " + str(command))
-                    commands[j.job_id] = command
+                        waiting_jobs.append(j)
             elif t == MPIScheduler.NO_JOB:
                 communicator.recv(source=0, tag=t)
-                # logger.debug("Slave " + repr(rank) + " "
-                #             "received no job " + repr(commands))
-                # time.sleep(1)
+                request_pending = False
+                next_request_time = time.time() + no_job_delay
+                no_job_delay = min(no_job_delay * 2, max_no_job_delay)
             elif t == MPIScheduler.EXIT_SIGNAL:
+                communicator.recv(source=0, tag=t)
                 communicator.send('STOP', dest=0, tag=MPIScheduler.EXIT_SIGNAL)
                 logger.debug("Slave " + repr(rank) + " STOP !!!!! received")
+                stop = True
                 break
             elif t == MPIScheduler.JOB_KILL:
                 job_ids = communicator.recv(source=0, tag=t)
                 for job_id in job_ids:
-                    if job_id in commands.keys():
-                        # TO DO: relevant exception type and message
-                        raise Exception(
-                            "The job " + repr(job_id) + " can not be killed")
-
+                    for j in waiting_jobs:
+                        if j.job_id == job_id:
+                            waiting_jobs.remove(j)
+                            ended_jobs_info[job_id] = (
+                                constants.FAILED,
+                                (constants.EXIT_ABORTED, None, None, None))
+                            break
+                    if job_id in processes:
+                        process, start_time = processes.pop(job_id)
+                        scheduler.LocalScheduler.kill_process(process)
+                        ended_jobs_info[job_id] = (
+                            constants.FAILED,
+                            (constants.USER_KILLED, None, None,
+                             scheduler.LocalScheduler.format_resource_usage(
+                                 None, start_time, time.time())))
+            elif t == MPIScheduler.JOB_STEAL:
+                # give back the last waiting jobs
+                nb_jobs = communicator.recv(source=0, tag=t)
+                returned = waiting_jobs[len(waiting_jobs) - nb_jobs:] \
+                    if nb_jobs > 0 else []
+                del waiting_jobs[len(waiting_jobs) - len(returned):]
+                communicator.send([j.job_id for j in returned], dest=0,
+                                  tag=MPIScheduler.JOB_RETURN)
             else:
                 raise Exception('Unknown tag')
-        for job_id, command in six.iteritems(commands):
-            if command == None:
-                # ended_jobs_info[job_id] = (constants.FAILED,
-                                           #(constants.EXIT_ABORTED, None,
-                                            # None, None))
-                # normally a barrier job
-                ended_jobs_info[job_id] = (constants.DONE,
-                                           (constants.FINISHED_REGULARLY, None,
-                                            None, None))
-            else:
-
-                if j.plain_stderr():
-                    command = command + " >> " + \
-                        j.plain_stdout() + " 2>> " + j.plain_stderr()
-                else:
-                    command = command + " >> " + j.plain_stdout()
-
-                ret_value = os.system(command)
-
-                if ret_value != None:
-                    # if ret_value != 0:
-                        # if ret_value == 32512:
-                        #    slave_on_hold = True
-                        # logger.debug("ERROR COMMAND %s, ret value: %s"
-                        # %(command, repr(ret_value)))
-                    ended_jobs_info[job_id] = (constants.DONE,
-                                               (constants.FINISHED_REGULARLY,
-                                                ret_value, None, None))
 
         if ended_jobs_info:
-            for job_id in six.iterkeys(ended_jobs_info):
-                del commands[job_id]
             logger.debug("Slave " + repr(rank) + " send JOB_RESULT")
             communicator.send(ended_jobs_info, dest=0,
                               tag=MPIScheduler.JOB_RESULT)
-        else:
-            pass
-            # TO DO send Slave is alive
-        if slave_on_hold:
-            logger.debug("Slave %d was punished !!!" % (rank))
-            # time.sleep(1200) #20 mins
+        if stop:
             break
-        else:
-            time.sleep(1)
+        if not received and not ended_jobs_info:
+            time.sleep(poll_interval)
+
+    for job_id, (process, start_time) in six.iteritems(processes):
+        scheduler.LocalScheduler.kill_process(process)
 
     if epd_to_deploy != None:
         logger.debug("Slave %d cleaning ... \n" % (rank))
@@ -159,12 +200,33 @@ def slave_loop(communicator,
                 if os.path.isdir(archive_dir_path):
                     shutil.rmtree(archive_dir_path)
                     logger.debug("remove %s" % (archive_dir_path))
-            except Exception, e:
+            except Exception as e:
                 pass
         logger.debug("Slave %d: end of cleaning! \n" % (rank))
     logger.debug("Slave %d END!!! \n" % (rank))
 
 
+def slots_per_rank(communicator, slots=0):
+    '''
+    Number of jobs each slave runs at the same time.
+    Collective call: all the ranks must call it.
+
+    * slots *int*
+        If 0, the CPUs of each node are shared between the slaves ranks of
+        the node.
+
+    * returns: *tuple*
+        (slots of the calling rank, list of the host names of the ranks)
+    '''
+    hosts = communicator.allgather(MPI.Get_processor_name())
+    if slots > 0:
+        return (slots, hosts)
+    rank = communicator.Get_rank()
+    local_slaves = len([r for r, host in enumerate(hosts)
+                        if host == hosts[rank] and r != 0])
+    return (max(1, cpu_count() // max(1, local_slaves)), hosts)
+
+
 class MPIScheduler(scheduler.Scheduler):
 
     '''
@@ -196,14 +258,73 @@ class MPIScheduler(scheduler.Scheduler):
 
     _failed_count = None
 
+    _job_rank = None
+
+    _kill_requests = None
+
+    # rank -> set of the ids of the jobs sent to the slave and not ended
+    _rank_jobs = None
+
+    # rank -> number of slots of the slave
+    _rank_slots = None
+
+    # ranks asked to give back some of their waiting jobs
+    _steal_requests = None
+
+    # smoothed duration of the jobs (seconds), None until a job ended
+    _mean_duration = None
+
+    # host name of each rank (list), or None
+    _hosts = None
+
+    # engine path of a TemporaryPath -> host where it was written
+    # (collections.OrderedDict, bounded to MAX_TEMPORARY_HOSTS items)
+    _temporary_hosts = None
+
+    # job_id -> time the job was queued
+    _queued_time = None
+
+    # Time (in seconds) a job whose temporary inputs were written on a host
+    # may wait for a slave of this host, before being sent to any slave.
+    locality_wait = None
+
     JOB_REQUEST = 11
     JOB_SENDING = 12
     EXIT_SIGNAL = 13
     JOB_KILL = 14
     JOB_RESULT = 15
     NO_JOB = 16
+    JOB_STEAL = 17
+    JOB_RETURN = 18
+
+    # Time (in seconds) of work a slave should have for each of its slots
+    # after a job request. The slaves running short jobs receive several jobs
+    # per slot, so that they do not wait for the master between two jobs.
+    BATCH_TIME = 2.
 
-    def __init__(self, communicator, interval=1, nb_attempt_per_job=1):
+    # Maximum number of jobs sent for a slot
+    MAX_JOBS_PER_SLOT = 32
+
+    # Weight of the last ended job in the smoothed job duration
+    DURATION_SMOOTHING = 0.2
+
+    # Number of TemporaryPath locations remembered
+    MAX_TEMPORARY_HOSTS = 100000
+
+    # Number of queued jobs examined to find jobs for a given host
+    LOCALITY_SCAN = 1000
+
+    def __init__(self, communicator, interval=1, nb_attempt_per_job=1,
+                 poll_interval=0.01, hosts=None, locality_wait=5.):
+        '''
+        * hosts *list of string*
+            Host name of each rank (see slots_per_rank). If given, the jobs
+            reading TemporaryPath are sent preferably to the slaves of the
+            host where they were written.
+
+        * locality_wait *float*
+            see MPIScheduler.locality_wait
+        '''
         super(MPIScheduler, self).__init__()
 
         self._communicator = communicator
@@ -212,12 +333,23 @@ class MPIScheduler(scheduler.Scheduler):
         self._queue = []
         self._jobs = {}
         self._fail_count = {}  # job_id -> nb of fail
+        self._job_rank = {}  # job_id -> rank of the slave running the job
+        self._kill_requests = []  # running jobs to kill
+        self._rank_jobs = {}
+        self._rank_slots = {}
+        self._steal_requests = set()
+        self._mean_duration = None
+        self._hosts = hosts
+        self._temporary_hosts = collections.OrderedDict()
+        self._queued_time = {}
+        self.locality_wait = locality_wait
         # self._processes = {}
         self._status = {}
         self._exit_info = {}
         self._lock = threading.RLock()
         self.stop_thread_loop = False
         self._interval = interval
+        self._poll_interval = poll_interval
 
         self._nb_attempt_per_job = nb_attempt_per_job
 
@@ -238,51 +370,71 @@ class MPIScheduler(scheduler.Scheduler):
     def end_scheduler_thread(self):
         with self._lock:
             self.stop_thread_loop = True
-            self._loop.join()
-            print("Soma scheduler thread ended nicely.")
+        # the loop needs the lock to end its iteration
+        self._loop.join()
+        print("Soma scheduler thread ended nicely.")
 
     def _master_iteration(self):
         MPIStatus = MPI.Status()
-        # if not self._queue:
-        #    return
-        self._communicator.Probe(source=MPI.ANY_SOURCE,
-                                 tag=MPI.ANY_TAG,
-                                 status=MPIStatus)
+        # non blocking test, so that the kill requests are sent even if the
+        # slaves are all busy and silent.
+        if not self._communicator.Iprobe(source=MPI.ANY_SOURCE,
+                                         tag=MPI.ANY_TAG,
+                                         status=MPIStatus):
+            with self._lock:
+                self._send_kill_requests()
+            time.sleep(self._poll_interval)
+            return
         with self._lock:
+            self._send_kill_requests()
             t = MPIStatus.Get_tag()
+            s = MPIStatus.Get_source()
             if t == MPIScheduler.JOB_REQUEST:
                 # self._logger.debug("Master received the JOB_REQUEST signal")
-                s = MPIStatus.Get_source()
-                if not self._queue:
+                request = self._communicator.recv(
+                    source=s, tag=MPIScheduler.JOB_REQUEST)
+                self._rank_slots[s] = request["slots"]
+                nb_jobs = self._batch_size(s, request["free_slots"])
+                job_list = [self._jobs[job_id] for job_id
+                            in self._select_jobs(s, nb_jobs)]
+                if not job_list:
                     # self._logger.debug("Master No job for now")
-                    self._communicator.recv(source=s,
-                                            tag=MPIScheduler.JOB_REQUEST)
                     self._communicator.send("No job for now",
                                             dest=s,
                                             tag=MPIScheduler.NO_JOB)
+                    if request["free_slots"] > 0 and not self._queue:
+                        self._steal_for(s)
                 else:
-                    self._logger.debug("Master send a Job !!!")
-                    self._communicator.recv(
-                        source=s, tag=MPIScheduler.JOB_REQUEST)
-                    job_id = self._queue.pop(0)
-                    job_list = [self._jobs[job_id]]
+                    self._logger.debug("Master send %d jobs" % len(job_list))
                     self._communicator.send(job_list, dest=s,
                                             tag=MPIScheduler.JOB_SENDING)
+                    rank_jobs = self._rank_jobs.setdefault(s, set())
                     for j in job_list:
                         self._status[j.job_id] = constants.RUNNING
+                        self._job_rank[j.job_id] = s
+                        rank_jobs.add(j.job_id)
             elif t == MPIScheduler.JOB_RESULT:
                 # self._logger.debug("Master received the JOB_RESULT signal")
-                s = MPIStatus.Get_source()
                 ended_jobs_info = self._communicator.recv(
                     source=s,
                     tag=MPIScheduler.JOB_RESULT)
                 for job_id, end_info in six.iteritems(ended_jobs_info):
+                    self._job_rank.pop(job_id, None)
+                    self._rank_jobs.get(s, set()).discard(job_id)
                     job_status, exit_info = end_info
+                    self._update_mean_duration(exit_info[3])
+                    if job_id not in self._jobs or job_id in self._exit_info:
+                        # killed job
+                        continue
+                    if job_status == constants.DONE:
+                        self._record_temporary_outputs(self._jobs[job_id], s)
                     ret_value = exit_info[1]
-                    if ret_value != 0 and \
+                    if exit_info[0] == constants.FINISHED_REGULARLY and \
+                       ret_value != 0 and \
                        (job_id not in self._fail_count or
                             self._fail_count[job_id] < self._nb_attempt_per_job):
                         self._queue.insert(0, job_id)
+                        self._queued_time[job_id] = time.time()
                         if job_id in self._fail_count:
                             self._fail_count[
                                 job_id] = self._fail_count[job_id] + 1
@@ -293,14 +445,157 @@ class MPIScheduler(scheduler.Scheduler):
                     else:
                         self._exit_info[job_id] = exit_info
                         self._status[job_id] = job_status
+            elif t == MPIScheduler.JOB_RETURN:
+                # jobs given back by a slave after a JOB_STEAL request
+                job_ids = self._communicator.recv(
+                    source=s, tag=MPIScheduler.JOB_RETURN)
+                self._steal_requests.discard(s)
+                for job_id in reversed(job_ids):
+                    self._job_rank.pop(job_id, None)
+                    self._rank_jobs.get(s, set()).discard(job_id)
+                    if job_id not in self._jobs or job_id in self._exit_info:
+                        continue
+                    self._status[job_id] = constants.QUEUED_ACTIVE
+                    self._queue.insert(0, job_id)
+                    self._queued_time.setdefault(job_id, time.time())
             elif t == MPIScheduler.EXIT_SIGNAL:
                 # self._logger.debug("Master received the EXIT_SIGNAL")
+                self._communicator.recv(source=s,
+                                        tag=MPIScheduler.EXIT_SIGNAL)
                 self._stopped_slaves = self._stopped_slaves + 1
                 if self._stopped_slaves == self._communicator.size - 1:
                     self.stop_thread_loop = True
             else:
                 self._logger.critical("Master unknown tag")
 
+    def _record_temporary_outputs(self, job, rank):
+        '''
+        Remember the host where the TemporaryPath outputs of an ended job
+        were written.
+        '''
+        if self._hosts is None:
+            return
+        for output in job.referenced_output_files:
+            if isinstance(output, TemporaryPath) and \
+                    output in job.transfer_mapping:
+                path = job.transfer_mapping[output].get_engine_path()
+                self._temporary_hosts.pop(path, None)
+                self._temporary_hosts[path] = self._hosts[rank]
+        while len(self._temporary_hosts) > MPIScheduler.MAX_TEMPORARY_HOSTS:
+            self._temporary_hosts.popitem(last=False)
+
+    def _preferred_host(self, job):
+        '''
+        * returns: *string*
+            Host where most of the job TemporaryPath inputs were written, or
+            None.
+        '''
+        counts = {}
+        for job_input in job.referenced_input_files:
+            if isinstance(job_input, TemporaryPath) and \
+                    job_input in job.transfer_mapping:
+                host = self._temporary_hosts.get(
+                    job.transfer_mapping[job_input].get_engine_path())
+                if host is not None:
+                    counts[host] = counts.get(host, 0) + 1
+        if not counts:
+            return None
+        return max(counts, key=lambda host: counts[host])
+
+    def _select_jobs(self, rank, nb_jobs):
+        '''
+        Remove from the queue and return the ids of the jobs to send to a
+        slave, in the queue order but first the jobs whose TemporaryPath
+        inputs were written on the slave host. The jobs which prefer another
+        host are not sent until they waited locality_wait seconds.
+        '''
+        if nb_jobs <= 0:
+            return []
+        if self._hosts is None or not self._temporary_hosts \
+                or not self.locality_wait:
+            job_ids = self._queue[:nb_jobs]
+            del self._queue[:nb_jobs]
+        else:
+            host = self._hosts[rank]
+            now = time.time()
+            local = []
+            other = []
+            for job_id in self._queue[:MPIScheduler.LOCALITY_SCAN]:
+                preferred_host = self._preferred_host(self._jobs[job_id])
+                if preferred_host == host:
+                    local.append(job_id)
+                    if len(local) == nb_jobs:
+                        break
+                elif preferred_host is None or \
+                        now - self._queued_time.get(job_id, now) \
+                        >= self.locality_wait:
+                    other.append(job_id)
+            job_ids = (local + other)[:nb_jobs]
+            selected = set(job_ids)
+            self._queue = [job_id for job_id in self._queue
+                           if job_id not in selected]
+        for job_id in job_ids:
+            self._queued_time.pop(job_id, None)
+        return job_ids
+
+    def _update_mean_duration(self, resource_usage):
+        duration = scheduler.parse_resource_usage(
+            resource_usage).get('wallclock')
+        if duration is None:
+            return
+        duration = float(duration)
+        if self._mean_duration is None:
+            self._mean_duration = duration
+        else:
+            self._mean_duration += MPIScheduler.DURATION_SMOOTHING \
+                * (duration - self._mean_duration)
+
+    def _batch_size(self, rank, free_slots):
+        '''
+        Number of jobs to send to a slave which requests jobs.
+
+        Each slot of the slave should have BATCH_TIME seconds of work, given
+        the smoothed job duration: the slaves running short jobs get the
+        next jobs before their slots are idle (prefetch). The batch is
+        bounded by a fair share of the queue between the slaves, but always
+        fills the free slots when the queue is long enough.
+        '''
+        if not self._queue:
+            return 0
+        slots = self._rank_slots.get(rank, 1)
+        jobs_per_slot = 1
+        if self._mean_duration is not None:
+            jobs_per_slot = int(min(
+                MPIScheduler.MAX_JOBS_PER_SLOT,
+                max(1, MPIScheduler.BATCH_TIME
+                    // max(self._mean_duration, 1e-3))))
+        wanted = slots * jobs_per_slot - len(self._rank_jobs.get(rank, ()))
+        nb_slaves = max(1, self._communicator.size - 1)
+        fair_share = -(-len(self._queue) // nb_slaves)
+        return max(0, min(wanted, fair_share), min(free_slots,
+                                                   len(self._queue)))
+
+    def _steal_for(self, rank):
+        '''
+        The queue is empty and the slave has free slots: ask the slave with
+        the largest number of waiting jobs (jobs sent but beyond its slots)
+        to give back half of them. They are queued again and sent at the
+        next job requests.
+        '''
+        victim = None
+        backlog = 0
+        for other_rank, job_ids in six.iteritems(self._rank_jobs):
+            if other_rank == rank or other_rank in self._steal_requests:
+                continue
+            other_backlog = len(job_ids) - self._rank_slots.get(other_rank, 1)
+            if other_backlog > backlog:
+                victim = other_rank
+                backlog = other_backlog
+        if victim is not None:
+            self._communicator.send(-(-backlog // 2), dest=victim,
+                                    tag=MPIScheduler.JOB_STEAL)
+            self._steal_requests.add(victim)
+
     def sleep(self):
         self.is_sleeping = True
 
@@ -327,6 +622,7 @@ class MPIScheduler(scheduler.Scheduler):
             self._queue.append(job.job_id)
             self._jobs[job.job_id] = job
             self._status[job.job_id] = constants.QUEUED_ACTIVE
+            self._queued_time[job.job_id] = time.time()
             self._queue.sort(key=lambda job_id: self._jobs[job_id].priority,
                              reverse=True)
             self._logger.debug("A Job was submitted.")
@@ -352,17 +648,58 @@ class MPIScheduler(scheduler.Scheduler):
         exit_status, exit_value, term_sig, resource_usage
         '''
         with self._lock:
-            exit_info = self._exit_info[scheduler_job_id]
-            del self._exit_info[scheduler_job_id]
+            exit_info = self._exit_info.pop(scheduler_job_id)
+            # the engine does not need the job any more
+            self._status.pop(scheduler_job_id, None)
+            self._jobs.pop(scheduler_job_id, None)
+            self._fail_count.pop(scheduler_job_id, None)
         return exit_info
 
+    def _send_kill_requests(self):
+        '''
+        Send the kill requests to the slaves running the jobs. The slaves
+        answer with a JOB_RESULT message.
+        '''
+        ranks = {}
+        for job_id in self._kill_requests:
+            rank = self._job_rank.get(job_id)
+            if rank is not None:
+                ranks.setdefault(rank, []).append(job_id)
+        self._kill_requests = []
+        for rank, job_ids in six.iteritems(ranks):
+            self._communicator.send(job_ids, dest=rank,
+                                    tag=MPIScheduler.JOB_KILL)
+
     def kill_job(self, scheduler_job_id):
         '''
         * scheduler_job_id *string*
         Job id for the scheduling system (DRMAA for example)
         '''
-        # TODO
-        pass
+        with self._lock:
+            if scheduler_job_id in self._queue:
+                self._queue.remove(scheduler_job_id)
+                self._queued_time.pop(scheduler_job_id, None)
+                self._status[scheduler_job_id] = constants.FAILED
+                self._exit_info[scheduler_job_id] = (constants.EXIT_ABORTED,
+                                                     None, None, None)
+            elif scheduler_job_id in self._job_rank:
+                # the kill request is sent by the master loop thread, which
+                # does all the communications.
+                self._kill_requests.append(scheduler_job_id)
+                self._status[scheduler_job_id] = constants.FAILED
+                self._exit_info[scheduler_job_id] = (constants.USER_KILLED,
+                                                     None, None, None)
+
+    def release_job(self, scheduler_job_id):
+        '''
+        * scheduler_job_id *string*
+        Job id for the scheduling system (DRMAA for example)
+        '''
+        with self._lock:
+            self._status.pop(scheduler_job_id, None)
+            self._jobs.pop(scheduler_job_id, None)
+            self._fail_count.pop(scheduler_job_id, None)
+            self._exit_info.pop(scheduler_job_id, None)
 
 if __name__ == '__main__':
 
@@ -389,6 +726,17 @@ if __name__ == '__main__':
                       help="A job can be restarted several time if it fails. This option "
                            "specify the number of attempt per job. "
                            "By default, the jobs are not restarted.")
+    parser.add_option('--slots_per_rank', type="int",
+                      dest='slots_per_rank', default=0,
+                      help="Number of jobs run at the same time by each slave "
+                           "rank. By default, the CPUs of each node are shared "
+                           "between the slave ranks of the node.")
+    parser.add_option('--locality_wait', type="float",
+                      dest='locality_wait', default=5.,
+                      help="Time (in seconds) a job reading temporary files "
+                           "may wait for a slave of the node where the files "
+                           "were written. 0 disables the locality aware "
+                           "dispatch. Default: 5 seconds.")
     group_alpha = optparse.OptionGroup(parser, "Alpha options")
     parser.add_option_group(group_alpha)
     group_alpha.add_option('--deploy_epd', dest='epd_to_deploy', default=None,
@@ -399,6 +747,8 @@ if __name__ == '__main__':
 
     options, args = parser.parse_args(sys.argv)
 
+    slots, hosts = slots_per_rank(comm, options.slots_per_rank)
+
     if rank == 0:
 
         from soma_workflow.engine import WorkflowEngine, ConfiguredWorkflowEngine
@@ -450,7 +800,8 @@ if __name__ == '__main__':
             logger.info("epd_to_deploy " + repr(options.epd_to_deploy))
             logger.info("untar_directory " + repr(options.untar_directory))
             sch = MPIScheduler(
-                comm, interval=1, nb_attempt_per_job=options.nb_attempt_per_job)
+                comm, interval=1, nb_attempt_per_job=options.nb_attempt_per_job,
+                hosts=hosts, locality_wait=options.locality_wait)
 
             config.disable_queue_limits()
 
@@ -484,18 +835,20 @@ if __name__ == '__main__':
             while not sch.stop_thread_loop:
                 time.sleep(1)
             logger.debug("######### master ends #############")
-        except Exception, e:
+        except Exception as e:
             for slave in range(1, comm.size):
                 logger.debug("STOP !!!  slave " + repr(slave))
                 comm.send('STOP', dest=slave, tag=MPIScheduler.EXIT_SIGNAL)
-            raise e
+            raise
     # slave code
     else:
         logger = logging.getLogger("testMPI.slave")
         logger.setLevel(logging.DEBUG)
         logger.addHandler(log_file_handler)
-        logger.info("=====> slave starts " + repr(rank))
+        logger.info("=====> slave starts " + repr(rank) + " with "
+                    + repr(slots) + " slots")
         slave_loop(comm,
                    logger=logger,
                    epd_to_deploy=options.epd_to_deploy,
-                   untar_directory=options.untar_directory)
+                   untar_directory=options.untar_directory,
+                   slots=slots)
@@ -23,10 +23,11 @@ import stat
 import operator
 import random
 import pickle
-import types
 import subprocess
 import sys
 import posixpath
+import threading
+import six
 
 if sys.version_info[:2] >= (2, 6):
     import json
@@ -34,7 +35,7 @@ if sys.version_info[:2] >= (2, 6):
 # import traceback
 
 import soma_workflow.connection as connection
-from soma_workflow.transfer import PortableRemoteTransfer, TransferSCP, TransferRsync, TransferMonitoring, TransferLocal
+from soma_workflow.transfer import PortableRemoteTransfer, TransferSCP, TransferRsync, TransferMonitoring, TransferLocal, ParallelTransferExecutor, Transfer
 import soma_workflow.constants as constants
 import soma_workflow.configuration as configuration
 from soma_workflow.errors import TransferError, SerializationError, SomaWorkflowError
@@ -47,6 +48,8 @@ from soma_workflow.errors import TransferError, SerializationError, SomaWorkflow
 # imports required by the users of soma-workflow API (do not remove):
 from soma_workflow.client_types import Job
 from soma_workflow.client_types import BarrierJob
+from soma_workflow.client_types import PythonJob
+from soma_workflow.client_types import RetryPolicy
 from soma_workflow.client_types import Workflow
 from soma_workflow.client_types import Group
 from soma_workflow.client_types import FileTransfer
@@ -71,6 +74,9 @@ class WorkflowController(object):
 
     _transfer_stdouterr = None
 
+    # number of files transfered at the same time by transfer_files
+    _transfer_streams = None
+
     config = None
 
     engine_config_proxy = None
@@ -174,9 +180,16 @@ class WorkflowController(object):
                                              username=login,
                                              hostname=sub_machine)
             else:
-                self._transfer = PortableRemoteTransfer(self._engine_proxy)
+                self._transfer = PortableRemoteTransfer(
+                    self._engine_proxy,
+                    hash_algorithm=self.config.get_transfer_hash(),
+                    nb_streams=self.config.get_transfer_streams(),
+                    compression_level=self.config.get_transfer_compression(),
+                    dedup=self.config.get_transfer_dedup())
             self._transfer_stdouterr = PortableRemoteTransfer(
-                self._engine_proxy)
+                self._engine_proxy,
+                hash_algorithm=self.config.get_transfer_hash(),
+                compression_level=self.config.get_transfer_compression())
 
         # LIGHT MODE
         elif mode == configuration.LIGHT_MODE:
@@ -198,6 +211,7 @@ class WorkflowController(object):
             self._transfer_stdouterr = TransferLocal(self._engine_proxy)
 
         self._transfer_monitoring = TransferMonitoring(self._engine_proxy)
+        self._transfer_streams = self.config.get_transfer_streams()
 
     def disconnect(self):
         '''
@@ -402,14 +416,19 @@ class WorkflowController(object):
         '''
         wf_status = self._engine_proxy.workflow_elements_status(workflow_id)
         # special processing for transfer status:
+        counters = self._transfer_counters(
+            [(engine_path, status) for engine_path, client_path,
+             client_paths, status, transfer_type in wf_status[1]])
         new_transfer_status = []
         for engine_path, client_path, client_paths, status, transfer_type \
                 in wf_status[1]:
-            progression = self._transfer_progression(status,
-                                                     transfer_type,
-                                                     client_path,
-                                                     client_paths,
-                                                     engine_path)
+            progression = counters.get(engine_path)
+            if progression is None:
+                progression = self._transfer_progression(status,
+                                                         transfer_type,
+                                                         client_path,
+                                                         client_paths,
+                                                         engine_path)
 
             new_transfer_status.append((engine_path, (status, progression)))
 
@@ -455,6 +474,23 @@ class WorkflowController(object):
         '''
         return self._engine_proxy.job_termination_status(job_id)
 
+    def job_attempts(self, job_id):
+        '''
+        Runs of a job which were followed by a resubmission (see
+        RetryPolicy). The last run is given by job_termination_status.
+
+        * job_id *job identifier*
+
+        * returns: *list of tuple(int, datetime.datetime, string, int or None,
+          string or None, string)*
+            For each run, in order: the attempt number, the date of the end
+            of the run, and the exit status, exit value, terminating signal
+            and resource usage as in job_termination_status.
+
+        Raises *UnknownObjectError* if the job_id is not valid
+        '''
+        return self._engine_proxy.job_attempts(job_id)
+
     def retrieve_job_stdouterr(self,
                                job_id,
                                stdout_file_path,
@@ -515,11 +551,14 @@ class WorkflowController(object):
          client_paths,
          transfer_type,
          status) = self._engine_proxy.transfer_information(transfer_id)
-        progression = self._transfer_progression(status,
-                                                 transfer_type,
-                                                 client_path,
-                                                 client_paths,
-                                                 transfer_id)
+        progression = self._transfer_counters(
+            [(transfer_id, status)]).get(transfer_id)
+        if progression is None:
+            progression = self._transfer_progression(status,
+                                                     transfer_type,
+                                                     client_path,
+                                                     client_paths,
+                                                     transfer_id)
 
         return (status, progression)
 
@@ -714,17 +753,62 @@ class WorkflowController(object):
             by piece. The size of each piece can be tuned using the buffer_size
             argument.
 
+        The files are transfered several at the same time, the largest
+        first (configuration item TRANSFER_STREAMS). If a transfer fails,
+        the others are still completed and signaled as ended before the
+        error is raised.
+
         * returns: *boolean*
             The transfer was done. (TBI right error management)
 
         Raises *UnknownObjectError* if the transfer_id is not valid
         #Raises *TransferError*
         '''
-        if not type(transfer_ids) in types.StringTypes:
+        if isinstance(transfer_ids, six.string_types):
+            transfer_ids = [transfer_ids]
+        executor = ParallelTransferExecutor(self._transfer_streams)
+        to_end = []
+        # transfer_id -> number of moves not completed yet
+        remaining = {}
+        # transfers whose moves all completed
+        done = set()
+        lock = threading.Lock()
+
+        def move_files(transfer_id, to_remote, source, destination,
+                       progress=None):
+            self._move_files(to_remote, source, destination, buffer_size,
+                             transfer_id, progress)
+            with lock:
+                remaining[transfer_id] -= 1
+                if remaining[transfer_id] == 0:
+                    done.add(transfer_id)
+
+        try:
             for transfer_id in transfer_ids:
-                self._transfer_file(transfer_id, buffer_size)
-        else:
-            self._transfer_file(transfer_ids, buffer_size)
+                actions = self._transfer_actions(transfer_id)
+                if actions is None:
+                    continue
+                workflow_id, moves = actions
+                self._set_transfer_size(transfer_id, moves)
+                remaining[transfer_id] = len(moves)
+                if not moves:
+                    done.add(transfer_id)
+                for size, to_remote, source, destination in moves:
+                    executor.add(size, move_files, transfer_id, to_remote,
+                                 source, destination)
+                to_end.append((transfer_id, workflow_id))
+        finally:
+            try:
+                executor.run()
+            finally:
+                for transfer_id, workflow_id in to_end:
+                    if transfer_id not in done:
+                        continue
+                    self._engine_proxy.set_transfer_status(
+                        transfer_id, constants.FILES_ON_CLIENT_AND_CR)
+                    self._engine_proxy.signalTransferEnded(transfer_id,
+                                                           workflow_id)
+        return len(to_end) == len(transfer_ids)
 
     def delete_transfer(self, transfer_id):
         '''
@@ -828,8 +912,16 @@ class WorkflowController(object):
 
             return transfer_type
 
-    def _transfer_file(self, transfer_id, buffer_size):
+    def _transfer_actions(self, transfer_id):
+        '''
+        Initializes the transfer and returns the files and directories to
+        copy.
 
+        * returns: *tuple or None*
+            (workflow_id, list of (size, to_remote, source, destination)),
+            to_remote being True for the copies from the client to the
+            computing resource. None if there is nothing to transfer.
+        '''
         (transfer_id,
          client_path,
          expiration_date,
@@ -841,79 +933,107 @@ class WorkflowController(object):
         if status == constants.FILES_ON_CLIENT or \
            status == constants.TRANSFERING_FROM_CLIENT_TO_CR:
             # transfer from client to computing resource
-            # overwrite = False
-            # if not transfer_type or \
-             # transfer_type == constants.TR_FILE_CR_TO_C or \
-             # transfer_type == constants.TR_DIR_CR_TO_C or \
-             # transfer_type == constants.TR_MFF_CR_TO_C:
-                # transfer reset
-                # overwrite = True
             transfer_type = self._initialize_transfer(transfer_id)
 
             remote_path = transfer_id
 
             if transfer_type == constants.TR_FILE_C_TO_CR or \
                transfer_type == constants.TR_DIR_C_TO_CR:
-                self._transfer.transfer_to_remote(client_path,
-                                                  remote_path)
-                self._engine_proxy.set_transfer_status(
-                    transfer_id, constants.FILES_ON_CLIENT_AND_CR)
-                self._engine_proxy.signalTransferEnded(
-                    transfer_id, workflow_id)
-                return True
+                return (workflow_id,
+                        [(self._local_size(client_path), True, client_path,
+                          remote_path)])
 
             if transfer_type == constants.TR_MFF_C_TO_CR:
+                moves = []
                 for path in client_paths:
                     relative_path = os.path.basename(path)
                     r_path = posixpath.join(remote_path, relative_path)
-                    self._transfer.transfer_to_remote(path,
-                                                      r_path)
-
-                self._engine_proxy.set_transfer_status(
-                    transfer_id, constants.FILES_ON_CLIENT_AND_CR)
-                self._engine_proxy.signalTransferEnded(
-                    transfer_id, workflow_id)
-                return True
+                    moves.append((self._local_size(path), True, path, r_path))
+                return (workflow_id, moves)
 
         if status == constants.FILES_ON_CR or \
            status == constants.TRANSFERING_FROM_CR_TO_CLIENT or \
            status == constants.FILES_ON_CLIENT_AND_CR:
             # transfer from computing resource to client
-            # overwrite = False
-            # if not transfer_type or \
-             # transfer_type == constants.TR_FILE_C_TO_CR or \
-             # transfer_type == constants.TR_DIR_C_TO_CR or \
-             # transfer_type == constants.TR_MFF_C_TO_CR :
-                # TBI remove existing files
-                # overwrite = True
             transfer_type = self._initialize_transfer(transfer_id)
 
             remote_path = transfer_id
             if transfer_type == constants.TR_FILE_CR_TO_C or \
                transfer_type == constants.TR_DIR_CR_TO_C:
-                # file case
-                self._transfer.transfer_from_remote(remote_path,
-                                                    client_path)
-                self._engine_proxy.set_transfer_status(
-                    transfer_id, constants.FILES_ON_CLIENT_AND_CR)
-                self._engine_proxy.signalTransferEnded(
-                    transfer_id, workflow_id)
-                return True
+                return (workflow_id,
+                        [(self._remote_size(remote_path), False, remote_path,
+                          client_path)])
 
             if transfer_type == constants.TR_MFF_CR_TO_C:
+                moves = []
                 for path in client_paths:
                     relative_path = os.path.basename(path)
                     r_path = posixpath.join(remote_path, relative_path)
-                    self._transfer.transfer_from_remote(r_path,
-                                                        path)
+                    moves.append((self._remote_size(r_path), False, r_path,
+                                  path))
+                return (workflow_id, moves)
 
-                self._engine_proxy.set_transfer_status(
-                    transfer_id, constants.FILES_ON_CLIENT_AND_CR)
-                self._engine_proxy.signalTransferEnded(
-                    transfer_id, workflow_id)
-                return True
+        return None
 
-        return False
+    @staticmethod
+    def _local_size(path):
+        if os.path.isdir(path):
+            return Transfer.get_dir_size(path)
+        if os.path.isfile(path):
+            return os.path.getsize(path)
+        return 0
+
+    def _remote_size(self, remote_path):
+        if self._engine_proxy.is_dir(remote_path):
+            return self._engine_proxy.get_dir_size(remote_path)
+        return self._engine_proxy.get_file_size(remote_path)
+
+    def _move_files(self, to_remote, source, destination, buffer_size,
+                    transfer_id=None, progress=None):
+        '''
+        Copy a file or a directory, from the client to the computing resource
+        if to_remote, the other way otherwise.
+        '''
+        kwargs = {}
+        if isinstance(self._transfer, PortableRemoteTransfer):
+            kwargs = {'buffer_size': buffer_size, 'progress': progress,
+                      'transfer_id': transfer_id}
+        if to_remote:
+            self._transfer.transfer_to_remote(source, destination, **kwargs)
+        else:
+            self._transfer.transfer_from_remote(source, destination,
+                                                **kwargs)
+
+    def _set_transfer_size(self, transfer_id, moves):
+        '''
+        Gives the engine the size of a transfer made through transfer
+        sessions, which count the bytes transfered (see _transfer_counters).
+        '''
+        if isinstance(self._transfer, PortableRemoteTransfer):
+            self._engine_proxy.set_transfer_size(
+                transfer_id, sum([move[0] for move in moves]))
+
+    def _transfer_counters(self, transfers):
+        '''
+        Progression of the transfers in progress read from the counters of
+        the engine, in one call and without reading the files.
+
+        * transfers *list of tuple(transfer_id, status)*
+
+        * returns: *dictionary transfer_id -> (data size, data transfered)*
+            The transfers unknown to the counters are missing: their
+            progression is computed from the files by
+            _transfer_progression.
+        '''
+        transfer_ids = [transfer_id for transfer_id, status in transfers
+                        if status in (constants.TRANSFERING_FROM_CLIENT_TO_CR,
+                                      constants.TRANSFERING_FROM_CR_TO_CLIENT)]
+        if not transfer_ids:
+            return {}
+        progressions = self._engine_proxy.transfer_progressions(transfer_ids)
+        return dict([(transfer_id, progression) for transfer_id, progression
+                     in zip(transfer_ids, progressions)
+                     if progression is not None])
 
     def _transfer_progression(self,
                               status,
@@ -1056,10 +1176,7 @@ def _embedded_engine_and_server(config, local_scheduler_config=None):
     if config.get_scheduler_type() == configuration.DRMAA_SCHEDULER:
         from soma_workflow.scheduler import DrmaaCTypes
         # print("scheduler type: drmaa")
-        scheduler = DrmaaCTypes(config.get_drmaa_implementation(),
-                                config.get_parallel_job_config(),
-                                configured_native_spec
-                                    =config.get_native_specification())
+        scheduler = DrmaaCTypes.from_config(config)
 
     elif config.get_scheduler_type() == configuration.LOCAL_SCHEDULER:
         from soma_workflow.scheduler import ConfiguredLocalScheduler
@@ -1069,6 +1186,20 @@ def _embedded_engine_and_server(config, local_scheduler_config=None):
         # repr(local_scheduler_config.get_proc_nb()))
         scheduler = ConfiguredLocalScheduler(local_scheduler_config)
 
+    elif config.get_scheduler_type() == configuration.HYBRID_SCHEDULER:
+        from soma_workflow.scheduler import DrmaaCTypes, \
+            ConfiguredLocalScheduler, HybridScheduler
+        if local_scheduler_config == None:
+            local_scheduler_config = LocalSchedulerCfg()
+        scheduler = HybridScheduler(
+            ConfiguredLocalScheduler(local_scheduler_config),
+            DrmaaCTypes.from_config(config),
+            **config.get_hybrid_config())
+
+    elif config.get_scheduler_type() == configuration.SIMULATED_SCHEDULER:
+        from soma_workflow.scheduler import SimulatedScheduler
+        scheduler = SimulatedScheduler(**config.get_simulation_config())
+
     workflow_engine = ConfiguredWorkflowEngine(database_server,
                                                scheduler,
                                                config)
@@ -17,6 +17,7 @@
 
 import warnings
 import sys
+import json
 import soma_workflow.constants as constants
 
 # python2/3 compatibility
@@ -32,6 +33,141 @@ if sys.version_info[0] >= 3:
 #-------------------------------------------------------------------------
 
 
+class RetryPolicy(object):
+
+    '''
+    Resubmission of the failed jobs by the engine, before they are marked as
+    failed (and before their failure aborts the jobs depending on them in a
+    workflow). A policy can be set on a job, or on a workflow for all its
+    jobs which have none.
+
+    Each attempt is recorded in the database (see
+    WorkflowController.job_attempts).
+
+    **max_attempts**: *int*
+      Maximum number of runs of the job, the first one included.
+
+    **delay**: *float*
+      Time (in seconds) waited before the first resubmission.
+
+    **backoff**: *float*
+      Factor applied to the delay at each new resubmission.
+
+    **max_delay**: *float or None*
+      Maximum time (in seconds) waited before a resubmission.
+
+    **exit_values**: *sequence of int or None*
+      Exit values for which the job is resubmitted. If None, any non zero
+      exit value.
+
+    **signals**: *sequence of string or None*
+      Terminating signals (as reported by the scheduler, "SIGKILL" for
+      example) for which the job is resubmitted. If None, any signal.
+
+    **retry_aborted**: *boolean*
+      Resubmit the jobs aborted by the scheduler, or which ended in unclear
+      conditions (node failures for example).
+
+    The jobs killed by the user are never resubmitted.
+    '''
+
+    # int
+    max_attempts = None
+
+    # float (seconds)
+    delay = None
+
+    # float
+    backoff = None
+
+    # float (seconds) or None
+    max_delay = None
+
+    # list of int or None
+    exit_values = None
+
+    # list of string or None
+    signals = None
+
+    # boolean
+    retry_aborted = None
+
+    def __init__(self,
+                 max_attempts=3,
+                 delay=0.,
+                 backoff=2.,
+                 max_delay=None,
+                 exit_values=None,
+                 signals=None,
+                 retry_aborted=True):
+        self.max_attempts = max_attempts
+        self.delay = delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        if exit_values is not None:
+            exit_values = list(exit_values)
+        self.exit_values = exit_values
+        if signals is not None:
+            signals = list(signals)
+        self.signals = signals
+        self.retry_aborted = retry_aborted
+
+    def should_retry(self,
+                     attempt,
+                     exit_status,
+                     exit_value,
+                     terminating_signal):
+        '''
+        * attempt *int*
+            Number of the run which ended (1 for the first run).
+
+        * returns: *boolean*
+            True if the job has to be resubmitted.
+        '''
+        if attempt >= self.max_attempts:
+            return False
+        if exit_status == constants.FINISHED_REGULARLY:
+            if not exit_value:
+                return False
+            return self.exit_values is None or exit_value in self.exit_values
+        if exit_status == constants.FINISHED_TERM_SIG:
+            return self.signals is None \
+                or str(terminating_signal) in self.signals
+        if exit_status in (constants.EXIT_ABORTED,
+                           constants.EXIT_UNDETERMINED,
+                           constants.FINISHED_UNCLEAR_CONDITIONS):
+            return self.retry_aborted
+        return False
+
+    def retry_delay(self, attempt):
+        '''
+        Time (in seconds) waited before the run following the attempt
+        number attempt.
+        '''
+        delay = self.delay * self.backoff ** (attempt - 1)
+        if self.max_delay is not None:
+            delay = min(delay, self.max_delay)
+        return delay
+
+    def attributs_equal(self, other):
+        if not isinstance(other, self.__class__):
+            return False
+        return self.to_dict() == other.to_dict()
+
+    def to_dict(self):
+        return {"max_attempts": self.max_attempts,
+                "delay": self.delay,
+                "backoff": self.backoff,
+                "max_delay": self.max_delay,
+                "exit_values": self.exit_values,
+                "signals": self.signals,
+                "retry_aborted": self.retry_aborted}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**d)
+
+
 class Job(object):
 
     '''
@@ -121,6 +257,17 @@ class Job(object):
     **user_storage**: *picklable object*
       For the user needs, any small and picklable object can be stored here.
 
+    **idempotent**: *boolean*
+      The job can be run several times, even at the same time, with the same
+      result: it does not modify its inputs and writes its outputs
+      atomically. Such a job may be duplicated when it runs abnormally slowly,
+      if the speculative execution is configured (configuration item
+      SPECULATIVE_EXECUTION).
+
+    **retry_policy**: *RetryPolicy or None*
+      Resubmission of the job when it fails. If None, the retry policy of
+      the workflow, if any.
+
     ..
       **disposal_time_out**: int
       Only requiered outside of a workflow
@@ -171,6 +318,12 @@ class Job(object):
     # any small and picklable object needed by the user
     user_storage = None
 
+    # boolean
+    idempotent = False
+
+    # RetryPolicy or None
+    retry_policy = None
+
     def __init__(self,
                  command,
                  referenced_input_files=None,
@@ -185,7 +338,9 @@ class Job(object):
                  parallel_job_info=None,
                  priority=0,
                  native_specification=None,
-                 user_storage=None):
+                 user_storage=None,
+                 idempotent=False,
+                 retry_policy=None):
         if not name and len(command) != 0:
             self.name = command[0]
         else:
@@ -208,6 +363,9 @@ class Job(object):
         self.parallel_job_info = parallel_job_info
         self.priority = priority
         self.native_specification = native_specification
+        self.user_storage = user_storage
+        self.idempotent = idempotent
+        self.retry_policy = retry_policy
 
         for command_elem in self.command:
             if isinstance(command_elem, basestring):
@@ -270,6 +428,7 @@ class Job(object):
             "native_specification",
             "parallel_job_info",
             "disposal_timeout",
+            "idempotent",
         ]
         for attr_name in attributs:
             attr = getattr(self, attr_name)
@@ -282,8 +441,20 @@ class Job(object):
                     return False
             elif not attr == other_attr:
                 return False
+        if self.retry_policy is None or other.retry_policy is None:
+            if self.retry_policy is not other.retry_policy:
+                return False
+        elif not self.retry_policy.attributs_equal(other.retry_policy):
+            return False
         return True
 
+    @classmethod
+    def _create_from_dict(cls, d):
+        '''
+        Build the job instance which from_dict fills with the attributes.
+        '''
+        return cls(command=d["command"])
+
     @classmethod
     def from_dict(cls,
                   d,
@@ -298,7 +469,7 @@ class Job(object):
          * tmp_from_ids *id -> TemporaryPath*
          * opt_from_ids *id -> OptionPath*
         '''
-        job = cls(command=d["command"])
+        job = cls._create_from_dict(d)
         for key, value in six.iteritems(d):
             setattr(job, key, value)
 
@@ -309,6 +480,9 @@ class Job(object):
                                              opt_from_ids)
         job.command = new_command
 
+        if job.retry_policy is not None:
+            job.retry_policy = RetryPolicy.from_dict(job.retry_policy)
+
         if job.referenced_input_files:
             ref_in_files = list_from_serializable(job.referenced_input_files,
                                                   tr_from_ids,
@@ -376,11 +550,15 @@ class Job(object):
             "native_specification",
             "parallel_job_info",
             "disposal_timeout",
+            "idempotent",
         ]
 
         for attr_name in attributs:
             job_dict[attr_name] = getattr(self, attr_name)
 
+        if self.retry_policy is not None:
+            job_dict["retry_policy"] = self.retry_policy.to_dict()
+
         # command, referenced_input_files, referenced_output_files
         # stdin, stdout_file, stderr_file and working_directory
         # can contain FileTransfer et SharedResourcePath.
@@ -577,6 +755,136 @@ class BarrierJob(Job):
         return job_dict
 
 
+class PythonJob(Job):
+
+    '''
+    Job running a Python callable.
+
+    With the local scheduler, the callable is run by a persistent Python
+    worker: the interpreter startup and the modules imports are not paid for
+    each job. With the other schedulers, the job runs the command: ::
+
+      python -m soma_workflow.python_worker <python_callable> <args> <kwargs>
+
+    where args and kwargs are JSON encoded.
+
+    The exit value of the job is 0 if the callable returns, the code of
+    SystemExit if it raises it, and 1 if it raises any other exception (the
+    traceback is written to the job standard error).
+
+    PythonJob constructor accepts the Job constructor parameters, except
+    command, and:
+
+    **python_callable**: *string*
+      The callable to run, as "package.module:function" or
+      "package.module.function". It must be importable by the computing
+      resource Python.
+
+    **args**: *list*
+      Positional arguments of the callable. Must be JSON serializable.
+
+    **kwargs**: *dictionary*
+      Keyword arguments of the callable. Must be JSON serializable.
+    '''
+
+    # string
+    python_callable = None
+
+    # list
+    args = None
+
+    # dictionary
+    kwargs = None
+
+    def __init__(self,
+                 python_callable,
+                 args=None,
+                 kwargs=None,
+                 referenced_input_files=None,
+                 referenced_output_files=None,
+                 stdin=None,
+                 join_stderrout=False,
+                 disposal_timeout=168,
+                 name=None,
+                 stdout_file=None,
+                 stderr_file=None,
+                 working_directory=None,
+                 parallel_job_info=None,
+                 priority=0,
+                 native_specification=None,
+                 user_storage=None,
+                 idempotent=False,
+                 retry_policy=None):
+        self.python_callable = python_callable
+        if args:
+            self.args = list(args)
+        else:
+            self.args = []
+        if kwargs:
+            self.kwargs = dict(kwargs)
+        else:
+            self.kwargs = {}
+        if not name:
+            name = python_callable
+        super(PythonJob, self).__init__(
+            command=PythonJob.python_command(python_callable, self.args,
+                                             self.kwargs),
+            referenced_input_files=referenced_input_files,
+            referenced_output_files=referenced_output_files,
+            stdin=stdin,
+            join_stderrout=join_stderrout,
+            disposal_timeout=disposal_timeout,
+            name=name,
+            stdout_file=stdout_file,
+            stderr_file=stderr_file,
+            working_directory=working_directory,
+            parallel_job_info=parallel_job_info,
+            priority=priority,
+            native_specification=native_specification,
+            user_storage=user_storage,
+            idempotent=idempotent,
+            retry_policy=retry_policy)
+
+    @staticmethod
+    def python_command(python_callable, args, kwargs):
+        '''
+        Command running the callable in a new Python process.
+        '''
+        return ['python', '-m', 'soma_workflow.python_worker',
+                python_callable, json.dumps(args), json.dumps(kwargs)]
+
+    @classmethod
+    def _create_from_dict(cls, d):
+        return cls(python_callable=d["python_callable"],
+                   args=d.get("args"),
+                   kwargs=d.get("kwargs"))
+
+    def to_dict(self,
+                id_generator,
+                transfer_ids,
+                shared_res_path_id,
+                tmp_ids,
+                opt_ids):
+        '''
+        * id_generator *IdGenerator*
+        * transfer_ids *dict: client.FileTransfer -> int*
+            This dictonary will be modified.
+        * shared_res_path_id *dict: client.SharedResourcePath -> int*
+            This dictonary will be modified.
+        * tmp_ids *dict: client.TemporaryPath -> int*
+        * opt_ids *dict: client.OptionPath -> int*
+        '''
+        job_dict = super(PythonJob, self).to_dict(id_generator,
+                                                  transfer_ids,
+                                                  shared_res_path_id,
+                                                  tmp_ids,
+                                                  opt_ids)
+        job_dict["python_callable"] = self.python_callable
+        job_dict["args"] = self.args
+        job_dict["kwargs"] = self.kwargs
+        return job_dict
+
+
 class Workflow(object):
 
     '''
@@ -615,6 +923,10 @@ class Workflow(object):
       Name of the workflow which will be displayed in the GUI.
       Default: workflow_id once submitted
 
+    **retry_policy**: *RetryPolicy or None*
+      Resubmission of the failed jobs of the workflow which have no retry
+      policy of their own.
+
     '''
     # string
     name = None
@@ -634,15 +946,20 @@ class Workflow(object):
     # any small and picklable object needed by the user
     user_storage = None
 
+    # RetryPolicy or None
+    retry_policy = None
+
     def __init__(self,
                  jobs,
                  dependencies=None,
                  root_group=None,
                  disposal_timeout=168,
                  user_storage=None,
-                 name=None):
+                 name=None,
+                 retry_policy=None):
 
         self.name = name
+        self.retry_policy = retry_policy
         self.jobs = jobs
         if dependencies != None:
             self.dependencies = dependencies
@@ -761,6 +1078,8 @@ class Workflow(object):
         wf_dict = {}
 
         wf_dict["name"] = self.name
+        if self.retry_policy is not None:
+            wf_dict["retry_policy"] = self.retry_policy.to_dict()
 
         new_jobs = []
         for job in self.jobs:
@@ -801,6 +1120,7 @@ class Workflow(object):
 
         ser_jobs = {}
         ser_barriers = {}
+        ser_python_jobs = {}
         transfer_ids = {}  # FileTransfer -> id
         shared_res_path_ids = {}  # SharedResourcePath -> id
         temporary_ids = {}  # TemporaryPath -> id
@@ -812,6 +1132,12 @@ class Workflow(object):
                                                         shared_res_path_ids,
                                                         temporary_ids,
                                                         option_ids)
+            elif isinstance(job, PythonJob):
+                ser_python_jobs[str(job_id)] = job.to_dict(id_generator,
+                                                           transfer_ids,
+                                                           shared_res_path_ids,
+                                                           temporary_ids,
+                                                           option_ids)
             else:
                 ser_jobs[str(job_id)] = job.to_dict(id_generator,
                                                     transfer_ids,
@@ -820,6 +1146,7 @@ class Workflow(object):
                                                     option_ids)
         wf_dict["serialized_jobs"] = ser_jobs
         wf_dict["serialized_barriers"] = ser_barriers
+        wf_dict["serialized_python_jobs"] = ser_python_jobs
 
         ser_transfers = {}
         for file_transfer, transfer_id in six.iteritems(transfer_ids):
@@ -893,7 +1220,15 @@ class Workflow(object):
                 job_d, tr_from_ids, srp_from_ids, tmp_from_ids, opt_from_ids)
             job_from_ids[int(job_id)] = job
 
-        jobs = list(job_from_ids.values())
+        # python jobs (absent from the workflows serialized by older versions)
+        serialized_jobs = d.get("serialized_python_jobs", {})
+        for job_id, job_d in six.iteritems(serialized_jobs):
+            job = PythonJob.from_dict(
+                job_d, tr_from_ids, srp_from_ids, tmp_from_ids, opt_from_ids)
+            job_from_ids[int(job_id)] = job
+
+        # the ids follow the jobs order
+        jobs = [job_from_ids[job_id] for job_id in sorted(job_from_ids)]
 
         # groups
         serialized_groups = d["serialized_groups"]
@@ -930,11 +1265,16 @@ class Workflow(object):
             dep = (job_from_ids[id_dep[0]], job_from_ids[id_dep[1]])
             dependencies.append(dep)
 
+        retry_policy = None
+        if d.get("retry_policy") is not None:
+            retry_policy = RetryPolicy.from_dict(d["retry_policy"])
+
         workflow = cls(jobs,
                        dependencies,
                        root_group=root_group,
                        user_storage=None,
-                       name=name)
+                       name=name,
+                       retry_policy=retry_policy)
 
         return workflow
 
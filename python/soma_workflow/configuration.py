@@ -18,6 +18,7 @@ from __future__ import with_statement, print_function
 import os
 import sys
 import socket
+import hashlib
 try:
     import configparser # python 3
 except ImportError:
@@ -44,9 +45,13 @@ MODES = [LIGHT_MODE,
 LOCAL_SCHEDULER = 'local_basic'
 DRMAA_SCHEDULER = 'drmaa'
 MPI_SCHEDULER = 'mpi'
+SIMULATED_SCHEDULER = 'simulated'
+HYBRID_SCHEDULER = 'hybrid'
 SCHEDULER_TYPES = [LOCAL_SCHEDULER,
                    DRMAA_SCHEDULER,
-                   MPI_SCHEDULER]
+                   MPI_SCHEDULER,
+                   SIMULATED_SCHEDULER,
+                   HYBRID_SCHEDULER]
 
 # configuration variables ------------------------------------------------
 
@@ -69,6 +74,17 @@ OCFG_LOGIN = 'LOGIN'
 OCFG_SSHPort = 'SSHPort'
 OCFG_INSTALLPATH = 'INSTALLPATH'
 
+# hashlib algorithm checking the portable transfers ("md5" by default)
+OCFG_TRANSFER_HASH = 'TRANSFER_HASH'
+# number of files transfered at the same time (4 by default)
+OCFG_TRANSFER_STREAMS = 'TRANSFER_STREAMS'
+# zlib level (1 to 9) of the compression of the portable transfers
+# (0, no compression, by default)
+OCFG_TRANSFER_COMPRESSION = 'TRANSFER_COMPRESSION'
+# share the identical files uploaded by the portable transfers through the
+# transfer store of the server (False by default)
+OCFG_TRANSFER_DEDUP = 'TRANSFER_DEDUP'
+
 # OCFG_MAX_JOB_IN_QUEUE allow to specify a maximum number of job N which can be
 # in the queue for one user. The engine won't submit more than N jobs at once.
 # Also wait for the job to leave the queue before submitting new jobs.
@@ -129,6 +145,41 @@ PARALLEL_JOB_ENV = [OCFG_PARALLEL_ENV_MPI_BIN, OCFG_PARALLEL_ENV_NODE_FILE]
 # Native_specification for all jobs
 OCFG_NATIVE_SPECIFICATION = 'NATIVE_SPECIFICATION'
 
+# DRMAA_IMPLEMENTATION value selecting the in-process fake DRMAA session
+# (see soma_workflow.fake_drmaa), configured by the FAKE_DRMAA_* items
+FAKE_DRMAA_IMPLEMENTATION = 'fake'
+OCFG_FAKE_DRMAA_LATENCIES = 'FAKE_DRMAA_LATENCIES'
+OCFG_FAKE_DRMAA_FAILURES = 'FAKE_DRMAA_FAILURES'
+OCFG_FAKE_DRMAA_QUEUE_TIME = 'FAKE_DRMAA_QUEUE_TIME'
+OCFG_FAKE_DRMAA_JOB_DURATION = 'FAKE_DRMAA_JOB_DURATION'
+OCFG_FAKE_DRMAA_SEED = 'FAKE_DRMAA_SEED'
+
+# DRMAA session behavior when the engine idles: "close" the session (default)
+# or "keep" it open, checking it every DRMAA_SESSION_CHECK_INTERVAL seconds
+OCFG_DRMAA_SESSION_IDLE = 'DRMAA_SESSION_IDLE'
+OCFG_DRMAA_SESSION_CHECK_INTERVAL = 'DRMAA_SESSION_CHECK_INTERVAL'
+DRMAA_SESSION_CLOSE = 'close'
+DRMAA_SESSION_KEEP = 'keep'
+DRMAA_SESSION_IDLE_MODES = [DRMAA_SESSION_CLOSE, DRMAA_SESSION_KEEP]
+
+# speculative execution of the straggler jobs (see
+# engine.SpeculativeExecution): defined to enable it, its value is the
+# slowness factor of the stragglers
+OCFG_SPECULATIVE_EXECUTION = 'SPECULATIVE_EXECUTION'
+OCFG_SPECULATIVE_MIN_SAMPLES = 'SPECULATIVE_MIN_SAMPLES'
+OCFG_SPECULATIVE_MAX_JOBS = 'SPECULATIVE_MAX_JOBS'
+
+# hybrid scheduler configuration (see scheduler.HybridScheduler)
+OCFG_HYBRID_LOCAL_MAX_DURATION = 'HYBRID_LOCAL_MAX_DURATION'
+OCFG_HYBRID_LOCAL_QUEUE = 'HYBRID_LOCAL_QUEUE'
+
+# simulated scheduler configuration (see scheduler.SimulatedScheduler)
+OCFG_SIMULATION_SLOTS = 'SIMULATION_SLOTS'
+OCFG_SIMULATION_QUEUE_LATENCY = 'SIMULATION_QUEUE_LATENCY'
+OCFG_SIMULATION_DEFAULT_DURATION = 'SIMULATION_DEFAULT_DURATION'
+OCFG_SIMULATION_DURATIONS_FILE = 'SIMULATION_DURATIONS_FILE'
+OCFG_SIMULATION_TIME_SCALE = 'SIMULATION_TIME_SCALE'
+
 # local sheduler configuration -------------------------------------------
 
 OCFG_SCDL_CPU_NB = "CPU_NB"
@@ -482,6 +533,78 @@ class Configuration(observer.Observable):
 
         return self._sshport
 
+    def get_transfer_hash(self):
+        '''
+        hashlib algorithm name of the hash checking the portable transfers
+        (see transfer.PortableRemoteTransfer).
+        '''
+        algorithm = 'md5'
+        if self._config_parser != None and \
+           self._config_parser.has_option(self._resource_id,
+                                          OCFG_TRANSFER_HASH):
+            algorithm = self._config_parser.get(self._resource_id,
+                                                OCFG_TRANSFER_HASH).strip()
+            try:
+                hashlib.new(algorithm)
+            except ValueError:
+                raise ConfigurationError(
+                    "Invalid value for %s: %s is not an available hash "
+                    "algorithm." % (OCFG_TRANSFER_HASH, algorithm))
+        return algorithm
+
+    def get_transfer_streams(self):
+        '''
+        Number of files transfered at the same time (see
+        transfer.ParallelTransferExecutor).
+        '''
+        if self._config_parser != None and \
+           self._config_parser.has_option(self._resource_id,
+                                          OCFG_TRANSFER_STREAMS):
+            return int(self._config_parser.get(self._resource_id,
+                                               OCFG_TRANSFER_STREAMS))
+        return 4
+
+    def get_transfer_compression(self):
+        '''
+        zlib level of the compression of the portable transfers (see
+        transfer.ChunkCompressor), None if they are not compressed.
+        '''
+        if self._config_parser != None and \
+           self._config_parser.has_option(self._resource_id,
+                                          OCFG_TRANSFER_COMPRESSION):
+            level = self._config_parser.get(self._resource_id,
+                                            OCFG_TRANSFER_COMPRESSION)
+            try:
+                level = int(level)
+            except ValueError:
+                level = -1
+            if level < 0 or level > 9:
+                raise ConfigurationError(
+                    "Invalid value for %s: the compression level must be "
+                    "an integer between 0 and 9."
+                    % OCFG_TRANSFER_COMPRESSION)
+            if level:
+                return level
+        return None
+
+    def get_transfer_dedup(self):
+        '''
+        Whether the portable transfers link the files already uploaded with
+        the same content instead of sending them again (see
+        transfer.PortableRemoteTransfer).
+        '''
+        if self._config_parser != None and \
+           self._config_parser.has_option(self._resource_id,
+                                          OCFG_TRANSFER_DEDUP):
+            try:
+                return self._config_parser.getboolean(self._resource_id,
+                                                      OCFG_TRANSFER_DEDUP)
+            except ValueError:
+                raise ConfigurationError(
+                    "Invalid value for %s: a boolean is expected."
+                    % OCFG_TRANSFER_DEDUP)
+        return False
+
     def get_submitting_machines(self):
         if self._config_parser == None or self._submitting_machines:
             return self._submitting_machines
@@ -708,6 +831,137 @@ class Configuration(observer.Observable):
                 OCFG_NATIVE_SPECIFICATION)
         return self._native_specification
 
+    def get_fake_drmaa_config(self):
+        '''
+        Parameters of the fake DRMAA session, used if the DRMAA
+        implementation is FAKE_DRMAA_IMPLEMENTATION.
+
+        * returns: *dictionary*
+            keyword arguments of fake_drmaa.FakeSessionFactory
+        '''
+        fake_drmaa_config = {}
+        if self._config_parser == None:
+            return fake_drmaa_config
+        for option, key, convert in (
+                (OCFG_FAKE_DRMAA_LATENCIES, 'latencies', str),
+                (OCFG_FAKE_DRMAA_FAILURES, 'failures', str),
+                (OCFG_FAKE_DRMAA_QUEUE_TIME, 'queue_time', float),
+                (OCFG_FAKE_DRMAA_JOB_DURATION, 'job_duration', float),
+                (OCFG_FAKE_DRMAA_SEED, 'seed', int)):
+            if self._config_parser.has_option(self._resource_id, option):
+                fake_drmaa_config[key] = convert(
+                    self._config_parser.get(self._resource_id, option))
+        return fake_drmaa_config
+
+    def get_drmaa_session_idle(self):
+        '''
+        DRMAA session behavior when the engine idles, among
+        DRMAA_SESSION_IDLE_MODES.
+        '''
+        if self._config_parser != None and \
+           self._config_parser.has_option(self._resource_id,
+                                          OCFG_DRMAA_SESSION_IDLE):
+            mode = self._config_parser.get(self._resource_id,
+                                           OCFG_DRMAA_SESSION_IDLE).strip()
+            if mode not in DRMAA_SESSION_IDLE_MODES:
+                raise ConfigurationError(
+                    "Invalid value for %s: %s. Expected one of %s."
+                    % (OCFG_DRMAA_SESSION_IDLE, mode,
+                       repr(DRMAA_SESSION_IDLE_MODES)))
+            return mode
+        return DRMAA_SESSION_CLOSE
+
+    def get_drmaa_session_check_interval(self):
+        '''
+        Interval (in seconds) between two checks of an idle DRMAA session
+        kept open.
+        '''
+        if self._config_parser != None and \
+           self._config_parser.has_option(self._resource_id,
+                                          OCFG_DRMAA_SESSION_CHECK_INTERVAL):
+            return float(self._config_parser.get(
+                self._resource_id, OCFG_DRMAA_SESSION_CHECK_INTERVAL))
+        return 300.
+
+    def get_speculative_execution_config(self):
+        '''
+        Parameters of the speculative execution of the straggler jobs.
+
+        * returns: *dictionary or None*
+            keyword arguments of engine.SpeculativeExecution, or None if the
+            speculative execution is not enabled.
+        '''
+        if self._config_parser == None or \
+           not self._config_parser.has_option(self._resource_id,
+                                              OCFG_SPECULATIVE_EXECUTION):
+            return None
+        speculation_config = {'factor': float(self._config_parser.get(
+            self._resource_id, OCFG_SPECULATIVE_EXECUTION))}
+        if self._config_parser.has_option(self._resource_id,
+                                          OCFG_SPECULATIVE_MIN_SAMPLES):
+            speculation_config['min_samples'] = int(self._config_parser.get(
+                self._resource_id, OCFG_SPECULATIVE_MIN_SAMPLES))
+        if self._config_parser.has_option(self._resource_id,
+                                          OCFG_SPECULATIVE_MAX_JOBS):
+            speculation_config['max_duplicates'] = int(
+                self._config_parser.get(self._resource_id,
+                                        OCFG_SPECULATIVE_MAX_JOBS))
+        return speculation_config
+
+    def get_hybrid_config(self):
+        '''
+        Routing parameters of the hybrid scheduler.
+
+        * returns: *dictionary*
+            keyword arguments of scheduler.HybridScheduler
+        '''
+        hybrid_config = {'local_max_duration': 60.,
+                         'local_queue': 'local'}
+        if self._config_parser == None:
+            return hybrid_config
+        if self._config_parser.has_option(self._resource_id,
+                                          OCFG_HYBRID_LOCAL_MAX_DURATION):
+            value = self._config_parser.get(
+                self._resource_id, OCFG_HYBRID_LOCAL_MAX_DURATION).strip()
+            if value == 'None':
+                hybrid_config['local_max_duration'] = None
+            else:
+                hybrid_config['local_max_duration'] = float(value)
+        if self._config_parser.has_option(self._resource_id,
+                                          OCFG_HYBRID_LOCAL_QUEUE):
+            value = self._config_parser.get(
+                self._resource_id, OCFG_HYBRID_LOCAL_QUEUE).strip()
+            if value == 'None':
+                value = None
+            hybrid_config['local_queue'] = value
+        return hybrid_config
+
+    def get_simulation_config(self):
+        '''
+        Parameters of the simulated scheduler.
+
+        * returns: *dictionary*
+            keyword arguments of scheduler.SimulatedScheduler
+        '''
+        simulation_config = {'proc_nb': 1,
+                             'queue_latency': 0.,
+                             'default_duration': 1.,
+                             'durations_file': None,
+                             'time_scale': 0.}
+        if self._config_parser == None:
+            return simulation_config
+        for option, key, convert in (
+                (OCFG_SIMULATION_SLOTS, 'proc_nb', int),
+                (OCFG_SIMULATION_QUEUE_LATENCY, 'queue_latency', float),
+                (OCFG_SIMULATION_DEFAULT_DURATION, 'default_duration', float),
+                (OCFG_SIMULATION_DURATIONS_FILE, 'durations_file',
+                 os.path.expandvars),
+                (OCFG_SIMULATION_TIME_SCALE, 'time_scale', float)):
+            if self._config_parser.has_option(self._resource_id, option):
+                simulation_config[key] = convert(
+                    self._config_parser.get(self._resource_id, option))
+        return simulation_config
+
     def get_path_translation(self):
         if self._config_parser == None or self.path_translation != None:
             return self.path_translation
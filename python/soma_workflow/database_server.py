@@ -30,6 +30,7 @@ import soma_workflow.constants as constants
 from soma_workflow.client import FileTransfer, TemporaryPath
 from soma_workflow.errors import UnknownObjectError, DatabaseError
 from soma_workflow.info import DB_VERSION
+from soma_workflow.transfer import clean_transfer_store
 
 # python 2/3 compatibility
 import sys
@@ -63,6 +64,10 @@ if not hasattr(six, 'next'):
 strtime_format = '%Y-%m-%d %H:%M:%S'
 file_separator = ', '
 update_interval = timedelta(0, 30, 0)
+# name of the content-addressed store in the transfer directory of a user
+transfer_store_name = 'transfer_store'
+# minimum time between two cleanings of the transfer stores
+transfer_store_clean_interval = timedelta(hours=1)
 
 #-----------------------------------------------------------------------------
 # Local utilities
@@ -168,6 +173,16 @@ Job server database tables:
     engine file path (transferid)
     input or output
 
+  Job attempts (runs of a job followed by a resubmission, see RetryPolicy)
+    job_id
+    attempt
+    drmaa_id
+    ending date
+    exit_status
+    exit_value
+    terminating_signal
+    resource_usage
+
   Workflows
     id,
     user_id,
@@ -228,7 +243,8 @@ def create_database(database_file):
                                             workflow_id      INTEGER CONSTRAINT known_workflow REFERENCES workflows (id),
                                             status           VARCHAR(255) NOT NULL,
                                             client_paths     TEXT,
-                                            transfer_type TEXT)''')
+                                            transfer_type TEXT,
+                                            transmitted      INTEGER NOT NULL DEFAULT 0)''')
 
     cursor.execute('''CREATE TABLE temporary_paths (
       temp_path_id     INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
@@ -250,6 +266,17 @@ def create_database(database_file):
       is_input      BOOLEAN NOT NULL,
       PRIMARY KEY   (job_id, temp_path_id, is_input))''')
 
+    cursor.execute('''CREATE TABLE job_attempts (
+      job_id              INTEGER NOT NULL CONSTRAINT known_job REFERENCES jobs(id),
+      attempt             INTEGER NOT NULL,
+      drmaa_id            VARCHAR(255),
+      ending_date         DATE,
+      exit_status         VARCHAR(255),
+      exit_value          INTEGER,
+      terminating_signal  VARCHAR(255),
+      resource_usage      TEXT,
+      PRIMARY KEY         (job_id, attempt))''')
+
     cursor.execute('''CREATE TABLE fileCounter (count INTEGER)''')
     cursor.execute('INSERT INTO fileCounter (count) VALUES (?)', [0])
 
@@ -369,6 +396,9 @@ class WorkflowDatabaseServer(object):
         EngineTemporaryPath.temporary_directory = self._shared_temp_dir
 
         self._lock = threading.RLock()
+        # last cleaning of the transfer stores, and thread cleaning them
+        self._store_clean_date = datetime.min
+        self._store_cleaning = None
 
         self.logger = logging.getLogger('jobServer')
         self.logger.debug("=> starting database server")
@@ -430,6 +460,14 @@ class WorkflowDatabaseServer(object):
             self._tmp_file_dir_path, login + "_" + repr(user_id))
         return path  # supposes simple logins. Or use only the user id ?
 
+    def transfer_store_path(self, login, user_id):
+        '''
+        Directory of the content-addressed store of the files transfered by
+        the user (see RemoteFileController.link_stored_file).
+        '''
+        return os.path.join(self._user_transfer_dir_path(login, user_id),
+                            transfer_store_name)
+
     def register_user(self, login):
         '''
         Register a user so that he can submit job.
@@ -491,6 +529,9 @@ class WorkflowDatabaseServer(object):
                 cursor.execute(
                     'DELETE FROM ios_tmp WHERE job_id IN (%s)' % job_str,
                     jobsToDelete)
+                cursor.execute(
+                    'DELETE FROM job_attempts WHERE job_id IN (%s)' % job_str,
+                    jobsToDelete)
 
                 for stdof, stdef in cursor.execute(
                         '''SELECT
@@ -569,6 +610,8 @@ class WorkflowDatabaseServer(object):
                     'DELETE FROM workflows WHERE expiration_date < ?',
                     [date.today()])
 
+                users = list(cursor.execute('SELECT id, login FROM users'))
+
             except Exception as e:
                 connection.rollback()
                 cursor.close()
@@ -579,8 +622,36 @@ class WorkflowDatabaseServer(object):
             connection.commit()
             connection.close()
 
+            # the transfer stores are walked from time to time only, in an
+            # other thread: the lock is not held meanwhile
+            now = datetime.now()
+            if now - self._store_clean_date > transfer_store_clean_interval \
+                    and (self._store_cleaning is None
+                         or not self._store_cleaning.is_alive()):
+                self._store_clean_date = now
+                self._store_cleaning = threading.Thread(
+                    target=self._clean_transfer_stores,
+                    args=([self.transfer_store_path(
+                        self._string_conversion(login), user_id)
+                        for user_id, login in users],))
+                self._store_cleaning.daemon = True
+                self._store_cleaning.start()
+
             # self.remove_non_registered_files()
 
+    def _clean_transfer_stores(self, stores):
+        '''
+        Remove the files of the transfer stores not linked to any transfer
+        anymore (see clean_transfer_store).
+        '''
+        for store in stores:
+            try:
+                clean_transfer_store(store)
+            except Exception as e:
+                self.logger.debug(
+                    "Could not clean the transfer store %s, error %s: "
+                    "%s \n" % (store, type(e), e))
+
     def vacuum(self):
         '''
         Resize the database file, so that it shrinks to the necessary size, not more.
@@ -635,7 +706,9 @@ class WorkflowDatabaseServer(object):
             directory_path = self._user_transfer_dir_path(login, user_id)
             for name in os.listdir(directory_path):
                 engine_path = os.path.join(directory_path, name)
-                if not engine_path in registered_engine_paths:
+                if name == transfer_store_name:
+                    self._clean_transfer_stores([engine_path])
+                elif not engine_path in registered_engine_paths:
                     self.logger.debug(
                         "remove_non_registered_files, not registered " + engine_path + " to delete!")
                     self.__removeFile(engine_path)
@@ -1260,6 +1333,76 @@ class WorkflowDatabaseServer(object):
             cursor.close()
             connection.close()
 
+    def set_transfer_transmitted(self, engine_file_path, transmitted):
+        '''
+        Records the number of bytes of the transfer already present on its
+        destination side, for an interrupted transfer to be resumed.
+
+        @type  transmitted: int
+        '''
+        self.logger.debug("=> set_transfer_transmitted")
+        with self._lock:
+            connection = self._connect()
+            cursor = connection.cursor()
+            try:
+                cursor.execute(
+                    'UPDATE transfers SET transmitted=? WHERE engine_file_path=?',
+                    (transmitted, engine_file_path))
+            except Exception as e:
+                connection.rollback()
+                cursor.close()
+                connection.close()
+                raise DatabaseError('%s: %s \n' % (type(e), e))
+            connection.commit()
+            cursor.close()
+            connection.close()
+
+    def add_transfer_transmitted(self, engine_file_path, size):
+        '''
+        Adds size bytes to the transmitted size of the transfer (see
+        set_transfer_transmitted).
+        '''
+        self.logger.debug("=> add_transfer_transmitted")
+        with self._lock:
+            connection = self._connect()
+            cursor = connection.cursor()
+            try:
+                cursor.execute(
+                    'UPDATE transfers SET transmitted=transmitted+? '
+                    'WHERE engine_file_path=?',
+                    (size, engine_file_path))
+            except Exception as e:
+                connection.rollback()
+                cursor.close()
+                connection.close()
+                raise DatabaseError('%s: %s \n' % (type(e), e))
+            connection.commit()
+            cursor.close()
+            connection.close()
+
+    def get_transfer_transmitted(self, engine_file_path, user_id):
+        '''
+        Returns the number of bytes of the transfer recorded as present on
+        its destination side.
+        '''
+        self.logger.debug("=> get_transfer_transmitted")
+        with self._lock:
+            connection = self._connect()
+            cursor = connection.cursor()
+            self._check_transfer(connection, cursor, engine_file_path, user_id)
+            try:
+                transmitted = six.next(cursor.execute(
+                    'SELECT transmitted FROM transfers WHERE engine_file_path=?',
+                    [engine_file_path]))[0]
+            except Exception as e:
+                cursor.close()
+                connection.close()
+                raise DatabaseError('%s: %s \n' % (type(e), e))
+            cursor.close()
+            connection.close()
+
+        return transmitted
+
     def set_transfer_type(self, engine_file_path, transfer_type, user_id):
         self.logger.debug("=> set_transfer_type")
         with self._lock:
@@ -2524,6 +2667,88 @@ class WorkflowDatabaseServer(object):
                 cursor.close()
                 connection.close()
 
+    def add_job_attempt(self, job):
+        '''
+        Record the end of a run of a job which is going to be resubmitted
+        (see client_types.RetryPolicy).
+
+        @type  job: C{EngineJob}
+        @param job: job holding the exit information of the run number
+        job.attempt
+        '''
+        self.logger.debug("=> add_job_attempt")
+        with self._lock:
+            connection = self._connect()
+            cursor = connection.cursor()
+            try:
+                cursor.execute('''INSERT INTO job_attempts
+                                  (job_id,
+                                   attempt,
+                                   drmaa_id,
+                                   ending_date,
+                                   exit_status,
+                                   exit_value,
+                                   terminating_signal,
+                                   resource_usage)
+                                  VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                               (job.job_id,
+                                job.attempt,
+                                job.drmaa_id,
+                                datetime.now(),
+                                job.exit_status,
+                                job.exit_value,
+                                job.terminating_signal,
+                                job.str_rusage))
+            except Exception as e:
+                connection.rollback()
+                cursor.close()
+                connection.close()
+                raise DatabaseError('%s: %s \n' % (type(e), e))
+            connection.commit()
+            cursor.close()
+            connection.close()
+
+    def get_job_attempts(self, job_id, user_id):
+        '''
+        Returns the runs of the job which were followed by a resubmission.
+
+        @type job_id: C{JobIdentifier}
+        @rtype: list of tuple
+        @return: (attempt, ending_date, exit_status, exit_value,
+        terminating_signal, resource_usage) for each run, in order
+        '''
+        self.logger.debug("=> get_job_attempts")
+        with self._lock:
+            connection = self._connect()
+            cursor = connection.cursor()
+            self._check_job(connection, cursor, job_id, user_id)
+            try:
+                attempts = []
+                for row in cursor.execute(
+                        '''SELECT attempt,
+                                  ending_date,
+                                  exit_status,
+                                  exit_value,
+                                  terminating_signal,
+                                  resource_usage
+                        FROM job_attempts WHERE job_id=?
+                        ORDER BY attempt''',
+                        [job_id]):
+                    attempts.append(
+                        (row[0],
+                         self._str_to_date_conversion(row[1]),
+                         self._string_conversion(row[2]),
+                         row[3],
+                         self._string_conversion(row[4]),
+                         self._string_conversion(row[5])))
+            except Exception as e:
+                cursor.close()
+                connection.close()
+                raise DatabaseError('%s: %s \n' % (type(e), e))
+            cursor.close()
+            connection.close()
+        return attempts
+
     def _string_conversion(self, string):
         # return string
         if string:
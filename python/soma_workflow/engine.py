@@ -26,6 +26,8 @@ import hashlib
 import operator
 import itertools
 import atexit
+import copy
+import collections
 import six
 
 # import cProfile
@@ -85,6 +87,221 @@ class EngineLoopThread(threading.Thread):
         # print("Soma workflow engine thread ended nicely.")
 
 
+class SpeculativeExecution(object):
+
+    '''
+    Speculative re-execution of the straggler jobs.
+
+    The durations of the jobs which ended successfully are kept by signature
+    (workflow, job name and program). When an idempotent job (Job.idempotent)
+    runs for more than factor times the median duration of its signature, a
+    duplicate of the job is submitted. The first of the two which ends
+    successfully is kept, the other one is killed.
+
+    The duplicate writes its standard output and error in its own files,
+    which replace the job ones if it wins. The other outputs of the jobs are
+    not redirected: an idempotent job must support to run twice at the same
+    time, writing its output files atomically (to a temporary file renamed
+    at the end, for instance).
+
+    * _durations *dictionary signature -> collections.deque of float*
+
+    * _medians *dictionary signature -> float*
+        Cache of the median durations.
+
+    * _start_times *dictionary job_id -> float*
+        Time at which the engine saw each job running for the first time.
+
+    * _duplicates *dictionary job_id -> EngineJob*
+        Running duplicates.
+
+    * _speculated *set of job_id*
+        Jobs already duplicated once.
+    '''
+
+    # suffix of the duplicates ids and standard output and error files
+    SUFFIX = '.speculative'
+
+    def __init__(self, scheduler, factor=2., min_samples=5,
+                 max_duplicates=10, history_size=100):
+        '''
+        * scheduler *Scheduler*
+
+        * factor *float*
+            A job is a straggler when it runs for more than factor times the
+            median duration of its signature.
+
+        * min_samples *int*
+            Minimum number of known durations of a signature.
+
+        * max_duplicates *int*
+            Maximum number of duplicates running at the same time.
+
+        * history_size *int*
+            Number of durations kept for each signature.
+        '''
+        self.logger = logging.getLogger('engine.SpeculativeExecution')
+        self.scheduler = scheduler
+        self.factor = factor
+        self.min_samples = min_samples
+        self.max_duplicates = max_duplicates
+        self.history_size = history_size
+        self._durations = {}
+        self._medians = {}
+        self._start_times = {}
+        self._duplicates = {}
+        self._speculated = set()
+
+    @staticmethod
+    def signature(job):
+        program = None
+        if job.command:
+            program = str(job.command[0])
+        return (job.workflow_id, job.name, program)
+
+    def median_duration(self, signature):
+        '''
+        * returns: *float or None*
+            None if less than min_samples durations are known.
+        '''
+        median = self._medians.get(signature)
+        if median is None:
+            durations = self._durations.get(signature)
+            if not durations or len(durations) < self.min_samples:
+                return None
+            durations = sorted(durations)
+            median = durations[len(durations) // 2]
+            self._medians[signature] = median
+        return median
+
+    def check(self, job, now=None):
+        '''
+        Follow a job whose status was just updated: duplicate it if it is a
+        straggler, or settle the race with its duplicate.
+
+        * job *EngineJob*
+
+        * returns: *tuple or None*
+            Exit information of the duplicate if it won: the job must then
+            be considered as done with this exit information. None
+            otherwise.
+        '''
+        if job.status != constants.RUNNING:
+            return None
+        if now is None:
+            now = time.time()
+        start_time = self._start_times.setdefault(job.job_id, now)
+        duplicate = self._duplicates.get(job.job_id)
+        if duplicate is not None:
+            return self._check_duplicate(job, duplicate)
+        if not job.idempotent or job.job_id in self._speculated \
+                or len(self._duplicates) >= self.max_duplicates:
+            return None
+        median = self.median_duration(self.signature(job))
+        if median is not None and now - start_time > self.factor * median:
+            self._duplicate(job)
+        return None
+
+    def _duplicate(self, job):
+        duplicate = copy.copy(job)
+        duplicate.job_id = "%s%s" % (job.job_id, self.SUFFIX)
+        stdout_file = job.plain_stdout()
+        if stdout_file:
+            duplicate.stdout_file = stdout_file + self.SUFFIX
+        stderr_file = job.plain_stderr()
+        if stderr_file:
+            duplicate.stderr_file = stderr_file + self.SUFFIX
+        try:
+            duplicate.drmaa_id = self.scheduler.job_submission(duplicate)
+        except DRMError as e:
+            self.logger.error("duplicate of job %s: %s" % (job.job_id, e))
+            return
+        self.logger.info("job %s is a straggler: duplicate submitted"
+                         % job.job_id)
+        self._duplicates[job.job_id] = duplicate
+        self._speculated.add(job.job_id)
+
+    def _check_duplicate(self, job, duplicate):
+        try:
+            status = self.scheduler.get_job_status(duplicate.drmaa_id)
+            if status not in (constants.DONE, constants.FAILED):
+                return None
+            exit_info = self.scheduler.get_job_exit_info(duplicate.drmaa_id)
+        except DRMError as e:
+            self.logger.error("duplicate of job %s: %s" % (job.job_id, e))
+            self._discard(job.job_id)
+            return None
+        del self._duplicates[job.job_id]
+        if exit_info[0] != constants.FINISHED_REGULARLY or exit_info[1] != 0:
+            # the job keeps running
+            self._remove_outputs(duplicate)
+            return None
+        self.logger.info("the duplicate of job %s ended first" % job.job_id)
+        try:
+            self.scheduler.kill_job(job.drmaa_id)
+            self.scheduler.release_job(job.drmaa_id)
+        except DRMError as e:
+            self.logger.error("kill job %s: %s" % (job.job_id, e))
+        for path, duplicate_path in (
+                (job.plain_stdout(), duplicate.stdout_file),
+                (job.plain_stderr(), duplicate.stderr_file)):
+            if path and duplicate_path and os.path.exists(duplicate_path):
+                if os.path.exists(path):
+                    os.unlink(path)
+                os.rename(duplicate_path, path)
+        # the duration of the job is not a regular one
+        self._start_times.pop(job.job_id, None)
+        return exit_info
+
+    def _remove_outputs(self, duplicate):
+        for path in (duplicate.stdout_file, duplicate.stderr_file):
+            if path and os.path.exists(path):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    def _discard(self, job_id):
+        duplicate = self._duplicates.pop(job_id, None)
+        if duplicate is None:
+            return
+        try:
+            self.scheduler.kill_job(duplicate.drmaa_id)
+            self.scheduler.release_job(duplicate.drmaa_id)
+        except DRMError as e:
+            self.logger.error("kill duplicate of job %s: %s" % (job_id, e))
+        self._remove_outputs(duplicate)
+
+    def job_ended(self, job, now=None):
+        '''
+        Record the end of a job, once its exit information is known. A
+        running duplicate is killed.
+        '''
+        if now is None:
+            now = time.time()
+        self._discard(job.job_id)
+        self._speculated.discard(job.job_id)
+        start_time = self._start_times.pop(job.job_id, None)
+        if start_time is not None and job.status == constants.DONE \
+                and job.exit_status == constants.FINISHED_REGULARLY \
+                and job.exit_value == 0:
+            signature = self.signature(job)
+            durations = self._durations.get(signature)
+            if durations is None:
+                durations = collections.deque(maxlen=self.history_size)
+                self._durations[signature] = durations
+            durations.append(now - start_time)
+            self._medians.pop(signature, None)
+
+    def forget(self, job):
+        '''
+        The job is stopped: its duplicate is killed.
+        '''
+        self._discard(job.job_id)
+        self._speculated.discard(job.job_id)
+        self._start_times.pop(job.job_id, None)
+
+
 class WorkflowEngineLoop(object):
 
     # jobs managed by the current engine process instance.
@@ -127,12 +344,20 @@ class WorkflowEngineLoop(object):
 
     logger = None
 
+    # SpeculativeExecution, or None
+    _speculation = None
+
+    # Failed jobs waiting for their resubmission (see RetryPolicy).
+    # dictionary job_id -> (resubmission time, EngineJob)
+    _retry_jobs = None
+
     def __init__(self,
                  database_server,
                  scheduler,
                  path_translation=None,
                  queue_limits={},
-                 running_jobs_limits={}):
+                 running_jobs_limits={},
+                 speculation=None):
 
         self.logger = logging.getLogger('engine.WorkflowEngineLoop')
 
@@ -149,11 +374,14 @@ class WorkflowEngineLoop(object):
 
         self._running_jobs_limits = running_jobs_limits
 
+        self._speculation = speculation
+
         self.logger.debug('queue_limits ' + repr(self._queue_limits))
         self.logger.debug(
             'running_jobs_limits ' + repr(self._running_jobs_limits))
 
         self._pending_queues = {}
+        self._retry_jobs = {}
 
         # The running flag is set to True at the beginning, not in start_loop(),
         # to overcome race conditions which may occur in this situation:
@@ -209,9 +437,13 @@ class WorkflowEngineLoop(object):
             if not self._running:
                 break
             with self._lock:
-                ended_jobs = drms_error_jobs  # {}
+                ended_jobs = {}
                 wf_to_inspect = set()  # set of workflow id
                 for job in six.itervalues(drms_error_jobs):
+                    if not job.is_done():
+                        # resubmitted
+                        continue
+                    ended_jobs[job.job_id] = job
                     if job.workflow_id != -1:
                         wf_to_inspect.add(job.workflow_id)
                 drms_error_jobs = {}
@@ -302,11 +534,17 @@ class WorkflowEngineLoop(object):
                                 "!!!ERROR!!! get_job_status %s: %s" % (type(e), e))
                             job.status = constants.FAILED
                             job.exit_status = constants.EXIT_ABORTED
-                            stderr_file = open(job.stderr_file, "wa")
+                            stderr_file = open(job.stderr_file, "a")
                             stderr_file.write(
                                 "Error while requesting the job status %s: %s \nWarning: the job may still be running.\n" % (type(e), e))
                             stderr_file.close()
                             drms_error_jobs[job.job_id] = job
+                        speculative_exit_info = None
+                        if self._speculation is not None:
+                            speculative_exit_info \
+                                = self._speculation.check(job)
+                            if speculative_exit_info is not None:
+                                job.status = constants.DONE
                         self.logger.debug(
                             "job " + repr(job.job_id) + " : " + job.status)
                         if job.status == constants.DONE \
@@ -314,12 +552,16 @@ class WorkflowEngineLoop(object):
                             self.logger.debug(
                                 "End of job %s, drmaaJobId = %s, status= %s",
                                 job.job_id, job.drmaa_id, repr(job.status))
+                            if speculative_exit_info is None:
+                                speculative_exit_info \
+                                    = self._scheduler.get_job_exit_info(
+                                        job.drmaa_id)
                             (job.exit_status,
                              job.exit_value,
                              job.terminating_signal,
-                             job.str_rusage) \
-                                = self._scheduler.get_job_exit_info(
-                                    job.drmaa_id)
+                             job.str_rusage) = speculative_exit_info
+                            if self._speculation is not None:
+                                self._speculation.job_ended(job)
 
                             self.logger.debug("  after get_job_exit_info ")
                             self.logger.debug(
@@ -331,6 +573,9 @@ class WorkflowEngineLoop(object):
                             self.logger.debug(
                                 "  => rusage " + repr(job.str_rusage))
 
+                            if self._retry(job):
+                                continue
+
                             if job.workflow_id != -1:
                                 wf_to_inspect.add(job.workflow_id)
                             if job.status == constants.DONE:
@@ -387,6 +632,12 @@ class WorkflowEngineLoop(object):
                         self._pend_for_submission(job)
 
                 # --- 5. Check if pending jobs can now be submitted -----------
+                now = time.time()
+                for job_id, (retry_time, job) \
+                        in list(six.iteritems(self._retry_jobs)):
+                    if retry_time <= now:
+                        del self._retry_jobs[job_id]
+                        self._pend_for_submission(job)
                 self.logger.debug("Check pending jobs")
                 jobs_to_run = self._get_pending_job_to_submit()
                 self.logger.debug("jobs_to_run=" + repr(jobs_to_run))
@@ -409,11 +660,13 @@ class WorkflowEngineLoop(object):
                                                            type(e), e))
                         job.status = constants.FAILED
                         job.exit_status = constants.EXIT_ABORTED
-                        stderr_file = open(job.stderr_file, "wa")
+                        stderr_file = open(job.stderr_file, "a")
                         stderr_file.write(
                             "Error while submitting the job %s: %s\n" % (type(e), e))
                         stderr_file.close()
-                        drms_error_jobs[job.job_id] = job
+                        # before step 7, which forgets the ended jobs
+                        if not self._retry(job):
+                            drms_error_jobs[job.job_id] = job
                     else:
                         drmaa_id_for_db_up[job.job_id] = job.drmaa_id
                         job.status = constants.UNDETERMINED
@@ -648,6 +901,37 @@ class WorkflowEngineLoop(object):
 
         return engine_workflow.wf_id
 
+    def _retry(self, job):
+        '''
+        Prepare the resubmission of a failed job, if its retry policy allows
+        it: the run is recorded in the database, and the job is pending for
+        submission again once the policy delay has elapsed.
+
+        @rtype: boolean
+        @return: True if the job is going to be resubmitted.
+        '''
+        if job.retry_policy is None or not job.failed() or \
+                not job.retry_policy.should_retry(job.attempt,
+                                                  job.exit_status,
+                                                  job.exit_value,
+                                                  job.terminating_signal):
+            return False
+        self._database_server.add_job_attempt(job)
+        delay = job.retry_policy.retry_delay(job.attempt)
+        self.logger.info("job %s: attempt %d failed (%s, %s, %s), "
+                         "resubmission in %.1fs",
+                         job.job_id, job.attempt, job.exit_status,
+                         repr(job.exit_value), job.terminating_signal, delay)
+        job.attempt += 1
+        job.drmaa_id = None
+        job.exit_status = None
+        job.exit_value = None
+        job.terminating_signal = None
+        job.str_rusage = None
+        job.status = constants.SUBMISSION_PENDING
+        self._retry_jobs[job.job_id] = (time.time() + delay, job)
+        return True
+
     def _stop_job(self, job_id, job):
         if job.status == constants.DONE or job.status == constants.FAILED:
             return False
@@ -658,12 +942,18 @@ class WorkflowEngineLoop(object):
                         job.drmaa_id) + " status " + repr(job.status))
                     try:
                         self._scheduler.kill_job(job.drmaa_id)
+                        # the exit info of the killed job is not requested
+                        self._scheduler.release_job(job.drmaa_id)
                     except DRMError as e:
                         # TBI how to communicate the error
                         self.logger.error("!!!ERROR!!! %s:%s" % (type(e), e))
+                    if self._speculation is not None:
+                        self._speculation.forget(job)
                 elif job.queue in self._pending_queues and \
                         job in self._pending_queues[job.queue]:
                     self._pending_queues[job.queue].remove(job)
+                elif job_id in self._retry_jobs:
+                    del self._retry_jobs[job_id]
                 if job.status in (
                     constants.RUNNING, constants.SYSTEM_SUSPENDED,
                     constants.USER_SUSPENDED,
@@ -752,19 +1042,35 @@ class WorkflowEngine(RemoteFileController):
     engine_loop_thread = None
     # id of the user on the database server
     _user_id = None
+    # minimum time (seconds) between two records of the progress of a
+    # transfer in the database
+    transmitted_record_interval = 2.
 
     def __init__(self,
                  database_server,
                  scheduler,
                  path_translation=None,
                  queue_limits={},
-                 running_jobs_limits={}):
+                 running_jobs_limits={},
+                 speculation=None):
         '''
         @type  database_server:
                L{soma_workflow.database_server.WorkflowDatabaseServer}
         @type  engine_loop: L{WorkflowEngineLoop}
+        @type  speculation: L{SpeculativeExecution} or None
         '''
 
+        RemoteFileController.__init__(self)
+
+        # transfer engine path -> bytes transfered not recorded yet
+        self._transmitted = {}
+        # transfer engine path -> date of the last record
+        self._transmitted_dates = {}
+        # transfer engine path -> [size or None, bytes transfered] for the
+        # transfers in progress
+        self._transfer_counters = {}
+        self._transmitted_lock = threading.Lock()
+
         self.logger = logging.getLogger('engine.WorkflowEngine')
 
         self._database_server = database_server
@@ -777,12 +1083,15 @@ class WorkflowEngine(RemoteFileController):
 
         self._user_id = self._database_server.register_user(user_login)
         self.logger.debug("user_id : " + repr(self._user_id))
+        self.transfer_store = self._database_server.transfer_store_path(
+            user_login, self._user_id)
 
         self.engine_loop = WorkflowEngineLoop(database_server,
                                               scheduler,
                                               path_translation,
                                               queue_limits,
-                                              running_jobs_limits)
+                                              running_jobs_limits,
+                                              speculation)
         self.engine_loop_thread = EngineLoopThread(self.engine_loop)
         self.engine_loop_thread.setDaemon(True)
         self.engine_loop_thread.start()
@@ -829,8 +1138,83 @@ class WorkflowEngine(RemoteFileController):
         '''
         Set a transfer status.
         '''
+        if status in (constants.TRANSFERING_FROM_CLIENT_TO_CR,
+                      constants.TRANSFERING_FROM_CR_TO_CLIENT):
+            # (re)start of the transfer: the resumed files are counted
+            # again when their transfer sessions are opened.
+            self._close_transfer_sessions(engine_path)
+            with self._transmitted_lock:
+                self._transmitted.pop(engine_path, None)
+                self._transmitted_dates.pop(engine_path, None)
+                self._transfer_counters[engine_path] = [None, 0]
+            self._database_server.set_transfer_transmitted(engine_path, 0)
+        else:
+            with self._transmitted_lock:
+                self._transfer_counters.pop(engine_path, None)
         self._database_server.set_transfer_status(engine_path, status)
 
+    def set_transfer_size(self, engine_path, size):
+        '''
+        Size of the data of a transfer in progress, given by the client
+        which transfers it (see transfer_progressions).
+        '''
+        with self._transmitted_lock:
+            counter = self._transfer_counters.get(engine_path)
+            if counter is not None:
+                counter[0] = size
+
+    def transfer_progressions(self, engine_paths):
+        '''
+        Progression of the transfers in progress, read from the counters
+        of their transfer sessions: no file is read.
+
+        @rtype: list of tuple (int, int) or None
+        @return: (data size, size of data transfered) for each transfer,
+                 None if the engine does not know (transfer not in progress
+                 or not made through transfer sessions).
+        '''
+        progressions = []
+        with self._transmitted_lock:
+            for engine_path in engine_paths:
+                counter = self._transfer_counters.get(engine_path)
+                if counter is None or counter[0] is None:
+                    progressions.append(None)
+                else:
+                    progressions.append((counter[0], counter[1]))
+        return progressions
+
+    def transfer_transmitted(self, engine_path):
+        '''
+        Number of bytes of the transfer present on its destination side, as
+        recorded by the engine.
+        '''
+        return self._database_server.get_transfer_transmitted(engine_path,
+                                                              self._user_id)
+
+    def _transfer_progress(self, transfer_id, size, ended=False):
+        '''
+        Counts the bytes transfered (see transfer_progressions) and records
+        the progress of the transfer in the database, at most every
+        transmitted_record_interval seconds, and when a session ends.
+        '''
+        now = time.time()
+        with self._transmitted_lock:
+            counter = self._transfer_counters.get(transfer_id)
+            if counter is not None:
+                counter[1] += size
+            transmitted = self._transmitted.pop(transfer_id, 0) + size
+            if ended:
+                self._transmitted_dates.pop(transfer_id, None)
+            elif now - self._transmitted_dates.get(transfer_id, 0) \
+                    < self.transmitted_record_interval:
+                self._transmitted[transfer_id] = transmitted
+                return
+            else:
+                self._transmitted_dates[transfer_id] = now
+        if transmitted:
+            self._database_server.add_transfer_transmitted(transfer_id,
+                                                           transmitted)
+
     def delete_transfer(self, engine_path):
         '''
         Implementation of soma_workflow.client.WorkflowController API
@@ -1058,6 +1442,12 @@ class WorkflowEngine(RemoteFileController):
 
         return job_exit_info
 
+    def job_attempts(self, job_id):
+        '''
+        Implementation of soma_workflow.client.WorkflowController API
+        '''
+        return self._database_server.get_job_attempts(job_id, self._user_id)
+
     def stdouterr_file_path(self, job_id):
         (stdout_file,
          stderr_file) = self._database_server.get_std_out_err_file_path(job_id,
@@ -1265,12 +1655,18 @@ class ConfiguredWorkflowEngine(WorkflowEngine):
         '''
         * config *configuration.Configuration*
         '''
+        speculation = None
+        speculation_config = config.get_speculative_execution_config()
+        if speculation_config is not None:
+            speculation = SpeculativeExecution(scheduler,
+                                               **speculation_config)
         super(ConfiguredWorkflowEngine, self).__init__(
             database_server,
             scheduler,
             path_translation=config.get_path_translation(),
             queue_limits=config.get_queue_limits(),
-            running_jobs_limits=config.get_running_jobs_limits())
+            running_jobs_limits=config.get_running_jobs_limits(),
+            speculation=speculation)
 
         self.config = config
 
@@ -26,8 +26,9 @@ import six
 
 from soma_workflow.errors import JobError, WorkflowError
 import soma_workflow.constants as constants
-from soma_workflow.client import Job, BarrierJob, SpecialPath, FileTransfer, \
-    Workflow, SharedResourcePath, TemporaryPath, OptionPath, Group
+from soma_workflow.client import Job, BarrierJob, PythonJob, SpecialPath, \
+    FileTransfer, Workflow, SharedResourcePath, TemporaryPath, OptionPath, \
+    Group
 
 # python 2/3 compatibility
 import sys
@@ -110,6 +111,17 @@ class EngineJob(Job):
 
     path_translation = None
 
+    # True for the jobs running a Python callable (see PythonJob)
+    is_python_job = False
+
+    # Python callable jobs attributes (see PythonJob)
+    python_callable = None
+    args = None
+    kwargs = None
+
+    # number of the current run of the job (see RetryPolicy), int
+    attempt = 1
+
     logger = None
 
     def __init__(self,
@@ -144,6 +156,10 @@ class EngineJob(Job):
 
         self.workflow_id = workflow_id
         self.queue = queue
+        self.user_storage = client_job.user_storage
+        self.idempotent = client_job.idempotent
+        self.retry_policy = client_job.retry_policy
+        self.attempt = 1
 
         self.path_translation = path_translation
 
@@ -156,6 +172,11 @@ class EngineJob(Job):
             self.is_barrier = True
         else:
             self.is_barrier = False
+        if isinstance(client_job, PythonJob):
+            self.is_python_job = True
+            self.python_callable = client_job.python_callable
+            self.args = client_job.args
+            self.kwargs = client_job.kwargs
 
         self._map(parallel_job_submission_info)
 
@@ -428,10 +449,15 @@ class EngineWorkflow(Workflow):
         self.name = name
 
         self.user_storage = client_workflow.user_storage
+        self.retry_policy = client_workflow.retry_policy
 
         self.job_mapping = {}
         self.transfer_mapping = {}
         self._map()
+        if self.retry_policy is not None:
+            for job in six.itervalues(self.job_mapping):
+                if job.retry_policy is None and not job.is_barrier:
+                    job.retry_policy = self.retry_policy
 
         self.registered_tr = {}
         self.registered_jobs = {}
@@ -924,6 +950,7 @@ class EngineWorkflow(Workflow):
                 job.exit_value = None
                 job.terminating_signal = None
                 job.drmaa_id = None
+                job.attempt = 1
                 job.queue = self.queue
                 jobs_queue_changed.append(job.job_id)
                 stdout = open(job.stdout_file, "w")
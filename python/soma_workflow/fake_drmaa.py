@@ -0,0 +1,307 @@
+from __future__ import with_statement, print_function
+
+'''
+@author: Soizic Laguitton
+
+@organization: I2BM, Neurospin, Gif-sur-Yvette, France
+@organization: CATI, France
+@organization: U{IFR 49<http://www.ifr49.org>}
+
+@license: U{CeCILL version 2<http://www.cecill.info/licences/Licence_CeCILL_V2-en.html>}
+'''
+
+'''
+In-process stand-in for a DRMAA session (somadrmaa.Session), used to load
+test the DRMAA code path of soma-workflow (scheduler.DrmaaCTypes) without
+any DRMS.
+
+No job is run: a job is queued for queue_time seconds, then runs for
+job_duration seconds, and then ends with the exit status 0. The calls to the
+session can be slowed down and made to fail, to measure and test the
+submission, polling and exit information handling.
+
+The exceptions are the ones of somadrmaa when a DRMAA library is available,
+otherwise classes with the same names.
+'''
+
+import time
+import random
+import itertools
+import threading
+import collections
+
+import soma_workflow.constants as constants
+from soma_workflow.utils import DetectFindLib
+
+try:
+    (_DRMAA_LIB_FOUND, _lib) = DetectFindLib('DRMAA_LIBRARY_PATH', 'drmaa')
+except:
+    _DRMAA_LIB_FOUND = False
+
+if _DRMAA_LIB_FOUND:
+    from somadrmaa.errors import DrmaaException, \
+        DrmCommunicationException, DrmsInitException, ExitTimeoutException, \
+        InvalidJobException, NoActiveSessionException, \
+        AlreadyActiveSessionException
+    from somadrmaa.const import JobControlAction
+else:
+
+    class DrmaaException(Exception):
+        pass
+
+    class AlreadyActiveSessionException(DrmaaException):
+        pass
+
+    class DrmCommunicationException(DrmaaException):
+        pass
+
+    class DrmsInitException(DrmaaException):
+        pass
+
+    class ExitTimeoutException(DrmaaException):
+        pass
+
+    class InvalidJobException(DrmaaException):
+        pass
+
+    class NoActiveSessionException(DrmaaException):
+        pass
+
+    class JobControlAction(object):
+        SUSPEND = 'suspend'
+        RESUME = 'resume'
+        HOLD = 'hold'
+        RELEASE = 'release'
+        TERMINATE = 'terminate'
+
+
+JobInfo = collections.namedtuple("JobInfo",
+                                 """jobId hasExited hasSignal terminatedSignal
+                                    hasCoreDump wasAborted exitStatus
+                                    resourceUsage""")
+
+# session calls which can be slowed down or fail
+CALLS = ('initialize', 'exit', 'createJobTemplate', 'deleteJobTemplate',
+         'runJob', 'jobStatus', 'wait', 'control', 'drmsInfo')
+
+# failure injection items which are not calls:
+# job: probability for a job to end with the exit status 1
+# session: probability for a call to lose the session, all the following
+#          calls raising NoActiveSessionException until the session is
+#          initialized again
+JOB_FAILURE = 'job'
+SESSION_LOSS = 'session'
+
+
+def parse_rates(rates):
+    '''
+    Parse a "name=value" string, as used in the configuration:
+    "runJob=0.01 jobStatus=0.001"
+
+    * rates *string, dictionary or None*
+
+    * returns: *dictionary name -> float*
+    '''
+    if not rates:
+        return {}
+    if isinstance(rates, dict):
+        return dict((name, float(value)) for name, value in rates.items())
+    result = {}
+    for item in rates.split():
+        name, value = item.split('=', 1)
+        result[name] = float(value)
+    return result
+
+
+class JobTemplate(object):
+
+    '''
+    Job template: the attributes are only stored.
+    '''
+
+    def __init__(self):
+        self.remoteCommand = None
+        self.args = []
+        self.jobEnvironment = {}
+
+
+class FakeSession(object):
+
+    '''
+    somadrmaa.Session stand-in.
+
+    * latencies *dictionary call name -> float*
+        Duration (in seconds) of each call, see CALLS.
+
+    * failures *dictionary call name -> float*
+        Probability of each call to raise DrmCommunicationException
+        (DrmsInitException for initialize). See also JOB_FAILURE and
+        SESSION_LOSS.
+
+    * queue_time, job_duration *float*
+        Time (in seconds) spent by the jobs in the queue, and running.
+
+    * jobs *dictionary job id -> dictionary*
+        Jobs of the fake DRMS. The sessions created by a FakeSessionFactory
+        share their jobs, as they would on a DRMS: a new session still knows
+        the jobs of a previous one.
+    '''
+
+    TIMEOUT_WAIT_FOREVER = -1
+    TIMEOUT_NO_WAIT = 0
+
+    _jobs_lock = threading.Lock()
+
+    _job_counter = itertools.count(1)
+
+    def __init__(self, latencies=None, failures=None, queue_time=0.,
+                 job_duration=0., seed=None, jobs=None):
+        self.latencies = parse_rates(latencies)
+        self.failures = parse_rates(failures)
+        self.queue_time = queue_time
+        self.job_duration = job_duration
+        self._random = random.Random(seed)
+        if jobs is None:
+            jobs = {}
+        self._jobs = jobs
+        self._active = False
+        self.calls = collections.Counter()
+
+    def _call(self, name):
+        '''
+        Simulate the latency and the failures of a call.
+        '''
+        self.calls[name] += 1
+        latency = self.latencies.get(name)
+        if latency:
+            time.sleep(latency)
+        if name != 'initialize':
+            if not self._active:
+                raise NoActiveSessionException("no active session")
+            if self._random.random() < self.failures.get(SESSION_LOSS, 0.):
+                self._active = False
+                raise NoActiveSessionException("session lost")
+        if self._random.random() < self.failures.get(name, 0.):
+            if name == 'initialize':
+                raise DrmsInitException("injected failure: %s" % name)
+            raise DrmCommunicationException("injected failure: %s" % name)
+
+    def initialize(self, contactString=None):
+        self._call('initialize')
+        if self._active:
+            raise AlreadyActiveSessionException("session already active")
+        self._active = True
+
+    def exit(self):
+        self._call('exit')
+        self._active = False
+
+    @property
+    def drmsInfo(self):
+        self._call('drmsInfo')
+        return 'soma-workflow fake DRMS'
+
+    def createJobTemplate(self):
+        self._call('createJobTemplate')
+        return JobTemplate()
+
+    def deleteJobTemplate(self, jobTemplate):
+        self._call('deleteJobTemplate')
+
+    def runJob(self, jobTemplate):
+        self._call('runJob')
+        now = time.time()
+        exit_status = 0
+        if self._random.random() < self.failures.get(JOB_FAILURE, 0.):
+            exit_status = 1
+        with self._jobs_lock:
+            job_id = 'fake.%d' % next(self._job_counter)
+            self._jobs[job_id] = {
+                'submission_time': now,
+                'start_time': now + self.queue_time,
+                'end_time': now + self.queue_time + self.job_duration,
+                'exit_status': exit_status,
+                'terminated': False}
+        return job_id
+
+    def _job(self, jobId):
+        job = self._jobs.get(jobId)
+        if job is None:
+            raise InvalidJobException("unknown job: %s" % jobId)
+        return job
+
+    def jobStatus(self, jobName):
+        self._call('jobStatus')
+        with self._jobs_lock:
+            job = self._job(jobName)
+            if job['terminated']:
+                return constants.FAILED
+            now = time.time()
+            if now < job['start_time']:
+                return constants.QUEUED_ACTIVE
+            if now < job['end_time']:
+                return constants.RUNNING
+            return constants.DONE
+
+    def control(self, jobId, operation):
+        self._call('control')
+        with self._jobs_lock:
+            job = self._job(jobId)
+            if operation == JobControlAction.TERMINATE \
+                    and time.time() < job['end_time']:
+                job['terminated'] = True
+                job['end_time'] = time.time()
+
+    def wait(self, jobId, timeout=-1):
+        self._call('wait')
+        with self._jobs_lock:
+            job = self._job(jobId)
+            end_time = job['end_time']
+        if not job['terminated'] and time.time() < end_time:
+            if timeout == self.TIMEOUT_NO_WAIT or \
+                    (timeout > 0 and time.time() + timeout < end_time):
+                raise ExitTimeoutException("job %s is not over" % jobId)
+            time.sleep(max(0., end_time - time.time()))
+        with self._jobs_lock:
+            # the job data is reaped
+            job = self._jobs.pop(jobId)
+        start_time = min(job['start_time'], job['end_time'])
+        resource_usage = {
+            'submission_time': '%.3f' % job['submission_time'],
+            'start_time': '%.3f' % start_time,
+            'end_time': '%.3f' % job['end_time'],
+            'wallclock': '%.3f' % (job['end_time'] - start_time)}
+        if job['terminated']:
+            return JobInfo(jobId, False, True, 'SIGTERM', False, False, 0,
+                           resource_usage)
+        return JobInfo(jobId, True, False, '', False, False,
+                       job['exit_status'], resource_usage)
+
+
+class FakeSessionFactory(object):
+
+    '''
+    Creates the sessions of a DrmaaCTypes scheduler (session_factory
+    argument), all with the same parameters (see FakeSession).
+    '''
+
+    def __init__(self, latencies=None, failures=None, queue_time=0.,
+                 job_duration=0., seed=None):
+        self.latencies = latencies
+        self.failures = failures
+        self.queue_time = queue_time
+        self.job_duration = job_duration
+        self.seed = seed
+        self.jobs = {}
+        self.sessions = []
+
+    def __call__(self):
+        seed = self.seed
+        if seed is not None:
+            # a recycled session does not replay the same failures
+            seed += len(self.sessions)
+        session = FakeSession(self.latencies, self.failures,
+                              self.queue_time, self.job_duration, seed,
+                              self.jobs)
+        self.sessions.append(session)
+        return session
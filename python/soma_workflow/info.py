@@ -63,4 +63,4 @@ EXTRA_REQUIRES = {
 # Globals and constants
 #-----------------------------------------------------------------------------
 
-DB_VERSION = '1.1'
+DB_VERSION = '1.3'
@@ -0,0 +1,414 @@
+from __future__ import with_statement, print_function
+
+'''
+@author: Soizic Laguitton
+
+@organization: I2BM, Neurospin, Gif-sur-Yvette, France
+@organization: CATI, France
+@organization: U{IFR 49<http://www.ifr49.org>}
+
+@license: U{CeCILL version 2<http://www.cecill.info/licences/Licence_CeCILL_V2-en.html>}
+'''
+
+'''
+Execution of Python callable jobs (see soma_workflow.client.PythonJob).
+
+The module can be run as a command:
+
+  * python -m soma_workflow.python_worker <callable> <json args> <json kwargs>
+    runs the callable once: this is the command of a PythonJob, used by the
+    schedulers which start a new process for each job (DRMAA, MPI...).
+
+  * python -m soma_workflow.python_worker --worker
+    starts a persistent worker which runs the callables sent by a
+    PythonWorkerPool, one at a time. The imported modules stay loaded between
+    jobs. The requests and replies are JSON lines exchanged on the standard
+    input and output of the worker.
+'''
+
+import os
+import sys
+import json
+import traceback
+import subprocess
+import importlib
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+try:
+    import select
+except ImportError:
+    select = None
+
+
+# resource usage fields reported for the jobs, in the struct_rusage naming.
+RUSAGE_FIELDS = ('ru_utime', 'ru_stime', 'ru_maxrss', 'ru_minflt',
+                 'ru_majflt', 'ru_inblock', 'ru_oublock', 'ru_nvcsw',
+                 'ru_nivcsw')
+
+WORKER_OPTION = '--worker'
+
+
+def resolve_callable(python_callable):
+    '''
+    Import the module and get the callable.
+
+    * python_callable *string*
+        "package.module:function", "package.module:Class.method" or
+        "package.module.function"
+
+    * returns: *callable*
+    '''
+    if ':' in python_callable:
+        module_name, attributes = python_callable.split(':', 1)
+    else:
+        module_name, attributes = python_callable.rsplit('.', 1)
+    obj = importlib.import_module(module_name)
+    for attribute in attributes.split('.'):
+        obj = getattr(obj, attribute)
+    if not callable(obj):
+        raise TypeError('%s is not callable' % python_callable)
+    return obj
+
+
+def run_python_callable(python_callable, args=None, kwargs=None,
+                        stdin=None, stdout=None, stderr=None,
+                        working_directory=None):
+    '''
+    Run a callable in the current process with the job standard streams and
+    working directory, which are restored afterwards.
+
+    The exit value follows the one of a Python script: 0 if the callable
+    returns, the SystemExit code if it raises SystemExit, and 1 if it raises
+    any other exception (the traceback is written to the standard error).
+
+    * python_callable *string*
+        see resolve_callable
+
+    * args *list*
+
+    * kwargs *dictionary*
+
+    * stdin, stdout, stderr *string*
+        Files paths, or None to keep the current streams.
+
+    * working_directory *string*
+
+    * returns: *int*
+    '''
+    if args is None:
+        args = []
+    if kwargs is None:
+        kwargs = {}
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    saved_fds = []
+    saved_cwd = os.getcwd()
+    try:
+        for fd, path, mode in ((0, stdin, os.O_RDONLY),
+                               (1, stdout, os.O_WRONLY | os.O_CREAT
+                                | os.O_TRUNC),
+                               (2, stderr, os.O_WRONLY | os.O_CREAT
+                                | os.O_TRUNC)):
+            if path:
+                file_fd = os.open(path, mode, 0o666)
+                saved_fds.append((fd, os.dup(fd)))
+                os.dup2(file_fd, fd)
+                os.close(file_fd)
+        if working_directory:
+            os.chdir(working_directory)
+
+        try:
+            function = resolve_callable(python_callable)
+            function(*args, **kwargs)
+            exit_value = 0
+        except SystemExit as e:
+            if e.code is None:
+                exit_value = 0
+            elif isinstance(e.code, int):
+                exit_value = e.code
+            else:
+                print(e.code, file=sys.stderr)
+                exit_value = 1
+        except BaseException:
+            traceback.print_exc()
+            exit_value = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        except Exception:
+            pass
+        for fd, saved_fd in reversed(saved_fds):
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+        os.chdir(saved_cwd)
+
+    return exit_value
+
+
+def _rusage():
+    '''
+    Resource usage of the current process and its waited children.
+
+    * returns: *dictionary*
+    '''
+    if resource is None:
+        return None
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    usage = {}
+    for name in RUSAGE_FIELDS:
+        if name == 'ru_maxrss':
+            usage[name] = max(own.ru_maxrss, children.ru_maxrss)
+        else:
+            usage[name] = getattr(own, name) + getattr(children, name)
+    return usage
+
+
+def worker_loop(input_stream, output_stream):
+    '''
+    Run the jobs requests read on input_stream until the end of the stream
+    and write a reply for each of them on output_stream.
+
+    Request: {"python_callable": ..., "args": ..., "kwargs": ...,
+              "stdin": ..., "stdout": ..., "stderr": ...,
+              "working_directory": ...}
+
+    Reply: {"exit_value": int, "rusage": dictionary}
+        The times and counters of rusage are the ones of the job, ru_maxrss
+        is the peak resident size of the worker.
+    '''
+    while True:
+        line = input_stream.readline()
+        if not line:
+            break
+        request = json.loads(line)
+        before = _rusage()
+        exit_value = run_python_callable(request["python_callable"],
+                                         request.get("args"),
+                                         request.get("kwargs"),
+                                         request.get("stdin"),
+                                         request.get("stdout"),
+                                         request.get("stderr"),
+                                         request.get("working_directory"))
+        after = _rusage()
+        rusage = None
+        if before is not None:
+            rusage = {}
+            for name in RUSAGE_FIELDS:
+                if name == 'ru_maxrss':
+                    rusage[name] = after[name]
+                else:
+                    rusage[name] = after[name] - before[name]
+        output_stream.write(json.dumps({"exit_value": exit_value,
+                                        "rusage": rusage}) + '\n')
+        output_stream.flush()
+
+
+def _worker_main():
+    # The requests and replies use private copies of the standard input and
+    # output, so that the jobs can neither read the requests nor corrupt the
+    # replies when they use the standard streams.
+    input_stream = os.fdopen(os.dup(0), 'r')
+    output_stream = os.fdopen(os.dup(1), 'w')
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+    worker_loop(input_stream, output_stream)
+
+
+class PythonWorker(object):
+
+    '''
+    Persistent worker process running Python callable jobs, one at a time.
+
+    * process *subprocess.Popen*
+
+    * job_id *int*
+        Scheduler id of the job being run, or None.
+    '''
+
+    process = None
+
+    job_id = None
+
+    def __init__(self):
+        env = dict(os.environ)
+        # make sure soma_workflow can be imported in the worker
+        package_dir = os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__)))
+        pythonpath = env.get('PYTHONPATH')
+        if pythonpath:
+            env['PYTHONPATH'] = package_dir + os.pathsep + pythonpath
+        else:
+            env['PYTHONPATH'] = package_dir
+        if sys.platform != 'win32':
+            # own session, to kill the job children processes with the
+            # worker (see LocalScheduler.kill_job)
+            kwargs = {'preexec_fn': os.setsid}
+        else:
+            kwargs = {}
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'soma_workflow.python_worker',
+             WORKER_OPTION],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=env,
+            **kwargs)
+        self.job_id = None
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def run(self, engine_job):
+        '''
+        Send the job to the worker.
+
+        * engine_job *EngineJob*
+            A Python job (engine_job.is_python_job is True).
+        '''
+        request = {"python_callable": engine_job.python_callable,
+                   "args": engine_job.args,
+                   "kwargs": engine_job.kwargs,
+                   "stdin": engine_job.plain_stdin(),
+                   "stdout": engine_job.plain_stdout(),
+                   "stderr": engine_job.plain_stderr(),
+                   "working_directory":
+                       engine_job.plain_working_directory()}
+        line = json.dumps(request) + '\n'
+        self.process.stdin.write(line.encode('utf-8'))
+        self.process.stdin.flush()
+        self.job_id = engine_job.job_id
+
+    def poll_job(self):
+        '''
+        Non blocking test of the termination of the running job.
+
+        If the worker died during the job, its return value is reported as the
+        job one (negative for a signal, as subprocess.Popen.returncode).
+
+        * returns: *tuple*
+            (exit value, or None if the job is still running,
+             resource usage dictionary or None)
+        '''
+        ready = select.select([self.process.stdout], [], [], 0)[0]
+        if not ready:
+            ret_value = self.process.poll()
+            return (ret_value, None)
+        line = self.process.stdout.readline()
+        if not line:
+            # end of stream: the worker died
+            self.process.wait()
+            return (self.process.returncode, None)
+        reply = json.loads(line.decode('utf-8'))
+        self.job_id = None
+        return (reply["exit_value"], reply["rusage"])
+
+    def close(self):
+        '''
+        Stop the worker once its current job is over.
+        '''
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+
+
+class PythonWorkerPool(object):
+
+    '''
+    Pool of persistent Python workers. The workers are started on demand and
+    kept for the next jobs, so the interpreter startup and the imports are
+    paid once per worker and not once per job.
+
+    * _idle_workers *list of PythonWorker*
+
+    * max_idle_workers *int*
+        Maximum number of idle workers kept alive.
+    '''
+
+    _idle_workers = None
+
+    max_idle_workers = None
+
+    def __init__(self, max_idle_workers=None):
+        self._idle_workers = []
+        self.max_idle_workers = max_idle_workers
+
+    @staticmethod
+    def is_supported():
+        '''
+        The workers need non blocking tests on pipes, which are not
+        available on Windows.
+        '''
+        return select is not None and sys.platform != 'win32'
+
+    def run(self, engine_job):
+        '''
+        Run the job on an idle worker, or on a new one.
+
+        * engine_job *EngineJob*
+
+        * returns: *PythonWorker*
+        '''
+        worker = None
+        while self._idle_workers and worker is None:
+            worker = self._idle_workers.pop()
+            if not worker.is_alive():
+                worker = None
+        if worker is None:
+            worker = PythonWorker()
+        worker.run(engine_job)
+        return worker
+
+    def release(self, worker):
+        '''
+        Give back a worker whose job is over.
+        '''
+        if worker.is_alive():
+            if self.max_idle_workers is None \
+                    or len(self._idle_workers) < self.max_idle_workers:
+                self._idle_workers.append(worker)
+            else:
+                worker.close()
+
+    def close(self):
+        '''
+        Stop the idle workers.
+        '''
+        for worker in self._idle_workers:
+            worker.close()
+        self._idle_workers = []
+
+
+def main(argv):
+    if len(argv) >= 1 and argv[0] == WORKER_OPTION:
+        _worker_main()
+        return 0
+    if len(argv) < 1 or len(argv) > 3:
+        print("usage: python -m soma_workflow.python_worker "
+              "<module:callable> [<json args> [<json kwargs>]]",
+              file=sys.stderr)
+        return 2
+    args = None
+    kwargs = None
+    if len(argv) >= 2:
+        args = json.loads(argv[1])
+    if len(argv) >= 3:
+        kwargs = json.loads(argv[2])
+    return run_python_callable(argv[0], args, kwargs)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -22,6 +22,11 @@ import ctypes
 import atexit
 import os.path
 import socket
+import heapq
+import itertools
+import math
+import collections
+import json
 import six
 
 try:
@@ -34,8 +39,11 @@ except ImportError:
 import soma_workflow.constants as constants
 from soma_workflow.errors import DRMError
 from soma_workflow.configuration import LocalSchedulerCfg, Configuration
+import soma_workflow.configuration as configuration
 from soma_workflow.utils import DetectFindLib
 from soma_workflow.configuration import default_cpu_number, cpu_count
+from soma_workflow.python_worker import PythonWorker, PythonWorkerPool, \
+    RUSAGE_FIELDS
 
 _drmaa_lib_env_name = 'DRMAA_LIBRARY_PATH'
 
@@ -49,6 +57,61 @@ except:
 if DRMAA_LIB_FOUND == True:
     from somadrmaa.errors import *
     from somadrmaa.const import JobControlAction
+else:
+    # DrmaaCTypes can still use a fake session (see soma_workflow.fake_drmaa)
+    from soma_workflow.fake_drmaa import DrmaaException, \
+        DrmCommunicationException, ExitTimeoutException, \
+        NoActiveSessionException, JobControlAction
+
+
+def resource_usage_string(resource_usage):
+    '''
+    Build the resource usage string stored in the database, using the
+    "name=value" format of the DRMAA resource usage: "name1=value1 name2=value2 "
+
+    * resource_usage *dictionary or sequence of tuple (name, value)*
+
+    * returns: *string*
+    '''
+    if isinstance(resource_usage, dict):
+        resource_usage = six.iteritems(resource_usage)
+    res = ''
+    for name, value in resource_usage:
+        res = res + name + '=' + str(value) + ' '
+    return res
+
+
+def parse_resource_usage(resource_usage):
+    '''
+    Inverse of resource_usage_string.
+
+    * resource_usage *string or None*
+
+    * returns: *dictionary name -> value (string)*
+    '''
+    usage = {}
+    if resource_usage:
+        for item in resource_usage.split():
+            if '=' in item:
+                name, value = item.split('=', 1)
+                usage[name] = value
+    return usage
+
+
+def expected_duration(job):
+    '''
+    Expected duration of a job, given by the "duration" item of its
+    user_storage, if it is a dictionary.
+
+    * job *EngineJob*
+
+    * returns: *float or None*
+        in seconds
+    '''
+    storage = getattr(job, 'user_storage', None)
+    if isinstance(storage, dict) and storage.get('duration') is not None:
+        return float(storage['duration'])
+    return None
 
 
 class Scheduler(object):
@@ -108,411 +171,955 @@ class Scheduler(object):
         '''
         raise Exception("Scheduler is an abstract class!")
 
-if DRMAA_LIB_FOUND == True:
-
-    class DrmaaCTypes(Scheduler):
-
+    def release_job(self, scheduler_job_id):
         '''
-        Scheduling using a Drmaa session.
-        Contains possible patch depending on the DRMAA impementation.
+        Forget a job the engine will not ask about any more (a killed job,
+        which exit information is not requested).
+        The schedulers also forget the jobs once their exit information has
+        been returned by get_job_exit_info.
+
+        * scheduler_job_id *string*
+            Job id for the scheduling system (DRMAA for example)
         '''
+        pass
 
-        # DRMAA session. DrmaaJobs
-        _drmaa = None
-        # string
-        _drmaa_implementation = None
-        # DRMAA doesn't provide an unified way of submitting
-        # parallel jobs. The value of parallel_job_submission is cluster dependant.
-        # The keys are:
-        #      -Drmaa job template attributes
-        #      -parallel configuration name as defined in soma_workflow.constants
-        # dict
-        parallel_job_submission_info = None
 
-        logger = None
+class DrmaaCTypes(Scheduler):
 
-        _configured_native_spec = None
+    '''
+    Scheduling using a Drmaa session.
+    Contains possible patch depending on the DRMAA impementation.
+    '''
 
-        tmp_file_path = None
+    # DRMAA session. DrmaaJobs
+    _drmaa = None
+    # string
+    _drmaa_implementation = None
+    # DRMAA doesn't provide an unified way of submitting
+    # parallel jobs. The value of parallel_job_submission is cluster dependant.
+    # The keys are:
+    #      -Drmaa job template attributes
+    #      -parallel configuration name as defined in soma_workflow.constants
+    # dict
+    parallel_job_submission_info = None
 
-        is_sleeping = False
-        FAKE_JOB = -167
+    logger = None
 
-        def __init__(self,
-                     drmaa_implementation,
-                     parallel_job_submission_info,
-                     tmp_file_path=None,
-                     configured_native_spec=None):
+    _configured_native_spec = None
 
-            import somadrmaa
+    tmp_file_path = None
 
-            self.logger = logging.getLogger('ljp.drmaajs')
+    is_sleeping = False
+    FAKE_JOB = -167
 
-            self.wake()
+    # maximum number of job templates kept for reuse
+    TEMPLATE_CACHE_SIZE = 32
 
-            self.hostname = socket.gethostname()
+    # job templates for reuse: template signature -> job template
+    # (collections.OrderedDict, least recently used first)
+    _job_templates = None
 
-            self._drmaa_implementation = drmaa_implementation
+    # environment of the jobs (PBS implementation), computed once per
+    # session
+    _job_environment = None
 
-            self.parallel_job_submission_info = parallel_job_submission_info
+    # if True the session stays open while the engine idles
+    keep_session = False
 
-            self._configured_native_spec = configured_native_spec
+    # interval (in seconds) between two checks of an idle session
+    session_check_interval = 300.
 
-            self.logger.debug("Parallel job submission info: %s",
-                              repr(parallel_job_submission_info))
+    # last time the session was known to work
+    _session_checked_time = None
 
-            if tmp_file_path == None:
-                self.tmp_file_path = os.path.abspath("tmp")
-            else:
-                self.tmp_file_path = os.path.abspath(tmp_file_path)
+    # callable creating the sessions, somadrmaa.Session if None
+    _session_factory = None
 
-        def clean(self):
-            if self._drmaa_implementation == "PBS":
-                tmp_out = os.path.join(
-                    self.tmp_file_path, "soma-workflow-empty-job-patch-torque.o")
-                tmp_err = os.path.join(
-                    self.tmp_file_path, "soma-workflow-empty-job-patch-torque.e")
+    @classmethod
+    def from_config(cls, config, tmp_file_path=None):
+        '''
+        Create the scheduler configured for a computing resource.
 
-                # print("tmp_out="+tmp_out)
-                # print("tmp_err="+tmp_err)
+        * config *Configuration*
 
-                if os.path.isfile(tmp_out):
-                    os.remove(tmp_out)
-                if os.path.isfile(tmp_err):
-                    os.remove(tmp_err)
+        * tmp_file_path *string*
+        '''
+        session_factory = None
+        if config.get_drmaa_implementation() \
+                == configuration.FAKE_DRMAA_IMPLEMENTATION:
+            from soma_workflow.fake_drmaa import FakeSessionFactory
+            session_factory = FakeSessionFactory(
+                **config.get_fake_drmaa_config())
+        return cls(config.get_drmaa_implementation(),
+                   config.get_parallel_job_config(),
+                   tmp_file_path,
+                   configured_native_spec=config.get_native_specification(),
+                   keep_session=config.get_drmaa_session_idle()
+                   == configuration.DRMAA_SESSION_KEEP,
+                   session_check_interval
+                   =config.get_drmaa_session_check_interval(),
+                   session_factory=session_factory)
+
+    def __init__(self,
+                 drmaa_implementation,
+                 parallel_job_submission_info,
+                 tmp_file_path=None,
+                 configured_native_spec=None,
+                 keep_session=False,
+                 session_check_interval=300.,
+                 session_factory=None):
+        '''
+        * session_factory *callable*
+            Creates the DRMAA sessions. Default: somadrmaa.Session. A
+            fake_drmaa.FakeSessionFactory allows to use the scheduler without
+            DRMS.
+        '''
+        self.logger = logging.getLogger('ljp.drmaajs')
 
-        def close_drmaa_session(self):
-            if self._drmaa:
-                self._drmaa.exit()
-                self._drmaa = None
+        self.keep_session = keep_session
+        self.session_check_interval = session_check_interval
+        self._session_factory = session_factory
 
-        def __del__(self):
-            self.clean()
-            self.close_drmaa_session()
+        self.wake()
 
-        def sleep(self):
-            '''
-            Some Drmaa sessions expire if they idle too long.
-            '''
-            self.close_drmaa_session()
-            self.is_sleeping = True
+        self.hostname = socket.gethostname()
 
-        def wake(self):
-            '''
-            Creates a fresh Drmaa session.
-            '''
-            import somadrmaa
+        self._drmaa_implementation = drmaa_implementation
 
-            self.is_sleeping = False
+        self.parallel_job_submission_info = parallel_job_submission_info
 
-            if not self._drmaa:
-                self._drmaa = somadrmaa.Session()
-                self._drmaa.initialize()
-
-        def submit_simple_test_job(self, outstr, out_o_file, out_e_file):
-            import somadrmaa
-            # patch for the PBS-torque DRMAA implementation
-            if self._drmaa_implementation == "PBS":
-
-                '''
-                Create a job to test
-                '''
-                jobTemplateId = self._drmaa.createJobTemplate()
-                jobTemplateId.remoteCommand = 'echo'
-                jobTemplateId.args = ["%s" % (outstr)]
-                jobTemplateId.outputPath = "%s:%s" % (
-                    self.hostname, os.path.join(self.tmp_file_path, "%s" % (out_o_file)))
-                jobTemplateId.errorPath = "%s:%s" % (
-                    self.hostname, os.path.join(self.tmp_file_path, "%s" % (out_e_file)))
-
-                # print("jobTemplateId="+repr(jobTemplateId))
-                # print("jobTemplateId.remoteCommand="+repr(jobTemplateId.remoteCommand))
-                # print("jobTemplateId.args="+repr(jobTemplateId.args))
-                # print("jobTemplateId.outputPath="+repr(jobTemplateId.outputPath))
-                # print(
-                # "jobTemplateId.errorPath="+repr(jobTemplateId.errorPath))
-
-                jobid = self._drmaa.runJob(jobTemplateId)
-                # print("jobid="+jobid)
-                retval = self._drmaa.wait(
-                    jobid, drmaa.Session.TIMEOUT_WAIT_FOREVER)
-                # print("retval="+repr(retval))
-                self._drmaa.deleteJobTemplate(jobTemplateId)
-
-        def _setDrmaaParallelJob(self,
-                                 drmaa_job_template_id,
-                                 configuration_name,
-                                 max_num_node):
-            '''
-            Set the DRMAA job template information for a parallel job submission.
-            The configuration file must provide the parallel job submission
-            information specific to the cluster in use.
-
-            @type  drmaa_job_template_id: string
-            @param drmaa_job_template_id: id of drmaa job template
-            @type  parallel_job_info: tuple (string, int)
-            @param parallel_job_info: (configuration_name, max_node_num)
-            configuration_name: type of parallel job as defined in soma_workflow.constants
-            (eg MPI, OpenMP...)
-            max_node_num: maximum node number the job requests (on a unique machine or
-            separated machine depending on the parallel configuration)
-            '''
-            if self.is_sleeping:
-                self.wake()
+        self._configured_native_spec = configured_native_spec
 
-            self.logger.debug(">> _setDrmaaParallelJob")
-            cluster_specific_cfg_name = self.parallel_job_submission_info[
-                configuration_name]
+        self.logger.debug("Parallel job submission info: %s",
+                          repr(parallel_job_submission_info))
 
-            for drmaa_attribute in constants.PARALLEL_DRMAA_ATTRIBUTES:
-                value = self.parallel_job_submission_info.get(drmaa_attribute)
-                if value:
-                    value = value.replace(
-                        "{config_name}", cluster_specific_cfg_name)
-                    value = value.replace("{max_node}", repr(max_num_node))
+        if tmp_file_path == None:
+            self.tmp_file_path = os.path.abspath("tmp")
+        else:
+            self.tmp_file_path = os.path.abspath(tmp_file_path)
 
-                    setattr(drmaa_job_template_id, drmaa_attribute, value)
+    def clean(self):
+        if self._drmaa_implementation == "PBS":
+            tmp_out = os.path.join(
+                self.tmp_file_path, "soma-workflow-empty-job-patch-torque.o")
+            tmp_err = os.path.join(
+                self.tmp_file_path, "soma-workflow-empty-job-patch-torque.e")
+
+            # print("tmp_out="+tmp_out)
+            # print("tmp_err="+tmp_err)
+
+            if os.path.isfile(tmp_out):
+                os.remove(tmp_out)
+            if os.path.isfile(tmp_err):
+                os.remove(tmp_err)
+
+    def close_drmaa_session(self):
+        if self._drmaa:
+            self._clear_job_templates()
+            self._drmaa.exit()
+            self._drmaa = None
+        self._job_environment = None
+        self._session_checked_time = None
+
+    def recycle_drmaa_session(self):
+        '''
+        Replaces a broken session by a new one. The job templates of the
+        broken session are dropped.
+        '''
+        self.logger.warning("recycling the DRMAA session")
+        if self._drmaa:
+            self._job_templates = collections.OrderedDict()
+            try:
+                self._drmaa.exit()
+            except DrmaaException as e:
+                self.logger.debug("exit: %s" % e)
+            self._drmaa = None
+        self._job_environment = None
+        self._session_checked_time = None
+        self.wake()
 
-                    self.logger.debug(
-                        "Parallel job, drmaa attribute = %s, value = %s ",
-                        drmaa_attribute, value)
+    def check_drmaa_session(self):
+        '''
+        Queries the DRMS through the session, and recycles the session if
+        it does not work anymore.
+        '''
+        try:
+            self._drmaa.drmsInfo
+        except DrmaaException as e:
+            self.logger.warning("DRMAA session check failed: %s" % e)
+            self.recycle_drmaa_session()
+        else:
+            self._session_checked_time = time.time()
+
+    def _drmaa_method(self, name):
+        '''
+        Method of the current session, looked up at call time so that a
+        call done again after a recycling uses the new session.
+        '''
+        return lambda *args: getattr(self._drmaa, name)(*args)
+
+    def _session_call(self, function, *args, **kwargs):
+        '''
+        Calls function(*args, **kwargs), which uses the session. If the
+        session is not active anymore or the DRMS can not be reached
+        through it, the session is recycled and the call is done again
+        once.
+
+        * retry_on *tuple of exception types*
+            Errors after which the session is recycled (keyword argument,
+            default: (NoActiveSessionException, DrmCommunicationException))
+        '''
+        retry_on = kwargs.pop('retry_on', (NoActiveSessionException,
+                                           DrmCommunicationException))
+        if self.is_sleeping:
+            self.wake()
+        try:
+            result = function(*args, **kwargs)
+        except retry_on as e:
+            self.logger.warning("DRMAA session error: %s" % e)
+            self.recycle_drmaa_session()
+            result = function(*args, **kwargs)
+        self._session_checked_time = time.time()
+        return result
+
+    def _clear_job_templates(self):
+        if self._job_templates:
+            for job_template in six.itervalues(self._job_templates):
+                try:
+                    self._drmaa.deleteJobTemplate(job_template)
+                except DrmaaException as e:
+                    self.logger.debug("deleteJobTemplate: %s" % e)
+        self._job_templates = collections.OrderedDict()
 
-            job_env = []
-            for parallel_env_v in constants.PARALLEL_JOB_ENV:
-                value = self.parallel_job_submission_info.get(parallel_env_v)
-                if value:
-                    job_env.append((parallel_env_v, value.rstrip()))
+    def __del__(self):
+        self.clean()
+        self.close_drmaa_session()
 
-            drmaa_job_template_id.jobEnvironment = dict(job_env)
+    def sleep(self):
+        '''
+        Some Drmaa sessions expire if they idle too long: the session is
+        closed, unless keep_session is set. In this case the session is
+        kept open and checked when the scheduler wakes up, so that the
+        first job after a quiet period does not pay the session start-up.
+        '''
+        if not self.keep_session:
+            self.close_drmaa_session()
+        self.is_sleeping = True
 
-            self.logger.debug("Parallel job environment : " + repr(job_env))
-            self.logger.debug("<< _setDrmaaParallelJob")
+    def wake(self):
+        '''
+        Creates a fresh Drmaa session, or checks the session kept open if
+        it idled more than session_check_interval.
+        '''
+        self.is_sleeping = False
 
-            return drmaa_job_template_id
+        if not self._drmaa:
+            if self._session_factory is None:
+                import somadrmaa
+                self._drmaa = somadrmaa.Session()
+            else:
+                self._drmaa = self._session_factory()
+            self._drmaa.initialize()
+            self._session_checked_time = time.time()
+        elif self._session_checked_time is None \
+                or time.time() - self._session_checked_time \
+                > self.session_check_interval:
+            self.check_drmaa_session()
+
+    def submit_simple_test_job(self, outstr, out_o_file, out_e_file):
+        import somadrmaa
+        # patch for the PBS-torque DRMAA implementation
+        if self._drmaa_implementation == "PBS":
 
-        def job_submission(self, job):
             '''
-            @type  job: soma_workflow.client.Job
-            @param job: job to be submitted
-            @rtype: string
-            @return: drmaa job id
+            Create a job to test
             '''
+            jobTemplateId = self._drmaa.createJobTemplate()
+            jobTemplateId.remoteCommand = 'echo'
+            jobTemplateId.args = ["%s" % (outstr)]
+            jobTemplateId.outputPath = "%s:%s" % (
+                self.hostname, os.path.join(self.tmp_file_path, "%s" % (out_o_file)))
+            jobTemplateId.errorPath = "%s:%s" % (
+                self.hostname, os.path.join(self.tmp_file_path, "%s" % (out_e_file)))
+
+            # print("jobTemplateId="+repr(jobTemplateId))
+            # print("jobTemplateId.remoteCommand="+repr(jobTemplateId.remoteCommand))
+            # print("jobTemplateId.args="+repr(jobTemplateId.args))
+            # print("jobTemplateId.outputPath="+repr(jobTemplateId.outputPath))
+            # print(
+            # "jobTemplateId.errorPath="+repr(jobTemplateId.errorPath))
+
+            jobid = self._drmaa.runJob(jobTemplateId)
+            # print("jobid="+jobid)
+            retval = self._drmaa.wait(
+                jobid, drmaa.Session.TIMEOUT_WAIT_FOREVER)
+            # print("retval="+repr(retval))
+            self._drmaa.deleteJobTemplate(jobTemplateId)
+
+    def _setDrmaaParallelJob(self,
+                             drmaa_job_template_id,
+                             configuration_name,
+                             max_num_node):
+        '''
+        Set the DRMAA job template information for a parallel job submission.
+        The configuration file must provide the parallel job submission
+        information specific to the cluster in use.
+
+        @type  drmaa_job_template_id: string
+        @param drmaa_job_template_id: id of drmaa job template
+        @type  parallel_job_info: tuple (string, int)
+        @param parallel_job_info: (configuration_name, max_node_num)
+        configuration_name: type of parallel job as defined in soma_workflow.constants
+        (eg MPI, OpenMP...)
+        max_node_num: maximum node number the job requests (on a unique machine or
+        separated machine depending on the parallel configuration)
+        '''
+        if self.is_sleeping:
+            self.wake()
 
-            if self.is_sleeping:
-                self.wake()
-            # patch for the PBS-torque DRMAA implementation
-            command = []
-            if job.is_barrier:
-                # barrier jobs don't actually go through DRMAA.
-                self.logger.debug('job_submission, DRMAA - barrier job.')
-                job.status = constants.DONE
-                return self.FAKE_JOB
-
-            job_command = job.plain_command()
-
-            # This is only for the old drmaa version
-            # Now it is not necessary anymore
-            # if self._drmaa_implementation == "PBS":
-            if False:
-                if job_command[0] == 'python':
-                    job_command[0] = sys.executable
-                for command_el in job_command:
-                    command_el = command_el.replace('"', '\\\"')
-                    command.append("\"" + command_el + "\"")
-                self.logger.debug("PBS case, new command:" + repr(command))
-            else:
-                command = job_command
+        self.logger.debug(">> _setDrmaaParallelJob")
+        cluster_specific_cfg_name = self.parallel_job_submission_info[
+            configuration_name]
 
-            self.logger.debug("command: " + repr(command))
-            self.logger.debug("job.name=" + repr(job.name))
+        for drmaa_attribute in constants.PARALLEL_DRMAA_ATTRIBUTES:
+            value = self.parallel_job_submission_info.get(drmaa_attribute)
+            if value:
+                value = value.replace(
+                    "{config_name}", cluster_specific_cfg_name)
+                value = value.replace("{max_node}", repr(max_num_node))
 
-            stdout_file = job.plain_stdout()
-            stderr_file = job.plain_stderr()
-            stdin = job.plain_stdin()
+                setattr(drmaa_job_template_id, drmaa_attribute, value)
 
-            try:
-                jobTemplateId = self._drmaa.createJobTemplate()
-                jobTemplateId.remoteCommand = command[0]
-                jobTemplateId.args = command[1:]
+                self.logger.debug(
+                    "Parallel job, drmaa attribute = %s, value = %s ",
+                    drmaa_attribute, value)
 
-                self.logger.info("jobTemplateId=" + repr(jobTemplateId) + " command[0]=" + repr(
-                    command[0]) + " command[1:]=" + repr(command[1:]))
-                self.logger.info(
-                    "hostname and stdout_file= [%s]:%s" % (self.hostname, stdout_file))
+        job_env = []
+        for parallel_env_v in constants.PARALLEL_JOB_ENV:
+            value = self.parallel_job_submission_info.get(parallel_env_v)
+            if value:
+                job_env.append((parallel_env_v, value.rstrip()))
 
-                jobTemplateId.outputPath = "%s:%s" % (
-                    self.hostname, stdout_file)
+        drmaa_job_template_id.jobEnvironment = dict(job_env)
 
-                if job.join_stderrout:
-                    jobTemplateId.joinFiles = "y"
-                else:
-                    if stderr_file:
-                        jobTemplateId.errorPath = "%s:%s" % (
-                            self.hostname, stderr_file)
-
-                if job.stdin:
-                    # self.logger.debug("stdin: " + repr(stdin))
-                    # self._drmaa.setAttribute(drmaaJobId,
-                    #                        "drmaa_input_path",
-                    #                        "%s:%s" %(self.hostname, stdin))
-                    self.logger.debug("stdin: " + repr(stdin))
-                    jobTemplateId.inputPath = stdin
-
-                working_directory = job.plain_working_directory()
-                if working_directory:
-                    jobTemplateId.workingDirectory = working_directory
+        self.logger.debug("Parallel job environment : " + repr(job_env))
+        self.logger.debug("<< _setDrmaaParallelJob")
 
-                self.logger.debug(
-                    "JOB NATIVE_SPEC " + repr(job.native_specification))
-                self.logger.debug(
-                    "CONFIGURED NATIVE SPEC " + repr(self._configured_native_spec))
-                native_spec = None
-
-                if job.native_specification:
-                    native_spec = job.native_specification
-                elif self._configured_native_spec:
-                    native_spec = self._configured_native_spec
-
-                if job.queue and native_spec:
-                    jobTemplateId.nativeSpecification = "-q " + \
-                        str(job.queue) + " " + str(native_spec)
-                    self.logger.debug(
-                        "NATIVE specification " + "-q " + str(job.queue) + " " + str(native_spec))
-                elif job.queue:
-                    jobTemplateId.nativeSpecification = "-q " + str(job.queue)
-                    self.logger.debug(
-                        "NATIVE specification " + "-q " + str(job.queue))
-                elif native_spec:
-                    jobTemplateId.nativeSpecification = str(native_spec)
-                    self.logger.debug(
-                        "NATIVE specification " + str(native_spec))
-
-                if job.parallel_job_info:
-                    parallel_config_name, max_node_number = job.parallel_job_info
-                    jobTemplateId = self._setDrmaaParallelJob(jobTemplateId,
-                                                              parallel_config_name,
-                                                              max_node_number)
-
-                if self._drmaa_implementation == "PBS":
-                    job_env = []
-                    for var_name in os.environ.keys():
-                # job_env.append(var_name+"="+os.environ[var_name])
-                        job_env.append((var_name, os.environ[var_name]))
-                    jobTemplateId.jobEnvironment = dict(job_env)
-
-                self.logger.debug("before submit command: " + repr(command))
-                self.logger.debug("before submit job.name=" + repr(job.name))
-                drmaaSubmittedJobId = self._drmaa.runJob(jobTemplateId)
-                self._drmaa.deleteJobTemplate(jobTemplateId)
+        return drmaa_job_template_id
 
+    def _native_specification(self, job):
+        '''
+        Native specification of the job, including its queue.
+        '''
+        self.logger.debug(
+            "JOB NATIVE_SPEC " + repr(job.native_specification))
+        self.logger.debug(
+            "CONFIGURED NATIVE SPEC " + repr(self._configured_native_spec))
+        native_spec = None
+
+        if job.native_specification:
+            native_spec = job.native_specification
+        elif self._configured_native_spec:
+            native_spec = self._configured_native_spec
+
+        if job.queue and native_spec:
+            return "-q " + str(job.queue) + " " + str(native_spec)
+        elif job.queue:
+            return "-q " + str(job.queue)
+        elif native_spec:
+            return str(native_spec)
+        return None
+
+    def _job_template(self, job):
+        '''
+        Job template with the attributes shared by the jobs of the same
+        signature: native specification (with the queue), parallel
+        configuration, environment, and the set of optional attributes
+        used. The templates are reused, so that only the attributes
+        specific to each job (command, paths) are set at submission.
+        The attributes which can not be unset are part of the signature.
+        '''
+        native_spec = self._native_specification(job)
+        parallel_job_info = job.parallel_job_info
+        if parallel_job_info:
+            parallel_job_info = tuple(parallel_job_info)
+        signature = (native_spec,
+                     parallel_job_info,
+                     bool(job.join_stderrout),
+                     bool(not job.join_stderrout and job.plain_stderr()),
+                     bool(job.stdin),
+                     bool(job.plain_working_directory()))
+
+        if self._job_templates is None:
+            self._job_templates = collections.OrderedDict()
+        job_template = self._job_templates.pop(signature, None)
+        if job_template is not None:
+            # most recently used
+            self._job_templates[signature] = job_template
+            return job_template
+
+        job_template = self._drmaa.createJobTemplate()
+        if job.join_stderrout:
+            job_template.joinFiles = "y"
+        if native_spec:
+            job_template.nativeSpecification = native_spec
+            self.logger.debug("NATIVE specification " + native_spec)
+
+        if parallel_job_info:
+            parallel_config_name, max_node_number = parallel_job_info
+            job_template = self._setDrmaaParallelJob(job_template,
+                                                     parallel_config_name,
+                                                     max_node_number)
+
+        if self._drmaa_implementation == "PBS":
+            if self._job_environment is None:
+                self._job_environment = dict(os.environ)
+            job_template.jobEnvironment = self._job_environment
+
+        self._job_templates[signature] = job_template
+        while len(self._job_templates) > self.TEMPLATE_CACHE_SIZE:
+            old_signature, old_template \
+                = self._job_templates.popitem(last=False)
+            try:
+                self._drmaa.deleteJobTemplate(old_template)
             except DrmaaException as e:
-                try:
-                    f = open(stderr_file, "wa")
-                    f.write("Error in job submission: %s" % (e))
-                    f.close()
-                except IOError as ioe:
-                    pass
-                self.logger.error("Error in job submission: %s" % (e))
-                raise DRMError("Job submission error: %s" % (e))
+                # the submission of the new job goes on
+                self.logger.debug("deleteJobTemplate: %s" % e)
+        return job_template
 
-            return drmaaSubmittedJobId
+    def job_submission(self, job):
+        '''
+        @type  job: soma_workflow.client.Job
+        @param job: job to be submitted
+        @rtype: string
+        @return: drmaa job id
+        '''
 
-        def kill_job(self, scheduler_job_id):
-            if self.is_sleeping:
-                self.wake()
-            if scheduler_job_id == self.FAKE_JOB:
-                return  # barriers are not run, thus cannot be killed.
-            try:
-                self._drmaa.control(
-                    scheduler_job_id, JobControlAction.TERMINATE)
-            except DrmaaException as e:
-                self.logger.critical("%s" % e)
-                raise e
+        if self.is_sleeping:
+            self.wake()
+        # patch for the PBS-torque DRMAA implementation
+        command = []
+        if job.is_barrier:
+            # barrier jobs don't actually go through DRMAA.
+            self.logger.debug('job_submission, DRMAA - barrier job.')
+            job.status = constants.DONE
+            return self.FAKE_JOB
+
+        job_command = job.plain_command()
+
+        # This is only for the old drmaa version
+        # Now it is not necessary anymore
+        # if self._drmaa_implementation == "PBS":
+        if False:
+            if job_command[0] == 'python':
+                job_command[0] = sys.executable
+            for command_el in job_command:
+                command_el = command_el.replace('"', '\\\"')
+                command.append("\"" + command_el + "\"")
+            self.logger.debug("PBS case, new command:" + repr(command))
+        else:
+            command = job_command
+
+        self.logger.debug("command: " + repr(command))
+        self.logger.debug("job.name=" + repr(job.name))
+
+        stderr_file = job.plain_stderr()
 
-        def get_job_status(self, scheduler_job_id):
-            if self.is_sleeping:
-                self.wake()
-            if scheduler_job_id == self.FAKE_JOB:
-                # a barrier job is done as soon as it is started.
-                return constants.DONE
+        try:
+            # the submission is done again only if the session was not
+            # active: after a communication error the job may have been
+            # submitted.
+            drmaaSubmittedJobId = self._session_call(
+                self._run_job, job, command,
+                retry_on=(NoActiveSessionException,))
+
+        except DrmaaException as e:
             try:
-                status = self._drmaa.jobStatus(scheduler_job_id)
-            except DrmaaException as e:
-                self.logger.error("%s" % (e))
-                raise DRMError("%s" % (e))
-            return status
+                f = open(stderr_file, "a")
+                f.write("Error in job submission: %s" % (e))
+                f.close()
+            except (IOError, OSError) as ioe:
+                pass
+            self.logger.error("Error in job submission: %s" % (e))
+            raise DRMError("Job submission error: %s" % (e))
 
-        def get_job_exit_info(self, scheduler_job_id):
-            if self.is_sleeping:
-                self.wake()
+        return drmaaSubmittedJobId
 
-            if scheduler_job_id == self.FAKE_JOB:
-                res_resourceUsage = ''
-                res_status = constants.FINISHED_REGULARLY
-                res_exitValue = 0
-                res_termSignal = None
-                return (res_status, res_exitValue, res_termSignal,
-                        res_resourceUsage)
+    def _run_job(self, job, command):
+        '''
+        Sets the job attributes in a job template and runs the job.
+        '''
+        stdout_file = job.plain_stdout()
+        stderr_file = job.plain_stderr()
+        stdin = job.plain_stdin()
+
+        jobTemplateId = self._job_template(job)
+        jobTemplateId.remoteCommand = command[0]
+        jobTemplateId.args = command[1:]
+
+        self.logger.info("jobTemplateId=" + repr(jobTemplateId) + " command[0]=" + repr(
+            command[0]) + " command[1:]=" + repr(command[1:]))
+        self.logger.info(
+            "hostname and stdout_file= [%s]:%s" % (self.hostname, stdout_file))
+
+        jobTemplateId.outputPath = "%s:%s" % (
+            self.hostname, stdout_file)
+
+        if not job.join_stderrout and stderr_file:
+            jobTemplateId.errorPath = "%s:%s" % (
+                self.hostname, stderr_file)
+
+        if job.stdin:
+            # self.logger.debug("stdin: " + repr(stdin))
+            # self._drmaa.setAttribute(drmaaJobId,
+            #                        "drmaa_input_path",
+            #                        "%s:%s" %(self.hostname, stdin))
+            self.logger.debug("stdin: " + repr(stdin))
+            jobTemplateId.inputPath = stdin
+
+        working_directory = job.plain_working_directory()
+        if working_directory:
+            jobTemplateId.workingDirectory = working_directory
+
+        self.logger.debug("before submit command: " + repr(command))
+        self.logger.debug("before submit job.name=" + repr(job.name))
+        return self._drmaa.runJob(jobTemplateId)
 
-            res_resourceUsage = []
-            res_status = constants.EXIT_UNDETERMINED
+    def kill_job(self, scheduler_job_id):
+        if self.is_sleeping:
+            self.wake()
+        if scheduler_job_id == self.FAKE_JOB:
+            return  # barriers are not run, thus cannot be killed.
+        try:
+            self._session_call(self._drmaa_method('control'),
+                               scheduler_job_id,
+                               JobControlAction.TERMINATE)
+        except DrmaaException as e:
+            self.logger.critical("%s" % e)
+            raise e
+
+    def get_job_status(self, scheduler_job_id):
+        if self.is_sleeping:
+            self.wake()
+        if scheduler_job_id == self.FAKE_JOB:
+            # a barrier job is done as soon as it is started.
+            return constants.DONE
+        try:
+            status = self._session_call(self._drmaa_method('jobStatus'),
+                                        scheduler_job_id)
+        except DrmaaException as e:
+            self.logger.error("%s" % (e))
+            raise DRMError("%s" % (e))
+        return status
+
+    def get_job_exit_info(self, scheduler_job_id):
+        if self.is_sleeping:
+            self.wake()
+
+        if scheduler_job_id == self.FAKE_JOB:
+            res_resourceUsage = ''
+            res_status = constants.FINISHED_REGULARLY
             res_exitValue = 0
             res_termSignal = None
+            return (res_status, res_exitValue, res_termSignal,
+                    res_resourceUsage)
 
-            try:
-                self.logger.debug(
-                    "  ==> Start to find info of job %s" % (scheduler_job_id))
-                jid_out, exit_value, signaled, term_sig, coredumped, aborted, exit_status, resource_usage = self._drmaa.wait(
-                    scheduler_job_id, self._drmaa.TIMEOUT_NO_WAIT)
-
-                self.logger.debug("  ==> jid_out=" + repr(jid_out))
-                self.logger.debug("  ==> exit_value=" + repr(exit_value))
-                self.logger.debug("  ==> signaled=" + repr(signaled))
-                self.logger.debug("  ==> term_sig=" + repr(term_sig))
-                self.logger.debug("  ==> coredumped=" + repr(coredumped))
-                self.logger.debug("  ==> aborted=" + repr(aborted))
-                self.logger.debug("  ==> exit_status=" + repr(exit_status))
-                self.logger.debug(
-                    "  ==> resource_usage=" + repr(resource_usage))
+        res_resourceUsage = []
+        res_status = constants.EXIT_UNDETERMINED
+        res_exitValue = 0
+        res_termSignal = None
 
-                if aborted == 1:
-                    res_status = constants.EXIT_ABORTED
+        try:
+            self.logger.debug(
+                "  ==> Start to find info of job %s" % (scheduler_job_id))
+            jid_out, exit_value, signaled, term_sig, coredumped, aborted, exit_status, resource_usage = self._session_call(
+                self._drmaa_method('wait'),
+                scheduler_job_id, self._drmaa.TIMEOUT_NO_WAIT)
+
+            self.logger.debug("  ==> jid_out=" + repr(jid_out))
+            self.logger.debug("  ==> exit_value=" + repr(exit_value))
+            self.logger.debug("  ==> signaled=" + repr(signaled))
+            self.logger.debug("  ==> term_sig=" + repr(term_sig))
+            self.logger.debug("  ==> coredumped=" + repr(coredumped))
+            self.logger.debug("  ==> aborted=" + repr(aborted))
+            self.logger.debug("  ==> exit_status=" + repr(exit_status))
+            self.logger.debug(
+                "  ==> resource_usage=" + repr(resource_usage))
+
+            if aborted == 1:
+                res_status = constants.EXIT_ABORTED
+            else:
+                if exit_value == 1:
+                    res_status = constants.FINISHED_REGULARLY
+                    res_exitValue = exit_status
                 else:
-                    if exit_value == 1:
-                        res_status = constants.FINISHED_REGULARLY
-                        res_exitValue = exit_status
+                    if signaled == 1:
+                        res_status = constants.FINISHED_TERM_SIG
+                        res_termSignal = term_sig
                     else:
-                        if signaled == 1:
-                            res_status = constants.FINISHED_TERM_SIG
-                            res_termSignal = term_sig
-                        else:
-                            res_status = constants.FINISHED_UNCLEAR_CONDITIONS
-
-                res_resourceUsage = ''
-                for k, v in six.iteritems(resource_usage):
-                    res_resourceUsage = res_resourceUsage + k + '=' + v + ' '
-
-            except ExitTimeoutException:
-                res_status = constants.EXIT_UNDETERMINED
-                self.logger.debug("  ==> self._drmaa.wait time out")
-
-            # DRMAA may leave files in ~/.drmaa
-            self.cleanup_drmaa_files(scheduler_job_id)
-
-            return (res_status, res_exitValue, res_termSignal, res_resourceUsage)
-
-        def cleanup_drmaa_files(self, scheduler_job_id):
-            filename = os.path.join(Configuration.get_home_dir(),
-                                    '.drmaa', str(scheduler_job_id))
-            startfile = '%s.started' % filename
-            endfile = '%s.exitcode' % filename
-            for f in (startfile, endfile):
-                if os.path.exists(f):
-                    os.unlink(f)
-else:
+                        res_status = constants.FINISHED_UNCLEAR_CONDITIONS
 
-    class DrmaaCTypes(Scheduler):
-        pass
+            res_resourceUsage = resource_usage_string(resource_usage)
+
+        except ExitTimeoutException:
+            res_status = constants.EXIT_UNDETERMINED
+            self.logger.debug("  ==> self._drmaa.wait time out")
+
+        # DRMAA may leave files in ~/.drmaa
+        self.cleanup_drmaa_files(scheduler_job_id)
+
+        return (res_status, res_exitValue, res_termSignal, res_resourceUsage)
+
+    def cleanup_drmaa_files(self, scheduler_job_id):
+        filename = os.path.join(Configuration.get_home_dir(),
+                                '.drmaa', str(scheduler_job_id))
+        startfile = '%s.started' % filename
+        endfile = '%s.exitcode' % filename
+        for f in (startfile, endfile):
+            if os.path.exists(f):
+                os.unlink(f)
+
+
+class JobQueue(object):
+
+    '''
+    Priority queue of scheduler job ids: the jobs with the highest priority
+    come first, and the jobs with the same priority in submission order.
+
+    push and pop are O(log n). remove only marks the entry, which is skipped
+    by pop (lazy deletion); the heap is compacted when most of its entries
+    are removed ones.
+
+    * _heap *list of list [-priority, submission number, job id]*
+
+    * _entries *dictionary job_id -> heap entry*
+    '''
+
+    # job id of the removed entries
+    _REMOVED = object()
+
+    _heap = None
+
+    _entries = None
+
+    _counter = None
+
+    _removed = None
+
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._removed = 0
+
+    def push(self, job_id, priority=0):
+        if job_id in self._entries:
+            self.remove(job_id)
+        entry = [-priority, next(self._counter), job_id]
+        self._entries[job_id] = entry
+        heapq.heappush(self._heap, entry)
+
+    def pop(self):
+        '''
+        Remove and return the job id with the highest priority.
+        Raise KeyError if the queue is empty.
+        '''
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            job_id = entry[2]
+            if job_id is JobQueue._REMOVED:
+                self._removed -= 1
+                continue
+            del self._entries[job_id]
+            return job_id
+        raise KeyError('pop from an empty job queue')
+
+    def remove(self, job_id):
+        '''
+        Raise KeyError if the job is not in the queue.
+        '''
+        entry = self._entries.pop(job_id)
+        # the submission numbers are unique, so the heap comparisons never
+        # reach the job id.
+        entry[2] = JobQueue._REMOVED
+        self._removed += 1
+        if self._removed > len(self._entries) and self._removed > 64:
+            self._heap = [e for e in self._heap
+                          if e[2] is not JobQueue._REMOVED]
+            heapq.heapify(self._heap)
+            self._removed = 0
+
+    def __contains__(self, job_id):
+        return job_id in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __bool__(self):
+        return len(self._entries) != 0
+
+    __nonzero__ = __bool__
+
+
+class LoadAdmissionController(object):
+
+    '''
+    Decides whether the local scheduler can run one more job than its
+    guaranteed number of processors (proc_nb), up to max_proc_nb.
+
+    The decision uses a smoothed load signal:
+
+      * idle CPUs (psutil, or /proc/stat),
+      * CPU, memory and I/O pressure (Linux PSI, /proc/pressure, "some avg10"
+        percentage) when available,
+      * available memory (psutil, or /proc/meminfo).
+
+    The machine is considered overloaded when the pressure or the memory use
+    goes over a high threshold, and stops being so only when they are all
+    under a low threshold (hysteresis), so that the number of jobs does not
+    oscillate.
+
+    Each admitted job reserves one CPU and its expected memory (the mean peak
+    resident size of the previous jobs). The reservations decay with the time
+    needed by the smoothed signal to see the new job, so that several jobs are
+    not admitted on the same idle CPU.
+
+    The idle CPUs are measured between two samples: a first sample is taken
+    at the creation, and no job is admitted as long as the idle CPUs are
+    unknown, unless they can not be measured on the system.
+    '''
+
+    # high and low thresholds of the pressure (percentage of time)
+    PRESSURE_HIGH = 40.
+    PRESSURE_LOW = 15.
+
+    # high and low thresholds of the used memory (fraction of the memory)
+    MEMORY_HIGH = 0.95
+    MEMORY_LOW = 0.85
+
+    # idle CPUs needed to admit a job
+    MIN_IDLE_CPU = 0.5
+
+    # smoothing factor of the signal (weight of a new sample)
+    SMOOTHING = 0.3
+
+    # minimum time between two samples (seconds)
+    SAMPLE_INTERVAL = 0.5
+
+    # time constant of the reservations decay (seconds)
+    RESERVATION_TIME = 5.
+
+    _cpu_idle = None
+
+    _pressure = None
+
+    _memory_available = None
+
+    _memory_total = None
+
+    _memory_per_job = None
+
+    _overloaded = None
+
+    _reservations = None
+
+    _last_sample = None
+
+    _last_cpu_times = None
+
+    _cpu_measurable = None
+
+    def __init__(self):
+        self._overloaded = False
+        self._reservations = []
+        self._last_sample = None
+        self._last_cpu_times = None
+        self._memory_per_job = 0
+        # priming sample: the idle CPUs are measured from there
+        self._read_cpu_idle()
+        self._cpu_measurable = self._last_cpu_times is not None
+
+    @staticmethod
+    def _read_pressure():
+        '''
+        * returns: *float*
+            Maximum of the CPU, memory and I/O "some avg10" pressure, or None
+            if /proc/pressure is not available.
+        '''
+        pressure = None
+        for resource_name in ('cpu', 'memory', 'io'):
+            try:
+                with open(os.path.join('/proc/pressure', resource_name)) as f:
+                    line = f.readline()
+            except (IOError, OSError):
+                continue
+            for field in line.split()[1:]:
+                name, value = field.split('=')
+                if name == 'avg10':
+                    pressure = max(pressure or 0., float(value))
+        return pressure
+
+    @staticmethod
+    def _read_memory():
+        '''
+        * returns: *tuple*
+            (available memory, total memory) in bytes, or (None, None)
+        '''
+        if have_psutil:
+            memory = psutil.virtual_memory()
+            return (memory.available, memory.total)
+        info = {}
+        try:
+            with open('/proc/meminfo') as f:
+                for line in f:
+                    fields = line.split()
+                    info[fields[0].rstrip(':')] = int(fields[1]) * 1024
+        except (IOError, OSError, ValueError, IndexError):
+            return (None, None)
+        return (info.get('MemAvailable', info.get('MemFree')),
+                info.get('MemTotal'))
+
+    def _read_cpu_idle(self):
+        '''
+        * returns: *float*
+            Number of idle CPUs since the previous call, or None.
+        '''
+        if have_psutil:
+            times = psutil.cpu_times_percent(interval=None)
+            if self._last_cpu_times is None:
+                # the first measure is meaningless
+                self._last_cpu_times = times
+                return None
+            if not sum(times):
+                # no time elapsed since the previous measure
+                return None
+            return times.idle * cpu_count() / 100.
+        try:
+            with open('/proc/stat') as f:
+                fields = [float(v) for v in f.readline().split()[1:]]
+        except (IOError, OSError, ValueError):
+            return None
+        # idle + iowait
+        idle = fields[3] + (fields[4] if len(fields) > 4 else 0.)
+        total = sum(fields)
+        last = self._last_cpu_times
+        self._last_cpu_times = (idle, total)
+        if last is None or total <= last[1]:
+            return None
+        return (idle - last[0]) / (total - last[1]) * cpu_count()
+
+    def _read_load(self):
+        '''
+        * returns: *tuple*
+            (idle CPUs, pressure, available memory, total memory), each one
+            None if it can not be measured.
+        '''
+        memory_available, memory_total = LoadAdmissionController._read_memory()
+        return (self._read_cpu_idle(),
+                LoadAdmissionController._read_pressure(),
+                memory_available,
+                memory_total)
+
+    @staticmethod
+    def _smooth(previous, value):
+        if value is None:
+            return previous
+        if previous is None:
+            return value
+        return previous + LoadAdmissionController.SMOOTHING \
+            * (value - previous)
+
+    def sample(self, now=None):
+        '''
+        Update the smoothed signal, if the last sample is old enough, and the
+        overload state.
+        '''
+        if now is None:
+            now = time.time()
+        if self._last_sample is not None and \
+                now - self._last_sample < self.SAMPLE_INTERVAL:
+            return
+        self._last_sample = now
+        cpu_idle, pressure, memory_available, memory_total = self._read_load()
+        self._cpu_idle = self._smooth(self._cpu_idle, cpu_idle)
+        self._pressure = self._smooth(self._pressure, pressure)
+        self._memory_available = self._smooth(self._memory_available,
+                                               memory_available)
+        if memory_total:
+            self._memory_total = memory_total
+
+        memory_used = None
+        if self._memory_available is not None and self._memory_total:
+            memory_used = 1. - float(self._memory_available) \
+                / self._memory_total
+        if self._overloaded:
+            self._overloaded = \
+                (self._pressure is not None
+                 and self._pressure > self.PRESSURE_LOW) \
+                or (memory_used is not None and memory_used > self.MEMORY_LOW)
+        else:
+            self._overloaded = \
+                (self._pressure is not None
+                 and self._pressure > self.PRESSURE_HIGH) \
+                or (memory_used is not None
+                    and memory_used > self.MEMORY_HIGH)
+
+    def _reserved(self, now):
+        '''
+        * returns: *tuple*
+            (reserved CPUs, reserved memory)
+        '''
+        self._reservations = [r for r in self._reservations
+                              if now - r[0] < 5 * self.RESERVATION_TIME]
+        cpu = 0.
+        memory = 0.
+        for admission_time, job_memory in self._reservations:
+            weight = math.exp(-(now - admission_time) / self.RESERVATION_TIME)
+            cpu += weight
+            memory += weight * job_memory
+        return (cpu, memory)
+
+    def admit(self, now=None):
+        '''
+        Decide if one more job can be run, and if so reserve its resources.
+
+        * returns: *boolean*
+        '''
+        if now is None:
+            now = time.time()
+        self.sample(now)
+        if self._overloaded:
+            return False
+        if self._cpu_idle is None and self._cpu_measurable:
+            # not measured yet
+            return False
+        reserved_cpu, reserved_memory = self._reserved(now)
+        if self._cpu_idle is not None and \
+                self._cpu_idle - reserved_cpu < self.MIN_IDLE_CPU:
+            return False
+        if self._memory_available is not None and self._memory_total:
+            margin = (1. - self.MEMORY_HIGH) * self._memory_total
+            if self._memory_available - reserved_memory \
+                    - self._memory_per_job < margin:
+                return False
+        self._reservations.append((now, self._memory_per_job))
+        return True
+
+    def job_ended(self, rusage):
+        '''
+        Update the expected memory of the jobs from an ended job.
+
+        * rusage *dictionary or None*
+            Resource usage with the fields of python_worker.RUSAGE_FIELDS
+        '''
+        if not rusage or not rusage.get('ru_maxrss'):
+            return
+        job_memory = rusage['ru_maxrss']
+        if sys.platform != 'darwin':
+            # kilobytes, except on MacOS
+            job_memory *= 1024
+        self._memory_per_job = self._smooth(self._memory_per_job or None,
+                                            job_memory)
 
 
 class LocalScheduler(Scheduler):
@@ -523,21 +1130,30 @@ class LocalScheduler(Scheduler):
 
     * _proc_nb *int*
 
-    * _queue *list of scheduler jobs ids*
+    * _queue *JobQueue of scheduler jobs ids*
 
     * _jobs *dictionary job_id -> soma_workflow.engine_types.EngineJob*
 
-    * _processes *dictionary job_id -> subprocess.Popen*
+    * _processes *dictionary job_id -> subprocess.Popen or PythonWorker*
+
+    * _python_pool *PythonWorkerPool*
+        Runs the Python callable jobs (see PythonJob), or None if not
+        supported on the system: the jobs then run their command.
 
     * _status *dictionary job_id -> job status as defined in constants*
 
     * _exit_info * dictionay job_id -> exit info*
 
+    * _timing *dictionary job_id -> list [submission time, start time]*
+
     * _loop *thread*
 
     * _interval *int*
 
     * _look *threading.RLock*
+
+    * _admission *LoadAdmissionController*
+        Decides if more than _proc_nb jobs can be run.
     '''
     parallel_job_submission_info = None
 
@@ -553,18 +1169,21 @@ class LocalScheduler(Scheduler):
 
     _processes = None
 
+    _python_pool = None
+
     _status = None
 
     _exit_info = None
 
+    _timing = None
+
     _loop = None
 
     _interval = None
 
     _lock = None
 
-    _lasttime = None
-    _lastidle = None
+    _admission = None
 
     def __init__(self, proc_nb=default_cpu_number(), interval=1,
                  max_proc_nb=0):
@@ -575,11 +1194,17 @@ class LocalScheduler(Scheduler):
         self._proc_nb = proc_nb
         self._max_proc_nb = max_proc_nb
         self._interval = interval
-        self._queue = []
+        self._queue = JobQueue()
         self._jobs = {}
         self._processes = {}
         self._status = {}
         self._exit_info = {}
+        self._timing = {}
+        self._admission = LoadAdmissionController()
+        if PythonWorkerPool.is_supported():
+            self._python_pool = PythonWorkerPool()
+        else:
+            self._python_pool = None
 
         self._lock = threading.RLock()
 
@@ -614,7 +1239,11 @@ class LocalScheduler(Scheduler):
     def end_scheduler_thread(self):
         with self._lock:
             self.stop_thread_loop = True
-            self._loop.join()
+        # the loop needs the lock to end its iteration
+        self._loop.join()
+        with self._lock:
+            if self._python_pool is not None:
+                self._python_pool.close()
             # print("Soma scheduler thread ended nicely.")
 
     def _iterate(self):
@@ -625,24 +1254,31 @@ class LocalScheduler(Scheduler):
         # Control the running jobs
         ended_jobs = []
         for job_id, process in six.iteritems(self._processes):
-            ret_value = process.poll()
+            if isinstance(process, PythonWorker):
+                ret_value, rusage = process.poll_job()
+            else:
+                ret_value, rusage = LocalScheduler._poll_process(process)
             # print("job_id " + repr(job_id) + " ret_value " + repr(ret_value))
             if ret_value != None:
                 ended_jobs.append(job_id)
+                self._admission.job_ended(rusage)
                 self._exit_info[job_id] = (constants.FINISHED_REGULARLY,
                                            ret_value,
                                            None,
-                                           None)
+                                           self._resource_usage(job_id,
+                                                                rusage))
 
         # update for the ended job
         for job_id in ended_jobs:
             # print("updated job_id " + repr(job_id) + " status DONE")
             self._status[job_id] = constants.DONE
-            del self._processes[job_id]
+            process = self._processes.pop(job_id)
+            if isinstance(process, PythonWorker):
+                self._python_pool.release(process)
 
         # run new jobs
         while (self._queue and self._can_submit_new_job()):
-            job_id = self._queue.pop(0)
+            job_id = self._queue.pop()
             job = self._jobs[job_id]
             # print("new job " + repr(job.job_id))
             if job.is_barrier:
@@ -653,18 +1289,109 @@ class LocalScheduler(Scheduler):
                                                None,
                                                None)
                 self._status[job.job_id] = constants.DONE
+                self._timing.pop(job.job_id, None)
+            elif job.is_python_job and self._python_pool is not None:
+                self._processes[job.job_id] = self._python_pool.run(job)
+                self._status[job.job_id] = constants.RUNNING
+                self._timing.setdefault(job.job_id,
+                                        [None, None])[1] = time.time()
             else:
                 process = LocalScheduler.create_process(job)
+                self._timing.setdefault(job.job_id,
+                                        [None, None])[1] = time.time()
                 if process == None:
                     self._exit_info[job.job_id] = (constants.EXIT_ABORTED,
                                                    None,
                                                    None,
                                                    None)
                     self._status[job.job_id] = constants.FAILED
+                    self._timing.pop(job.job_id, None)
                 else:
                     self._processes[job.job_id] = process
                     self._status[job.job_id] = constants.RUNNING
 
+    @staticmethod
+    def _poll_process(process):
+        '''
+        Non blocking test of the process termination.
+        When available (Unix systems), os.wait4 is used to reap the process so
+        that its resource usage is collected along with its return value.
+
+        * process *subprocess.Popen*
+
+        * returns: *tuple*
+            (return value, or None if the process is still running,
+             resource usage dictionary, or None)
+        '''
+        if process.returncode is not None or not hasattr(os, 'wait4'):
+            return (process.poll(), None)
+        try:
+            pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+        except OSError:
+            # the process was already reaped
+            return (process.poll(), None)
+        if pid == 0:
+            return (None, None)
+        if os.WIFSIGNALED(status):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
+        return (process.returncode,
+                dict((name, getattr(rusage, name)) for name in RUSAGE_FIELDS))
+
+    def _resource_usage(self, job_id, rusage=None):
+        '''
+        Resource usage string of an ended job (see format_resource_usage).
+
+        * job_id *int*
+
+        * rusage *dictionary or None*
+            Resource usage with the fields of python_worker.RUSAGE_FIELDS
+
+        * returns: *string*
+        '''
+        submission_time, start_time = self._timing.pop(job_id, (None, None))
+        return LocalScheduler.format_resource_usage(submission_time,
+                                                    start_time,
+                                                    time.time(),
+                                                    rusage)
+
+    @staticmethod
+    def format_resource_usage(submission_time, start_time, end_time,
+                              rusage=None):
+        '''
+        Resource usage string of an ended job, in the "name=value" format of
+        the DRMAA resource usage.
+        Times are given in seconds, ru_maxrss uses the unit of the system
+        getrusage call (kilobytes on Linux), ru_inblock and ru_oublock are
+        the numbers of block input and output operations.
+
+        * submission_time, start_time, end_time *float or None*
+
+        * rusage *dictionary or None*
+            Resource usage with the fields of python_worker.RUSAGE_FIELDS
+
+        * returns: *string*
+        '''
+        usage = []
+        if submission_time is not None:
+            usage.append(('submission_time', '%.3f' % submission_time))
+        if start_time is not None:
+            usage.append(('start_time', '%.3f' % start_time))
+            usage.append(('end_time', '%.3f' % end_time))
+            usage.append(('wallclock', '%.3f' % (end_time - start_time)))
+        if rusage is not None:
+            usage.append(('cpu', '%.3f' % (rusage['ru_utime']
+                                            + rusage['ru_stime'])))
+            for name in RUSAGE_FIELDS:
+                if name in ('ru_utime', 'ru_stime'):
+                    usage.append((name, '%.3f' % rusage[name]))
+                else:
+                    usage.append((name, rusage[name]))
+        if not usage:
+            return None
+        return resource_usage_string(usage)
+
     def _can_submit_new_job(self):
         n = len(self._processes)
         if n < self._proc_nb:
@@ -675,26 +1402,52 @@ class LocalScheduler(Scheduler):
                 max_proc_nb = cpu_count()
             else:
                 max_proc_nb = cpu_count() - 1
-        if n < max_proc_nb and self.is_available_cpu():
+        if n < max_proc_nb and self._admission.admit():
             return True
         return False
 
     @staticmethod
-    def is_available_cpu():
-        # OK if there is at least one half CPU left idle
+    def kill_process(process):
+        '''
+        Kill a job process with its children processes, and wait for its
+        actual termination.
+
+        * process *subprocess.Popen*
+            as returned by create_process
+        '''
         if have_psutil:
-            if LocalScheduler._lasttime is None or time.time() - LocalScheduler._lasttime > 0.1:
-                LocalScheduler._lasttime = time.time()
-                LocalScheduler._lastidle = psutil.cpu_times_percent().idle * psutil.cpu_count()
-            if LocalScheduler._lastidle > 20.:
-                # decrease artificially idle because we will sublit a job,
-                # and next calls should take it into account
-                # until another measurement is done.
-                LocalScheduler._lastidle -= 100. # increase artificially
-                return True
-            return False
-        # no psutil: get to the upper limit.
-        return True
+            kill_process_tree(process.pid)
+            # wait for actual termination, to avoid process writing files after
+            # we return from here.
+            process.communicate()
+        else:
+            # psutil not available
+            if sys.version_info < (2, 6):
+                if sys.platform == 'win32':
+                    PROCESS_TERMINATE = 1
+                    handle = ctypes.windll.kernel32.OpenProcess(
+                        PROCESS_TERMINATE,
+                        False,
+                        process.pid)
+                    ctypes.windll.kernel32.TerminateProcess(handle, -1)
+                    ctypes.windll.kernel32.CloseHandle(handle)
+                else:
+                    os.kill(process.pid, signal.SIGKILL)
+                    os.wait()
+            else:
+                if sys.platform == 'win32':
+                    # children processes will probably not be killed
+                    # immediately.
+                    process.kill()
+                else:
+                    # kill process group, to kill children processes as well
+                    # see
+                    # http://stackoverflow.com/questions/4789837/how-to-terminate-a-python-subprocess-launched-with-shell-true
+                    os.killpg(process.pid, signal.SIGKILL)
+
+            # wait for actual termination, to avoid process writing files after
+            # we return from here.
+            process.communicate()
 
     @staticmethod
     def create_process(engine_job):
@@ -779,14 +1532,13 @@ class LocalScheduler(Scheduler):
             Job id for the scheduling system (DRMAA for example)
         '''
         if not job.job_id or job.job_id == -1:
-            raise LocalSchedulerError("Invalid job: no id")
+            raise DRMError("Invalid job: no id")
         with self._lock:
             # print("job submission " + repr(job.job_id))
-            self._queue.append(job.job_id)
+            self._queue.push(job.job_id, job.priority)
             self._jobs[job.job_id] = job
             self._status[job.job_id] = constants.QUEUED_ACTIVE
-            self._queue.sort(key=lambda job_id: self._jobs[job_id].priority,
-                             reverse=True)
+            self._timing[job.job_id] = [time.time(), None]
         return job.job_id
 
     def get_job_status(self, scheduler_job_id):
@@ -797,7 +1549,7 @@ class LocalScheduler(Scheduler):
             Job status as defined in constants.JOB_STATUS
         '''
         if not scheduler_job_id in self._status:
-            raise LocalSchedulerError("Unknown job.")
+            raise DRMError("Unknown job.")
 
         status = self._status[scheduler_job_id]
         return status
@@ -811,10 +1563,26 @@ class LocalScheduler(Scheduler):
         '''
         # TBI errors
         with self._lock:
-            exit_info = self._exit_info[scheduler_job_id]
-            del self._exit_info[scheduler_job_id]
+            exit_info = self._exit_info.pop(scheduler_job_id)
+            # the engine does not need the job any more
+            self.release_job(scheduler_job_id)
         return exit_info
 
+    def release_job(self, scheduler_job_id):
+        '''
+        * scheduler_job_id *string*
+            Job id for the scheduling system (DRMAA for example)
+        '''
+        with self._lock:
+            if scheduler_job_id in self._processes \
+                    or scheduler_job_id in self._queue:
+                # the job is still queued or running
+                return
+            self._status.pop(scheduler_job_id, None)
+            self._jobs.pop(scheduler_job_id, None)
+            self._exit_info.pop(scheduler_job_id, None)
+            self._timing.pop(scheduler_job_id, None)
+
     def kill_job(self, scheduler_job_id):
         '''
         * scheduler_job_id *string*
@@ -826,50 +1594,24 @@ class LocalScheduler(Scheduler):
             if scheduler_job_id in self._processes:
                 # print("    => kill the process ")
                 process = self._processes[scheduler_job_id]
-                if have_psutil:
-                    kill_process_tree(process.pid)
-                    # wait for actual termination, to avoid process writing files after
-                    # we return from here.
-                    process.communicate()
-                else:
-                    # psutil not available
-                    if sys.version_info < (2, 6):
-                        if sys.platform == 'win32':
-                            PROCESS_TERMINATE = 1
-                            handle = ctypes.windll.kernel32.OpenProcess(
-                                PROCESS_TERMINATE,
-                                False,
-                                process.pid)
-                            ctypes.windll.kernel32.TerminateProcess(handle, -1)
-                            ctypes.windll.kernel32.CloseHandle(handle)
-                        else:
-                            os.kill(process.pid, signal.SIGKILL)
-                            os.wait()
-                    else:
-                        if sys.platform == 'win32':
-                            # children processes will probably not be killed
-                            # immediately.
-                            process.kill()
-                        else:
-                            # kill process group, to kill children processes as well
-                            # see
-                            # http://stackoverflow.com/questions/4789837/how-to-terminate-a-python-subprocess-launched-with-shell-true
-                            os.killpg(process.pid, signal.SIGKILL)
-
-                    # wait for actual termination, to avoid process writing files after
-                    # we return from here.
-                    process.communicate()
+                if isinstance(process, PythonWorker):
+                    # the worker is killed with the job, and not given back
+                    # to the pool
+                    process = process.process
+                LocalScheduler.kill_process(process)
 
                 del self._processes[scheduler_job_id]
                 self._status[scheduler_job_id] = constants.FAILED
-                self._exit_info[scheduler_job_id] = (constants.USER_KILLED,
-                                                     None,
-                                                     None,
-                                                     None)
+                self._exit_info[scheduler_job_id] = (
+                    constants.USER_KILLED,
+                    None,
+                    None,
+                    self._resource_usage(scheduler_job_id))
             elif scheduler_job_id in self._queue:
                 # print("    => removed from queue ")
                 self._queue.remove(scheduler_job_id)
                 del self._jobs[scheduler_job_id]
+                self._timing.pop(scheduler_job_id, None)
                 self._status[scheduler_job_id] = constants.FAILED
                 self._exit_info[scheduler_job_id] = (constants.EXIT_ABORTED,
                                                      None,
@@ -920,3 +1662,439 @@ class ConfiguredLocalScheduler(LocalScheduler):
         elif event == LocalSchedulerCfg.MAX_PROC_NB_CHANGED:
             self.change_max_proc_nb(self._config.get_max_proc_nb())
         self._config.save_to_file()
+
+
+class SimulatedScheduler(Scheduler):
+
+    '''
+    Discrete event simulation of a scheduler: no process is run. The jobs
+    wait queue_latency in the queue, then run on one of proc_nb slots for
+    their expected duration, on a virtual clock.
+
+    Used with the WorkflowEngine and a database server, it allows to measure
+    the engine and database scaling on very large workflows, or to estimate
+    the duration of a workflow on a given number of slots, without any
+    computing resource.
+
+    The duration of a job is, by order of preference:
+      * the "duration" item of its user_storage, if it is a dictionary,
+      * the duration of the jobs with the same name in the durations
+        history (see load_durations),
+      * default_duration.
+
+    If time_scale is 0 (default) the clock moves from event to event, at most
+    once per engine iteration (detected when the engine asks twice for the
+    status of the same job): the simulation runs as fast as the engine can
+    follow the jobs. Otherwise the clock follows the real time multiplied by
+    time_scale.
+
+    The times are reported in the resource usage of the jobs as virtual
+    seconds.
+
+    * _now *float*
+        Virtual time.
+
+    * _events *heap of tuple (time, event number, job_id)*
+        End of the queue latency, or end of the run of a job. An event is
+        outdated if its number is not the one of _event_numbers[job_id].
+
+    * _event_numbers *dictionary job_id -> event number*
+
+    * _queue *JobQueue of jobs ids*
+        Jobs which can start as soon as a slot is free.
+
+    * _running *dictionary job_id -> end time*
+
+    * _jobs *dictionary job_id -> soma_workflow.engine_types.EngineJob*
+
+    * _status *dictionary job_id -> job status as defined in constants*
+
+    * _exit_info *dictionary job_id -> exit info*
+
+    * _timing *dictionary job_id -> list [submission time, start time]*
+
+    * _observed *set of job_id*
+        Jobs whose status was asked since the last move of the clock.
+    '''
+
+    def __init__(self, proc_nb=1, queue_latency=0., default_duration=1.,
+                 durations=None, durations_file=None, time_scale=0.):
+        '''
+        * proc_nb *int*
+            Number of slots.
+
+        * queue_latency *float*
+            Minimum time (in seconds) spent by a job in the queue.
+
+        * default_duration *float*
+            Duration (in seconds) of the jobs with no known duration.
+
+        * durations *dictionary job name -> float*
+
+        * durations_file *string*
+            Durations history file (see load_durations), added to durations.
+
+        * time_scale *float*
+            Virtual seconds per real second, or 0.
+        '''
+        super(SimulatedScheduler, self).__init__()
+        self.logger = logging.getLogger('engine.Scheduler')
+        self._proc_nb = max(1, proc_nb)
+        self._queue_latency = queue_latency
+        self._default_duration = default_duration
+        self._durations = {}
+        if durations_file:
+            self._durations.update(self.load_durations(durations_file))
+        if durations:
+            self._durations.update(durations)
+        self._time_scale = time_scale
+        self._real_start_time = time.time()
+        self._now = 0.
+        self._events = []
+        self._event_numbers = {}
+        self._event_counter = itertools.count()
+        self._queue = JobQueue()
+        self._running = {}
+        self._jobs = {}
+        self._status = {}
+        self._exit_info = {}
+        self._timing = {}
+        self._observed = set()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def load_durations(file_path):
+        '''
+        Read a durations history file: a JSON object mapping job names to a
+        duration in seconds, or to a list of durations whose mean is used.
+
+        * returns: *dictionary job name -> float*
+        '''
+        with open(file_path) as f:
+            history = json.load(f)
+        durations = {}
+        for name, duration in six.iteritems(history):
+            if isinstance(duration, list):
+                if not duration:
+                    continue
+                duration = sum(duration) / float(len(duration))
+            durations[name] = float(duration)
+        return durations
+
+    def current_time(self):
+        '''
+        * returns: *float*
+            Virtual time, in seconds since the creation of the scheduler.
+        '''
+        with self._lock:
+            return self._now
+
+    def job_duration(self, job):
+        '''
+        * job *EngineJob*
+
+        * returns: *float*
+            Expected duration of the job, in seconds.
+        '''
+        duration = expected_duration(job)
+        if duration is not None:
+            return duration
+        return self._durations.get(job.name, self._default_duration)
+
+    def _push_event(self, event_time, job_id):
+        number = next(self._event_counter)
+        self._event_numbers[job_id] = number
+        heapq.heappush(self._events, (event_time, number, job_id))
+
+    def _start_jobs(self):
+        while self._queue and len(self._running) < self._proc_nb:
+            job_id = self._queue.pop()
+            end_time = self._now + self.job_duration(self._jobs[job_id])
+            self._running[job_id] = end_time
+            self._timing[job_id][1] = self._now
+            self._status[job_id] = constants.RUNNING
+            self._push_event(end_time, job_id)
+
+    def _process_events(self, until):
+        while self._events and self._events[0][0] <= until:
+            event_time, number, job_id = heapq.heappop(self._events)
+            if self._event_numbers.get(job_id) != number:
+                continue
+            del self._event_numbers[job_id]
+            self._now = max(self._now, event_time)
+            if job_id in self._running:
+                del self._running[job_id]
+                submission_time, start_time = self._timing[job_id]
+                self._status[job_id] = constants.DONE
+                self._exit_info[job_id] = (
+                    constants.FINISHED_REGULARLY,
+                    0,
+                    None,
+                    LocalScheduler.format_resource_usage(
+                        submission_time, start_time, self._now))
+            else:
+                # end of the queue latency
+                self._queue.push(job_id, self._jobs[job_id].priority)
+            self._start_jobs()
+        self._now = max(self._now, until)
+
+    def _advance(self, job_id=None):
+        '''
+        Move the virtual clock forward (see the class documentation).
+        '''
+        if self._time_scale:
+            self._process_events((time.time() - self._real_start_time)
+                                 * self._time_scale)
+        elif job_id is not None:
+            if job_id in self._observed:
+                self._observed.clear()
+                # drop the outdated events, which must not move the clock
+                while self._events and self._event_numbers.get(
+                        self._events[0][2]) != self._events[0][1]:
+                    heapq.heappop(self._events)
+                if self._events:
+                    self._process_events(self._events[0][0])
+            self._observed.add(job_id)
+
+    def job_submission(self, job):
+        '''
+        * job *EngineJob*
+        * return: *string*
+            Job id for the scheduling system (DRMAA for example)
+        '''
+        if not job.job_id or job.job_id == -1:
+            raise DRMError("Invalid job: no id")
+        with self._lock:
+            self._advance()
+            job_id = job.job_id
+            self._jobs[job_id] = job
+            self._timing[job_id] = [self._now, None]
+            if job.is_barrier:
+                self._status[job_id] = constants.DONE
+                self._exit_info[job_id] = (constants.FINISHED_REGULARLY,
+                                           0, None, None)
+            elif self._queue_latency > 0:
+                self._status[job_id] = constants.QUEUED_ACTIVE
+                self._push_event(self._now + self._queue_latency, job_id)
+            else:
+                self._status[job_id] = constants.QUEUED_ACTIVE
+                self._queue.push(job_id, job.priority)
+                self._start_jobs()
+        return job_id
+
+    def get_job_status(self, scheduler_job_id):
+        '''
+        * scheduler_job_id *string*
+            Job id for the scheduling system (DRMAA for example)
+        * return: *string*
+            Job status as defined in constants.JOB_STATUS
+        '''
+        with self._lock:
+            if not scheduler_job_id in self._status:
+                raise DRMError("Unknown job.")
+            self._advance(scheduler_job_id)
+            return self._status[scheduler_job_id]
+
+    def get_job_exit_info(self, scheduler_job_id):
+        '''
+        * scheduler_job_id *string*
+            Job id for the scheduling system (DRMAA for example)
+        * return: *tuple*
+            exit_status, exit_value, term_sig, resource_usage
+        '''
+        with self._lock:
+            exit_info = self._exit_info.pop(scheduler_job_id)
+            self.release_job(scheduler_job_id)
+        return exit_info
+
+    def release_job(self, scheduler_job_id):
+        '''
+        * scheduler_job_id *string*
+            Job id for the scheduling system (DRMAA for example)
+        '''
+        with self._lock:
+            if scheduler_job_id in self._event_numbers \
+                    or scheduler_job_id in self._queue:
+                # the job is still queued or running
+                return
+            self._status.pop(scheduler_job_id, None)
+            self._jobs.pop(scheduler_job_id, None)
+            self._exit_info.pop(scheduler_job_id, None)
+            self._timing.pop(scheduler_job_id, None)
+            self._observed.discard(scheduler_job_id)
+
+    def kill_job(self, scheduler_job_id):
+        '''
+        * scheduler_job_id *string*
+            Job id for the scheduling system (DRMAA for example)
+        '''
+        with self._lock:
+            # the pending event of the job is outdated
+            self._event_numbers.pop(scheduler_job_id, None)
+            if scheduler_job_id in self._running:
+                del self._running[scheduler_job_id]
+                submission_time, start_time = self._timing[scheduler_job_id]
+                self._status[scheduler_job_id] = constants.FAILED
+                self._exit_info[scheduler_job_id] = (
+                    constants.USER_KILLED,
+                    None,
+                    None,
+                    LocalScheduler.format_resource_usage(
+                        submission_time, start_time, self._now))
+                self._start_jobs()
+            elif self._status.get(scheduler_job_id) \
+                    == constants.QUEUED_ACTIVE:
+                if scheduler_job_id in self._queue:
+                    self._queue.remove(scheduler_job_id)
+                self._jobs.pop(scheduler_job_id, None)
+                self._timing.pop(scheduler_job_id, None)
+                self._status[scheduler_job_id] = constants.FAILED
+                self._exit_info[scheduler_job_id] = (constants.EXIT_ABORTED,
+                                                     None,
+                                                     None,
+                                                     None)
+
+
+class HybridScheduler(Scheduler):
+
+    '''
+    Routes each job either to a local scheduler, on the submission machine,
+    or to a cluster scheduler (DRMAA).
+
+    Small jobs (file renames, short Python steps...) thus do not pay the
+    queue latency of the cluster, while the heavy ones still run on it.
+    A job runs locally if:
+      * it is a barrier job,
+      * or its queue is local_queue,
+      * or its expected duration (see expected_duration) is at most
+        local_max_duration, and it needs no specific cluster resource
+        (parallel job or native specification).
+
+    * _local_scheduler *LocalScheduler*
+
+    * _drmaa_scheduler *Scheduler*
+
+    * _job_scheduler *dictionary scheduler job id -> Scheduler*
+        Scheduler running each job. The jobs which are not found here (such
+        as the jobs submitted before a restart of the engine) are the ones of
+        the cluster scheduler.
+    '''
+
+    def __init__(self, local_scheduler, drmaa_scheduler,
+                 local_max_duration=60., local_queue='local'):
+        '''
+        * local_scheduler *LocalScheduler*
+
+        * drmaa_scheduler *Scheduler*
+
+        * local_max_duration *float or None*
+            Maximum expected duration (in seconds) of the jobs run locally.
+            None: the duration is not used.
+
+        * local_queue *string or None*
+            Name of the queue of the jobs run locally.
+        '''
+        super(HybridScheduler, self).__init__()
+        self.logger = logging.getLogger('engine.Scheduler')
+        self._local_scheduler = local_scheduler
+        self._drmaa_scheduler = drmaa_scheduler
+        self._local_max_duration = local_max_duration
+        self._local_queue = local_queue
+        self._job_scheduler = {}
+        self.parallel_job_submission_info \
+            = drmaa_scheduler.parallel_job_submission_info
+
+    def is_local(self, job):
+        '''
+        * job *EngineJob*
+
+        * returns: *boolean*
+            True if the job runs on the local scheduler.
+        '''
+        if job.is_barrier:
+            return True
+        if self._local_queue and job.queue == self._local_queue:
+            return True
+        if job.parallel_job_info or job.native_specification:
+            return False
+        duration = expected_duration(job)
+        return self._local_max_duration is not None \
+            and duration is not None \
+            and duration <= self._local_max_duration
+
+    def _scheduler(self, scheduler_job_id):
+        return self._job_scheduler.get(scheduler_job_id,
+                                       self._drmaa_scheduler)
+
+    def sleep(self):
+        self._drmaa_scheduler.sleep()
+        self._local_scheduler.sleep()
+        self.is_sleeping = True
+
+    def wake(self):
+        self._drmaa_scheduler.wake()
+        self._local_scheduler.wake()
+        self.is_sleeping = False
+
+    def clean(self):
+        self._drmaa_scheduler.clean()
+        self._local_scheduler.clean()
+
+    def end_scheduler_thread(self):
+        self._local_scheduler.end_scheduler_thread()
+
+    def job_submission(self, job):
+        '''
+        * job *EngineJob*
+        * return: *string*
+            Job id for the scheduling system (DRMAA for example)
+        '''
+        if self.is_local(job):
+            scheduler = self._local_scheduler
+        else:
+            scheduler = self._drmaa_scheduler
+            if self.is_sleeping:
+                self.wake()
+        scheduler_job_id = scheduler.job_submission(job)
+        self.logger.debug("job %s submitted to %s: %s"
+                          % (repr(job.job_id), type(scheduler).__name__,
+                             repr(scheduler_job_id)))
+        self._job_scheduler[scheduler_job_id] = scheduler
+        return scheduler_job_id
+
+    def get_job_status(self, scheduler_job_id):
+        '''
+        * scheduler_job_id *string*
+            Job id for the scheduling system (DRMAA for example)
+        * return: *string*
+            Job status as defined in constants.JOB_STATUS
+        '''
+        return self._scheduler(scheduler_job_id).get_job_status(
+            scheduler_job_id)
+
+    def get_job_exit_info(self, scheduler_job_id):
+        '''
+        * scheduler_job_id *string*
+            Job id for the scheduling system (DRMAA for example)
+        * return: *tuple*
+            exit_status, exit_value, term_sig, resource_usage
+        '''
+        exit_info = self._scheduler(scheduler_job_id).get_job_exit_info(
+            scheduler_job_id)
+        self._job_scheduler.pop(scheduler_job_id, None)
+        return exit_info
+
+    def kill_job(self, scheduler_job_id):
+        '''
+        * scheduler_job_id *string*
+            Job id for the scheduling system (DRMAA for example)
+        '''
+        self._scheduler(scheduler_job_id).kill_job(scheduler_job_id)
+
+    def release_job(self, scheduler_job_id):
+        '''
+        * scheduler_job_id *string*
+            Job id for the scheduling system (DRMAA for example)
+        '''
+        self._scheduler(scheduler_job_id).release_job(scheduler_job_id)
+        self._job_scheduler.pop(scheduler_job_id, None)
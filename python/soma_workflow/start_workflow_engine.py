@@ -208,14 +208,13 @@ if __name__ == "__main__":
         if config.get_scheduler_type() \
                 == soma_workflow.configuration.DRMAA_SCHEDULER:
 
-            if not soma_workflow.scheduler.DRMAA_LIB_FOUND:
+            if config.get_drmaa_implementation() \
+                    != soma_workflow.configuration.FAKE_DRMAA_IMPLEMENTATION \
+                    and not soma_workflow.scheduler.DRMAA_LIB_FOUND:
                 raise NoDrmaaLibError
 
-            sch = soma_workflow.scheduler.DrmaaCTypes(
-                config.get_drmaa_implementation(),
-                config.get_parallel_job_config(),
-                os.path.expanduser("~"),
-                configured_native_spec=config.get_native_specification())
+            sch = soma_workflow.scheduler.DrmaaCTypes.from_config(
+                config, os.path.expanduser("~"))
             database_server = get_database_server_proxy(config, logger)
 
         elif config.get_scheduler_type() \
@@ -231,6 +230,34 @@ if __name__ == "__main__":
             database_server = get_database_server_proxy(config, logger)
             config.set_scheduler_config(local_scheduler_config)
 
+        elif config.get_scheduler_type() \
+                == soma_workflow.configuration.HYBRID_SCHEDULER:
+            if config.get_drmaa_implementation() \
+                    != soma_workflow.configuration.FAKE_DRMAA_IMPLEMENTATION \
+                    and not soma_workflow.scheduler.DRMAA_LIB_FOUND:
+                raise NoDrmaaLibError
+
+            local_scheduler_cfg_file_path \
+                = LocalSchedulerCfg.search_config_path()
+            if local_scheduler_cfg_file_path:
+                local_scheduler_config = LocalSchedulerCfg.load_from_file(
+                    local_scheduler_cfg_file_path)
+            else:
+                local_scheduler_config = LocalSchedulerCfg()
+            sch = soma_workflow.scheduler.HybridScheduler(
+                ConfiguredLocalScheduler(local_scheduler_config),
+                soma_workflow.scheduler.DrmaaCTypes.from_config(
+                    config, os.path.expanduser("~")),
+                **config.get_hybrid_config())
+            database_server = get_database_server_proxy(config, logger)
+            config.set_scheduler_config(local_scheduler_config)
+
+        elif config.get_scheduler_type() \
+                == soma_workflow.configuration.SIMULATED_SCHEDULER:
+            sch = soma_workflow.scheduler.SimulatedScheduler(
+                **config.get_simulation_config())
+            database_server = get_database_server_proxy(config, logger)
+
         elif config.get_scheduler_type() \
                 == soma_workflow.configuration.MPI_SCHEDULER:
             sch = None
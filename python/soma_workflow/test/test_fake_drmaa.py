@@ -0,0 +1,98 @@
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from soma_workflow.client import Job
+from soma_workflow.engine_types import EngineJob
+from soma_workflow.scheduler import DrmaaCTypes
+from soma_workflow.fake_drmaa import FakeSessionFactory
+import soma_workflow.constants as constants
+
+
+class FakeDrmaaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="swf_fakedrmaa")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_jobs(self, scheduler, nb_jobs):
+        drmaa_ids = []
+        for job_id in range(1, nb_jobs + 1):
+            job = EngineJob(Job(command=['ls'], name='job%d' % job_id),
+                            queue=None)
+            job.job_id = job_id
+            job.stdout_file = os.path.join(self.directory, 'out%d' % job_id)
+            drmaa_ids.append(scheduler.job_submission(job))
+        exit_info = {}
+        while drmaa_ids:
+            for drmaa_id in list(drmaa_ids):
+                if scheduler.get_job_status(drmaa_id) in (constants.DONE,
+                                                          constants.FAILED):
+                    exit_info[drmaa_id] \
+                        = scheduler.get_job_exit_info(drmaa_id)
+                    drmaa_ids.remove(drmaa_id)
+        return exit_info
+
+    def test_jobs(self):
+        factory = FakeSessionFactory(failures="job=0.5", seed=0)
+        scheduler = DrmaaCTypes(None, None, self.directory,
+                                session_factory=factory)
+        exit_info = self.run_jobs(scheduler, 200)
+        self.assertEqual(len(exit_info), 200)
+        exit_values = [info[1] for info in exit_info.values()]
+        self.assertTrue(0 < exit_values.count(1) < 200)
+        self.assertEqual(exit_values.count(0) + exit_values.count(1), 200)
+        for info in exit_info.values():
+            self.assertEqual(info[0], constants.FINISHED_REGULARLY)
+            self.assertTrue('wallclock=' in info[3])
+        # the job templates are reused
+        self.assertEqual(factory.sessions[0].calls['createJobTemplate'], 1)
+        self.assertEqual(len(factory.jobs), 0)
+
+    def test_template_deletion_failure(self):
+        factory = FakeSessionFactory(failures="deleteJobTemplate=1")
+        scheduler = DrmaaCTypes(None, None, self.directory,
+                                session_factory=factory)
+        scheduler.TEMPLATE_CACHE_SIZE = 1
+        for job_id in range(1, 5):
+            # two signatures: the templates are evicted in turn
+            job = EngineJob(Job(command=['ls'], name='job%d' % job_id,
+                                join_stderrout=bool(job_id % 2)),
+                            queue=None)
+            job.job_id = job_id
+            job.stdout_file = os.path.join(self.directory, 'out%d' % job_id)
+            self.assertTrue(scheduler.job_submission(job))
+        self.assertEqual(factory.sessions[0].calls['deleteJobTemplate'], 3)
+
+    def test_session_recycling(self):
+        factory = FakeSessionFactory(failures="session=0.01", seed=0)
+        scheduler = DrmaaCTypes(None, None, self.directory,
+                                session_factory=factory)
+        exit_info = self.run_jobs(scheduler, 200)
+        self.assertEqual(len(exit_info), 200)
+        self.assertTrue(len(factory.sessions) > 1)
+
+    def test_keep_session(self):
+        factory = FakeSessionFactory()
+        scheduler = DrmaaCTypes(None, None, self.directory,
+                                keep_session=True,
+                                session_factory=factory)
+        self.run_jobs(scheduler, 1)
+        scheduler.sleep()
+        self.run_jobs(scheduler, 1)
+        self.assertEqual(len(factory.sessions), 1)
+        scheduler = DrmaaCTypes(None, None, self.directory,
+                                session_factory=factory)
+        self.run_jobs(scheduler, 1)
+        scheduler.sleep()
+        self.run_jobs(scheduler, 1)
+        self.assertEqual(len(factory.sessions), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
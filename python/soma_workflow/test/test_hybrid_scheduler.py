@@ -0,0 +1,66 @@
+from __future__ import print_function
+
+import sys
+import shutil
+import tempfile
+import unittest
+
+from soma_workflow.client import Job, BarrierJob
+from soma_workflow.engine_types import EngineJob
+from soma_workflow.scheduler import DrmaaCTypes, LocalScheduler, \
+    HybridScheduler
+from soma_workflow.fake_drmaa import FakeSessionFactory
+import soma_workflow.constants as constants
+
+
+class HybridSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="swf_hybrid")
+        self.local_scheduler = LocalScheduler(proc_nb=2, interval=0.01)
+        self.drmaa_scheduler = DrmaaCTypes(
+            None, None, self.directory, session_factory=FakeSessionFactory())
+        self.scheduler = HybridScheduler(self.local_scheduler,
+                                         self.drmaa_scheduler,
+                                         local_max_duration=10.)
+
+    def tearDown(self):
+        self.scheduler.end_scheduler_thread()
+        shutil.rmtree(self.directory)
+
+    def test_routing(self):
+        command = [sys.executable, '-c', 'pass']
+        jobs = [(BarrierJob(), True),
+                (Job(command=command, user_storage={'duration': 2}), True),
+                (Job(command=command, user_storage={'duration': 2},
+                     native_specification='-l walltime=1:00:00'), False),
+                (Job(command=command, user_storage={'duration': 600}), False),
+                (Job(command=command), False),
+                (Job(command=command, user_storage={'duration': 600}), True)]
+        scheduler_ids = []
+        for job_id, (client_job, local) in enumerate(jobs, 1):
+            queue = None
+            if job_id == 6:
+                queue = 'local'
+            job = EngineJob(client_job, queue=queue)
+            job.job_id = job_id
+            job.stdout_file = self.directory + '/out%d' % job_id
+            self.assertEqual(self.scheduler.is_local(job), local)
+            scheduler_ids.append(self.scheduler.job_submission(job))
+        self.assertEqual(
+            [job_id in self.local_scheduler._status
+             for job_id in scheduler_ids],
+            [local for client_job, local in jobs])
+        while scheduler_ids:
+            for scheduler_id in list(scheduler_ids):
+                status = self.scheduler.get_job_status(scheduler_id)
+                if status in (constants.DONE, constants.FAILED):
+                    exit_info = self.scheduler.get_job_exit_info(scheduler_id)
+                    self.assertEqual(exit_info[0],
+                                     constants.FINISHED_REGULARLY)
+                    scheduler_ids.remove(scheduler_id)
+        self.assertEqual(self.scheduler._job_scheduler, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+from __future__ import print_function
+
+import sys
+import time
+import unittest
+
+from soma_workflow.client import Job, BarrierJob
+from soma_workflow.engine_types import EngineJob
+from soma_workflow.scheduler import JobQueue, LocalScheduler, \
+    LoadAdmissionController
+import soma_workflow.constants as constants
+
+
+class JobQueueTest(unittest.TestCase):
+
+    def test_order(self):
+        queue = JobQueue()
+        for job_id in range(10):
+            queue.push(job_id, job_id % 3)
+        queue.remove(5)
+        queue.remove(2)
+        self.assertFalse(5 in queue)
+        self.assertTrue(8 in queue)
+        self.assertEqual(len(queue), 8)
+        job_ids = []
+        while queue:
+            job_ids.append(queue.pop())
+        # highest priority first, submission order within a priority
+        self.assertEqual(job_ids, [8, 1, 4, 7, 0, 3, 6, 9])
+        self.assertRaises(KeyError, queue.pop)
+
+    def test_compaction(self):
+        queue = JobQueue()
+        for job_id in range(1000):
+            queue.push(job_id)
+        for job_id in range(0, 1000, 4):
+            queue.remove(job_id)
+        for job_id in range(1, 1000, 4):
+            queue.remove(job_id)
+        for job_id in range(2, 1000, 4):
+            queue.remove(job_id)
+        self.assertTrue(len(queue._heap) < 1000)
+        self.assertEqual([queue.pop() for i in range(len(queue))],
+                         list(range(3, 1000, 4)))
+
+
+class FixedLoadController(LoadAdmissionController):
+
+    def __init__(self):
+        super(FixedLoadController, self).__init__()
+        # idle CPUs, pressure, available memory, total memory
+        self.load = (4., 0., 8000., 10000.)
+
+    def _read_load(self):
+        return self.load
+
+
+class LoadAdmissionControllerTest(unittest.TestCase):
+
+    def test_reservations(self):
+        controller = FixedLoadController()
+        now = 1000.
+        admitted = 0
+        while controller.admit(now):
+            admitted += 1
+        # 4 idle CPUs: one job per idle CPU
+        self.assertEqual(admitted, 4)
+        # the reservations decay, but the signal did not change: an idle
+        # CPU is left for one more job after a while.
+        self.assertTrue(controller.admit(now + 5 * controller.RESERVATION_TIME))
+
+    def test_memory(self):
+        controller = FixedLoadController()
+        # jobs of 3 kB (3072 bytes), 8000 bytes available, 500 bytes margin
+        controller.job_ended({'ru_maxrss': 3})
+        now = 1000.
+        self.assertTrue(controller.admit(now))
+        self.assertTrue(controller.admit(now))
+        self.assertFalse(controller.admit(now))
+
+    def test_hysteresis(self):
+        controller = FixedLoadController()
+        now = 1000.
+        controller.load = (4., 90., 8000., 10000.)
+        for i in range(20):
+            now += controller.SAMPLE_INTERVAL
+            controller.sample(now)
+        self.assertFalse(controller.admit(now))
+        # between the low and high thresholds: still overloaded
+        controller.load = (4., 30., 8000., 10000.)
+        for i in range(20):
+            now += controller.SAMPLE_INTERVAL
+            controller.sample(now)
+        self.assertFalse(controller.admit(now))
+        controller.load = (4., 5., 8000., 10000.)
+        for i in range(20):
+            now += controller.SAMPLE_INTERVAL
+            controller.sample(now)
+        self.assertTrue(controller.admit(now))
+
+    def test_unknown_cpu(self):
+        controller = FixedLoadController()
+        controller._cpu_measurable = True
+        controller.load = (None, 0., 8000., 10000.)
+        now = 1000.
+        # no burst of admissions before the first CPU measure
+        self.assertFalse(controller.admit(now))
+        controller.load = (4., 0., 8000., 10000.)
+        now += controller.SAMPLE_INTERVAL
+        self.assertTrue(controller.admit(now))
+        # the idle CPUs can not be measured on the system
+        controller = FixedLoadController()
+        controller._cpu_measurable = False
+        controller.load = (None, 0., 8000., 10000.)
+        self.assertTrue(controller.admit(1000.))
+
+
+class LocalSchedulerTablesTest(unittest.TestCase):
+
+    '''
+    Soak test: the scheduler must not keep any record of the jobs once the
+    engine got their exit information, or released them after a kill.
+    '''
+
+    def setUp(self):
+        self.scheduler = LocalScheduler(proc_nb=4, interval=0.01)
+
+    def tearDown(self):
+        self.scheduler.end_scheduler_thread()
+
+    def tables_sizes(self):
+        scheduler = self.scheduler
+        with scheduler._lock:
+            return (len(scheduler._queue), len(scheduler._jobs),
+                    len(scheduler._processes), len(scheduler._status),
+                    len(scheduler._exit_info), len(scheduler._timing))
+
+    def submit(self, client_job, job_id):
+        job = EngineJob(client_job, queue=None)
+        job.job_id = job_id
+        return self.scheduler.job_submission(job)
+
+    def wait_end(self, job_ids):
+        ended = 0
+        while job_ids:
+            for job_id in list(job_ids):
+                status = self.scheduler.get_job_status(job_id)
+                if status in (constants.DONE, constants.FAILED):
+                    self.scheduler.get_job_exit_info(job_id)
+                    job_ids.remove(job_id)
+                    ended += 1
+            time.sleep(0.01)
+        return ended
+
+    def test_tables_stay_empty(self):
+        job_id = 0
+        for batch in range(5):
+            job_ids = set()
+            for i in range(400):
+                job_id += 1
+                job_ids.add(self.submit(BarrierJob(), job_id))
+            for i in range(4):
+                job_id += 1
+                job_ids.add(self.submit(Job(command=[sys.executable, '-c',
+                                                     'pass']),
+                                        job_id))
+            self.assertEqual(self.wait_end(job_ids), 404)
+            self.assertEqual(self.tables_sizes(), (0, 0, 0, 0, 0, 0))
+
+    def test_killed_jobs_released(self):
+        job_ids = [self.submit(Job(command=[sys.executable, '-c',
+                                            'import time; time.sleep(30)']),
+                               job_id)
+                   for job_id in range(1, 11)]
+        for job_id in job_ids:
+            self.scheduler.kill_job(job_id)
+            self.scheduler.release_job(job_id)
+        self.assertEqual(self.tables_sizes(), (0, 0, 0, 0, 0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,291 @@
+from __future__ import print_function
+
+import sys
+import time
+import types
+import threading
+import unittest
+
+from soma_workflow.client import Job, TemporaryPath
+from soma_workflow.engine_types import EngineJob
+import soma_workflow.constants as constants
+
+
+class StubStatus(object):
+
+    def __init__(self):
+        self.source = None
+        self.tag = None
+
+    def Get_source(self):
+        return self.source
+
+    def Get_tag(self):
+        return self.tag
+
+
+# mpi4py stand-in: the module is imported with it, mpi4py is not needed to
+# run the tests.
+stub_MPI = types.ModuleType('mpi4py.MPI')
+stub_MPI.ANY_SOURCE = -1
+stub_MPI.ANY_TAG = -1
+stub_MPI.Status = StubStatus
+stub_MPI.Get_processor_name = lambda: 'localhost'
+stub_mpi4py = types.ModuleType('mpi4py')
+stub_mpi4py.MPI = stub_MPI
+
+saved_modules = dict([(name, sys.modules.get(name))
+                      for name in ('mpi4py', 'mpi4py.MPI')])
+sys.modules['mpi4py'] = stub_mpi4py
+sys.modules['mpi4py.MPI'] = stub_MPI
+try:
+    from soma_workflow.MPI_workflow_runner import MPIScheduler, slave_loop
+finally:
+    for name, module in saved_modules.items():
+        if module is None:
+            del sys.modules[name]
+        else:
+            sys.modules[name] = module
+
+
+class StubCommunicator(object):
+
+    '''
+    Communicator of one rank: the tests put the messages received by the
+    rank in inbox, and read the messages it sent in outbox.
+    '''
+
+    def __init__(self, rank=0, size=3):
+        self.rank = rank
+        self.size = size
+        # list of (source, tag, data)
+        self.inbox = []
+        # list of (dest, tag, data)
+        self.outbox = []
+        self.lock = threading.Lock()
+
+    def Get_rank(self):
+        return self.rank
+
+    def _match(self, source, tag):
+        for message in self.inbox:
+            if source in (stub_MPI.ANY_SOURCE, message[0]) and \
+                    tag in (stub_MPI.ANY_TAG, message[1]):
+                return message
+        return None
+
+    def Iprobe(self, source, tag, status):
+        with self.lock:
+            message = self._match(source, tag)
+            if message is None:
+                return False
+            status.source, status.tag = message[:2]
+            return True
+
+    def recv(self, source, tag):
+        with self.lock:
+            message = self._match(source, tag)
+            self.inbox.remove(message)
+            return message[2]
+
+    def send(self, data, dest, tag):
+        with self.lock:
+            self.outbox.append((dest, tag, data))
+
+    def put(self, source, tag, data):
+        with self.lock:
+            self.inbox.append((source, tag, data))
+
+    def wait_message(self, dest, tag, timeout=10.):
+        '''
+        Remove from outbox and return the data of the first message sent to
+        dest with the tag.
+        '''
+        start = time.time()
+        while time.time() - start < timeout:
+            with self.lock:
+                for message in self.outbox:
+                    if message[0] == dest and message[1] == tag:
+                        self.outbox.remove(message)
+                        return message[2]
+            time.sleep(0.005)
+        raise AssertionError("no message %d to rank %d" % (tag, dest))
+
+
+class StubEnginePath(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def get_engine_path(self):
+        return self.path
+
+
+class MPISchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.communicator = StubCommunicator(size=4)
+        self.scheduler = MPIScheduler(
+            self.communicator, poll_interval=0.001,
+            hosts=['master', 'hostA', 'hostA', 'hostB'], locality_wait=0.2)
+        self.job_id = 0
+
+    def tearDown(self):
+        self.scheduler.end_scheduler_thread()
+
+    def submit(self, temporary_path=None, output=False):
+        '''
+        Submit a job which reads (or writes, if output is set) the
+        temporary_path file.
+        '''
+        self.job_id += 1
+        kwargs = {}
+        transfer_mapping = None
+        if temporary_path is not None:
+            temporary = TemporaryPath()
+            transfer_mapping = {temporary: StubEnginePath(temporary_path)}
+            if output:
+                kwargs['referenced_output_files'] = [temporary]
+            else:
+                kwargs['referenced_input_files'] = [temporary]
+        job = EngineJob(Job(command=['true'], **kwargs), queue=None,
+                        transfer_mapping=transfer_mapping)
+        job.job_id = self.job_id
+        self.scheduler.job_submission(job)
+        return job
+
+    def request(self, rank, slots=2, free_slots=2):
+        '''
+        Job request of a slave, returns the list of the jobs sent.
+        '''
+        self.communicator.put(rank, MPIScheduler.JOB_REQUEST,
+                              {"slots": slots, "free_slots": free_slots})
+        start = time.time()
+        while time.time() - start < 10.:
+            with self.communicator.lock:
+                for dest, tag, data in list(self.communicator.outbox):
+                    if dest == rank and tag in (MPIScheduler.JOB_SENDING,
+                                                MPIScheduler.NO_JOB):
+                        self.communicator.outbox.remove((dest, tag, data))
+                        if tag == MPIScheduler.NO_JOB:
+                            return []
+                        return data
+            time.sleep(0.005)
+        raise AssertionError("no answer to the job request")
+
+    def test_batch_size(self):
+        for i in range(100):
+            self.submit()
+        # no job ended yet: one job per slot
+        self.assertEqual(len(self.request(1, slots=2)), 2)
+        with self.scheduler._lock:
+            # short jobs: BATCH_TIME of work per slot
+            self.scheduler._mean_duration = 0.25
+            self.scheduler._rank_slots[2] = 2
+            self.assertEqual(self.scheduler._batch_size(2, 2), 16)
+            # the jobs already sent are deduced
+            self.assertEqual(self.scheduler._batch_size(1, 2), 14)
+            # bounded by the fair share of the queue between the 3 slaves
+            self.scheduler._mean_duration = 0.001
+            self.assertEqual(self.scheduler._batch_size(2, 2), 33)
+            # long jobs: the free slots are filled
+            self.scheduler._mean_duration = 100.
+            self.assertEqual(self.scheduler._batch_size(1, 2), 2)
+        jobs = self.request(2, slots=2)
+        self.assertEqual(len(jobs), 2)
+        for job in jobs:
+            self.assertEqual(self.scheduler.get_job_status(job.job_id),
+                             constants.RUNNING)
+        self.assertEqual(self.scheduler.queued_job_count(), 96)
+
+    def test_locality(self):
+        writer = self.submit("/tmp/swf_temporary", output=True)
+        with self.scheduler._lock:
+            self.scheduler._queue.remove(writer.job_id)
+            # written on hostB (rank 3)
+            self.scheduler._record_temporary_outputs(writer, 3)
+        reader = self.submit("/tmp/swf_temporary")
+        other = self.submit()
+        # the reader waits for a slave of hostB
+        self.assertEqual([job.job_id for job in self.request(1)],
+                         [other.job_id])
+        self.assertEqual(self.request(2), [])
+        self.assertEqual([job.job_id for job in self.request(3)],
+                         [reader.job_id])
+
+        # after locality_wait, any slave gets it
+        reader = self.submit("/tmp/swf_temporary")
+        self.assertEqual(self.request(1), [])
+        time.sleep(self.scheduler.locality_wait)
+        self.assertEqual([job.job_id for job in self.request(1)],
+                         [reader.job_id])
+
+    def test_steal(self):
+        jobs = [self.submit() for i in range(13)]
+        with self.scheduler._lock:
+            # rank 1: 2 slots, 10 jobs, rank 2: 2 slots, 3 jobs
+            for rank, nb_jobs in ((1, 10), (2, 3)):
+                self.scheduler._rank_slots[rank] = 2
+                self.scheduler._rank_jobs[rank] = set(
+                    self.scheduler._select_jobs(rank, nb_jobs))
+        self.assertEqual(self.scheduler.queued_job_count(), 0)
+        # an idle slave asks for jobs: the slave with the most waiting jobs
+        # gives back half of them
+        self.assertEqual(self.request(3, slots=2), [])
+        self.assertEqual(
+            self.communicator.wait_message(1, MPIScheduler.JOB_STEAL), 4)
+        # not asked again until it answers
+        self.assertEqual(self.request(3, slots=2), [])
+        self.assertEqual(
+            self.communicator.wait_message(2, MPIScheduler.JOB_STEAL), 1)
+
+        returned = [job.job_id for job in jobs[6:10]]
+        self.communicator.put(1, MPIScheduler.JOB_RETURN, returned)
+        self.assertEqual([job.job_id for job
+                          in self.request(3, slots=4, free_slots=4)],
+                         returned)
+        with self.scheduler._lock:
+            self.assertEqual(len(self.scheduler._rank_jobs[1]), 6)
+            self.assertFalse(1 in self.scheduler._steal_requests)
+
+
+class SlaveLoopTest(unittest.TestCase):
+
+    def test_slots_and_steal(self):
+        communicator = StubCommunicator(rank=1)
+        jobs = []
+        for job_id in range(1, 5):
+            job = EngineJob(Job(command=[sys.executable, '-c',
+                                         'import time; time.sleep(0.3)']),
+                            queue=None)
+            job.job_id = job_id
+            jobs.append(job)
+        communicator.put(0, MPIScheduler.JOB_SENDING, jobs)
+        # the last waiting job is given back
+        communicator.put(0, MPIScheduler.JOB_STEAL, 1)
+        thread = threading.Thread(target=slave_loop, args=(communicator,),
+                                  kwargs={'slots': 2, 'poll_interval': 0.01})
+        thread.start()
+        try:
+            request = communicator.wait_message(0, MPIScheduler.JOB_REQUEST)
+            self.assertEqual(request, {"slots": 2, "free_slots": 2})
+            self.assertEqual(
+                communicator.wait_message(0, MPIScheduler.JOB_RETURN), [4])
+            ended = {}
+            while len(ended) < 3:
+                ended.update(communicator.wait_message(
+                    0, MPIScheduler.JOB_RESULT))
+            self.assertEqual(sorted(ended), [1, 2, 3])
+            for job_status, exit_info in ended.values():
+                self.assertEqual(job_status, constants.DONE)
+                self.assertEqual(exit_info[:2],
+                                 (constants.FINISHED_REGULARLY, 0))
+        finally:
+            communicator.put(0, MPIScheduler.EXIT_SIGNAL, 'STOP')
+            thread.join()
+        self.assertEqual(
+            communicator.wait_message(0, MPIScheduler.EXIT_SIGNAL), 'STOP')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,564 @@
+from __future__ import print_function
+
+import io
+import os
+import time
+import tarfile
+import shutil
+import stat
+import hashlib
+import tempfile
+import datetime
+import threading
+import unittest
+
+from soma_workflow.client import FileTransfer, WorkflowController
+from soma_workflow.database_server import WorkflowDatabaseServer
+from soma_workflow.engine import WorkflowEngine
+from soma_workflow.engine_types import EngineTransfer
+from soma_workflow.errors import TransferError
+from soma_workflow.scheduler import LocalScheduler
+import soma_workflow.constants as constants
+from soma_workflow.transfer import RemoteFileController, \
+    PortableRemoteTransfer, StreamHash, file_hash, ParallelTransferExecutor, \
+    ChunkCompressor, unpack_files, clean_transfer_store
+
+
+class SlowFileController(RemoteFileController):
+
+    '''
+    RemoteFileController with a latency on each chunk call, which records
+    the maximum number of calls in flight, and the progress of the
+    transfers.
+    '''
+
+    def __init__(self, latency=0.01):
+        super(SlowFileController, self).__init__()
+        self.latency = latency
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.transmitted = {}
+        self.lock = threading.Lock()
+
+    def _slow_call(self, function, *args):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.latency)
+        try:
+            return function(*args)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def write_chunk(self, session_id, offset, data, compressed=False):
+        return self._slow_call(
+            super(SlowFileController, self).write_chunk,
+            session_id, offset, data, compressed)
+
+    def read_chunk(self, session_id, offset, buffer_size):
+        return self._slow_call(
+            super(SlowFileController, self).read_chunk,
+            session_id, offset, buffer_size)
+
+    def _transfer_progress(self, transfer_id, size, ended=False):
+        with self.lock:
+            self.transmitted[transfer_id] = \
+                self.transmitted.get(transfer_id, 0) + size
+
+
+class PortableRemoteTransferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="swf_transfer")
+        self.controller = SlowFileController()
+        self.transfer = PortableRemoteTransfer(self.controller, window=4)
+
+    def tearDown(self):
+        self.transfer.close()
+        shutil.rmtree(self.directory)
+
+    def make_file(self, path, size):
+        data = os.urandom(size)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return data
+
+    def read_file(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_file_round_trip(self):
+        path = os.path.join(self.directory, "local")
+        remote_path = os.path.join(self.directory, "remote", "file")
+        back_path = os.path.join(self.directory, "back")
+        data = self.make_file(path, 10000)
+        self.transfer.transfer_to_remote(path, remote_path, buffer_size=512)
+        self.assertEqual(self.read_file(remote_path), data)
+        self.assertEqual(self.controller.max_in_flight, 4)
+        self.controller.max_in_flight = 0
+        self.transfer.transfer_from_remote(remote_path, back_path,
+                                           buffer_size=512)
+        self.assertEqual(self.read_file(back_path), data)
+        self.assertEqual(self.controller.max_in_flight, 4)
+        self.assertEqual(self.controller._transfer_sessions, {})
+
+    def test_stream_hash(self):
+        path = os.path.join(self.directory, "file")
+        data = self.make_file(path, 1000)
+        stream_hash = StreamHash('sha1')
+        for offset in (300, 100, 0, 200, 900, 400, 500, 600, 800, 700):
+            stream_hash.update(offset, data[offset:offset + 100])
+        self.assertEqual(stream_hash.hexdigest(), file_hash(path, 'sha1'))
+        self.assertEqual(stream_hash._pending, {})
+
+    def test_hash_mismatch(self):
+        path = os.path.join(self.directory, "local")
+        remote_path = os.path.join(self.directory, "remote")
+        self.make_file(path, 1000)
+
+        def corrupted_write_chunk(session_id, offset, data):
+            return RemoteFileController.write_chunk(
+                self.controller, session_id, offset, b'x' * len(data))
+
+        self.controller.write_chunk = corrupted_write_chunk
+        self.assertRaises(TransferError, self.transfer.transfer_to_remote,
+                          path, remote_path, buffer_size=100)
+
+    def test_empty_file(self):
+        path = os.path.join(self.directory, "empty")
+        remote_path = os.path.join(self.directory, "remote_empty")
+        self.make_file(path, 0)
+        self.transfer.transfer_to_remote(path, remote_path)
+        self.assertEqual(self.read_file(remote_path), b"")
+
+    def test_directory(self):
+        path = os.path.join(self.directory, "dir")
+        os.makedirs(os.path.join(path, "sub", "subsub"))
+        data = self.make_file(os.path.join(path, "sub", "a"), 3000)
+        data2 = self.make_file(os.path.join(path, "sub", "subsub", "b"), 10)
+        remote_path = os.path.join(self.directory, "remote_dir")
+        self.transfer.transfer_to_remote(path, remote_path, buffer_size=256)
+        self.assertEqual(
+            self.read_file(os.path.join(remote_path, "sub", "a")), data)
+        self.assertEqual(
+            self.read_file(os.path.join(remote_path, "sub", "subsub", "b")),
+            data2)
+
+    def test_pipelines_reused(self):
+        path = os.path.join(self.directory, "dir")
+        os.mkdir(path)
+        for i in range(20):
+            self.make_file(os.path.join(path, str(i)), 2000)
+        self.transfer.small_file_size = 0
+        nb_threads = threading.active_count()
+        self.transfer.transfer_to_remote(
+            path, os.path.join(self.directory, "remote_dir"), buffer_size=256)
+        self.transfer.transfer_to_remote(
+            path, os.path.join(self.directory, "remote_dir2"),
+            buffer_size=256)
+        # one pipeline per stream, not per file
+        self.assertTrue(0 < len(self.transfer._pipelines)
+                        <= self.transfer.nb_streams)
+        self.assertEqual(threading.active_count() - nb_threads,
+                         len(self.transfer._pipelines) * self.transfer.window)
+        self.transfer.close()
+        self.assertEqual(threading.active_count(), nb_threads)
+
+    def test_parallel_executor(self):
+        started = []
+        progress = []
+        lock = threading.Lock()
+
+        def transfer(name, progress=None):
+            with lock:
+                started.append(name)
+            time.sleep(0.01)
+            if name == "reporting":
+                progress(10)
+                progress(20)
+
+        executor = ParallelTransferExecutor(nb_streams=1,
+                                            progress=progress.append)
+        for size, name in ((1, "small"), (30, "reporting"), (100, "large")):
+            executor.add(size, transfer, name)
+        executor.run()
+        self.assertEqual(started, ["large", "reporting", "small"])
+        self.assertEqual(progress, [100, 10, 20, 1])
+        self.assertEqual(executor.transfered_size, executor.total_size)
+
+        def failing_transfer(name, progress=None):
+            raise IOError(name)
+
+        executor = ParallelTransferExecutor(nb_streams=3)
+        for size in range(5):
+            executor.add(size, failing_transfer, "file%d" % size)
+        executor.add(10, transfer, "other")
+        self.assertRaises(IOError, executor.run)
+        self.assertTrue("other" in started)
+
+    def test_directory_from_remote(self):
+        remote_path = os.path.join(self.directory, "remote_dir")
+        os.makedirs(os.path.join(remote_path, "sub"))
+        data = {}
+        for i in range(10):
+            data[i] = self.make_file(
+                os.path.join(remote_path, "sub", "f%d" % i), 100 * i)
+        path = os.path.join(self.directory, "dir")
+        sizes = []
+        self.transfer.transfer_from_remote(remote_path, path,
+                                           buffer_size=128,
+                                           progress=sizes.append)
+        for i in range(10):
+            self.assertEqual(
+                self.read_file(os.path.join(path, "sub", "f%d" % i)), data[i])
+        self.assertEqual(sum(sizes), 4500)
+
+    def test_resume_to_remote(self):
+        path = os.path.join(self.directory, "local")
+        remote_path = os.path.join(self.directory, "remote")
+        data = self.make_file(path, 10000)
+        # interrupted transfer, the end of the last chunk is corrupted
+        with open(remote_path, 'wb') as f:
+            f.write(data[:6100] + b'x' * 500)
+        sizes = []
+        self.transfer.transfer_to_remote(path, remote_path, buffer_size=512,
+                                         progress=sizes.append,
+                                         transfer_id="tr")
+        self.assertEqual(self.read_file(remote_path), data)
+        # 11 verified chunks
+        self.assertEqual(sizes[0], 11 * 512)
+        self.assertEqual(sum(sizes), 10000)
+        self.assertEqual(self.controller.transmitted, {"tr": 10000})
+
+        # the remote file is longer than the local one
+        data = self.make_file(path, 3000)
+        with open(remote_path, 'ab') as f:
+            f.write(b'x' * 100)
+        self.transfer.transfer_to_remote(path, remote_path, buffer_size=512)
+        self.assertEqual(self.read_file(remote_path), data)
+
+    def test_resume_from_remote(self):
+        remote_path = os.path.join(self.directory, "remote")
+        path = os.path.join(self.directory, "local")
+        data = self.make_file(remote_path, 5000)
+        with open(path, 'wb') as f:
+            f.write(data[:2048] + b'x' * 10000)
+        sizes = []
+        self.transfer.transfer_from_remote(remote_path, path,
+                                           buffer_size=512,
+                                           progress=sizes.append)
+        self.assertEqual(self.read_file(path), data)
+        self.assertEqual(sizes[0], 2048)
+        self.assertEqual(sum(sizes), 5000)
+
+        self.transfer.resume = False
+        sizes = []
+        self.transfer.transfer_from_remote(remote_path, path,
+                                           buffer_size=512,
+                                           progress=sizes.append)
+        self.assertEqual(self.read_file(path), data)
+        self.assertEqual(sizes[0], 512)
+
+    def test_compression(self):
+        path = os.path.join(self.directory, "local")
+        remote_path = os.path.join(self.directory, "remote")
+        back_path = os.path.join(self.directory, "back")
+        data = b"soma-workflow compresses text\n" * 1000
+        with open(path, 'wb') as f:
+            f.write(data)
+        transfer = PortableRemoteTransfer(self.controller,
+                                          compression_level=6)
+        transfer.transfer_to_remote(path, remote_path, buffer_size=4096)
+        transfer.transfer_from_remote(remote_path, back_path,
+                                      buffer_size=4096)
+        self.assertEqual(self.read_file(remote_path), data)
+        self.assertEqual(self.read_file(back_path), data)
+        self.assertEqual(transfer.raw_size, 2 * len(data))
+        self.assertTrue(transfer.wire_size < transfer.raw_size / 10)
+
+        # older remote side: no compression
+        def get_transfer_compressions():
+            raise AttributeError("get_transfer_compressions")
+
+        self.controller.get_transfer_compressions = get_transfer_compressions
+        transfer = PortableRemoteTransfer(self.controller,
+                                          compression_level=6)
+        transfer.transfer_to_remote(path, remote_path + "2",
+                                    buffer_size=4096)
+        self.assertEqual(transfer.wire_size, len(data))
+
+    def test_incompressible(self):
+        compressor = ChunkCompressor(6)
+        data = os.urandom(1000)
+        probes = 0
+        for i in range(40):
+            compressed, sent = compressor.compress(data)
+            self.assertFalse(compressed)
+            self.assertEqual(sent, data)
+            if compressor._skipped == 0:
+                probes += 1
+        # 4 failures, then one probe every 16 chunks
+        self.assertEqual(probes, 6)
+        self.assertEqual(compressor.wire_size, compressor.raw_size)
+        compressed, sent = compressor.compress(b"a" * 1000)
+        self.assertFalse(compressed)
+        for i in range(20):
+            compressed, sent = compressor.compress(b"a" * 1000)
+        self.assertTrue(compressed)
+        self.assertEqual(ChunkCompressor.decompress(compressed, sent),
+                         b"a" * 1000)
+
+    def test_small_files(self):
+        path = os.path.join(self.directory, "dir")
+        os.makedirs(os.path.join(path, "sub"))
+        data = {}
+        for i in range(20):
+            name = os.path.join(path, i % 2 and "sub" or "", "f%d" % i)
+            data[name[len(path) + 1:]] = self.make_file(name, 100)
+        data["large"] = self.make_file(os.path.join(path, "large"), 5000)
+        self.transfer.small_file_size = 1000
+        self.transfer.batch_size = 1000
+        calls = []
+
+        def write_files(*args):
+            calls.append(args[0])
+            return RemoteFileController.write_files(self.controller, *args)
+
+        self.controller.write_files = write_files
+        remote_path = os.path.join(self.directory, "remote_dir")
+        sizes = []
+        self.transfer.transfer_to_remote(path, remote_path, buffer_size=512,
+                                         progress=sizes.append)
+        # 2000 bytes of small files, by batches of 1000 bytes
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(sum(sizes), 7000)
+        back_path = os.path.join(self.directory, "back")
+        self.transfer.transfer_from_remote(remote_path, back_path,
+                                           buffer_size=512)
+        for relative_path, file_data in data.items():
+            self.assertEqual(
+                self.read_file(os.path.join(remote_path, relative_path)),
+                file_data)
+            self.assertEqual(
+                self.read_file(os.path.join(back_path, relative_path)),
+                file_data)
+
+    def test_unpack_safety(self):
+        path = os.path.join(self.directory, "dir")
+        os.mkdir(path)
+        os.symlink(self.directory, os.path.join(path, "link"))
+        for name, member_type in (("../evil", tarfile.REGTYPE),
+                                  ("/tmp/evil", tarfile.REGTYPE),
+                                  ("link/evil", tarfile.REGTYPE),
+                                  ("evil", tarfile.SYMTYPE)):
+            buf = io.BytesIO()
+            tar = tarfile.open(fileobj=buf, mode='w')
+            info = tarfile.TarInfo(name)
+            info.type = member_type
+            info.linkname = "/etc/passwd"
+            tar.addfile(info, io.BytesIO(b""))
+            tar.close()
+            self.assertRaises(TransferError, unpack_files, buf.getvalue(),
+                              path)
+        self.assertFalse(os.path.exists(os.path.join(self.directory,
+                                                     "evil")))
+        self.assertEqual(os.listdir(path), ["link"])
+
+    def test_delta(self):
+        path = os.path.join(self.directory, "local")
+        remote_path = os.path.join(self.directory, "remote")
+        data = self.make_file(remote_path, 1000000)
+        # insertion, modification and deletion
+        data = data[:300000] + os.urandom(100) + data[300000:700000] + \
+            b'x' * 10 + data[700010:990000]
+        with open(path, 'wb') as f:
+            f.write(data)
+        transfer = PortableRemoteTransfer(self.controller)
+        transfer.delta_min_size = 0
+        transfer.delta_block_size = 4096
+        sizes = []
+        transfer.transfer_to_remote(path, remote_path, buffer_size=65536,
+                                    progress=sizes.append)
+        self.assertEqual(self.read_file(remote_path), data)
+        self.assertEqual(sum(sizes), len(data))
+        self.assertEqual(transfer.raw_size, len(data))
+        self.assertTrue(transfer.wire_size < 4 * 4096)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ["local", "remote"])
+
+        # unrelated file
+        data = self.make_file(path, 100000)
+        transfer.transfer_to_remote(path, remote_path, buffer_size=65536)
+        self.assertEqual(self.read_file(remote_path), data)
+
+    def test_ranges(self):
+        path = os.path.join(self.directory, "local")
+        remote_path = os.path.join(self.directory, "remote")
+        data = self.make_file(path, 10000)
+        self.transfer.range_min_size = 5000
+        sizes = []
+        self.transfer.transfer_to_remote(path, remote_path, buffer_size=512,
+                                         progress=sizes.append)
+        self.assertEqual(self.read_file(remote_path), data)
+        self.assertEqual(sum(sizes), 10000)
+        # 4 ranges, 4 chunks in flight for each
+        self.assertTrue(self.controller.max_in_flight > 4)
+
+        def corrupted_write_chunk(session_id, offset, data):
+            if offset == 6000:
+                data = b'x' * len(data)
+            return RemoteFileController.write_chunk(
+                self.controller, session_id, offset, data)
+
+        self.controller.write_chunk = corrupted_write_chunk
+        self.assertRaises(TransferError, self.transfer.transfer_to_remote,
+                          path, os.path.join(self.directory, "remote2"),
+                          buffer_size=500)
+
+    def test_dedup(self):
+        path = os.path.join(self.directory, "local")
+        remote_path1 = os.path.join(self.directory, "remote1")
+        remote_path2 = os.path.join(self.directory, "remote2")
+        store = os.path.join(self.directory, "store")
+        self.controller.transfer_store = store
+        transfer = PortableRemoteTransfer(self.controller, dedup=True)
+        transfer.dedup_min_size = 0
+        data = self.make_file(path, 10000)
+        transfer.transfer_to_remote(path, remote_path1, buffer_size=512)
+        wire_size = transfer.wire_size
+        sizes = []
+        transfer.transfer_to_remote(path, remote_path2, buffer_size=512,
+                                    progress=sizes.append)
+        self.assertEqual(self.read_file(remote_path2), data)
+        self.assertEqual(sum(sizes), 10000)
+        self.assertEqual(transfer.wire_size, wire_size)
+        self.assertTrue(os.path.samefile(remote_path1, remote_path2))
+        # the shared file can not be modified in place
+        self.assertFalse(os.stat(remote_path1).st_mode & stat.S_IWUSR)
+
+        # a new version of a linked file does not modify the others
+        data2 = self.make_file(path, 10000)
+        transfer.transfer_to_remote(path, remote_path2, buffer_size=512)
+        self.assertEqual(self.read_file(remote_path2), data2)
+        self.assertEqual(self.read_file(remote_path1), data)
+        # resumed transfer of a shared file
+        with open(path, 'wb') as f:
+            f.write(data + b'x' * 1000)
+        transfer.transfer_to_remote(path, remote_path1, buffer_size=512)
+        self.assertEqual(self.read_file(remote_path1), data + b'x' * 1000)
+        digest = hashlib.md5(data).hexdigest()
+        self.assertEqual(self.read_file(
+            os.path.join(store, "md5", digest[:2], digest)), data)
+
+        clean_transfer_store(store)
+        self.assertEqual(len(os.listdir(store)), 1)
+        os.remove(remote_path1)
+        os.remove(remote_path2)
+        clean_transfer_store(store)
+        self.assertEqual(os.listdir(store), [])
+
+
+class TransferCountersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="swf_counters")
+        transfer_dir = os.path.join(self.directory, "transfered_files")
+        os.mkdir(transfer_dir)
+        database_server = WorkflowDatabaseServer(
+            os.path.join(self.directory, "soma_workflow.db"), transfer_dir)
+        self.database_server = database_server
+        self.scheduler = LocalScheduler(proc_nb=1, interval=0.01)
+        self.engine = WorkflowEngine(database_server, self.scheduler)
+        self.engine_path = database_server.add_transfer(
+            EngineTransfer(FileTransfer(True, "/client/file", name="file")),
+            self.engine._user_id,
+            datetime.datetime.now() + datetime.timedelta(hours=1)).engine_path
+
+    def tearDown(self):
+        self.engine.engine_loop.stop_loop()
+        self.engine.engine_loop_thread.join()
+        self.scheduler.end_scheduler_thread()
+        shutil.rmtree(self.directory)
+
+    def test_counters(self):
+        path = os.path.join(self.directory, "local")
+        with open(path, 'wb') as f:
+            f.write(os.urandom(3000))
+        engine_path = self.engine_path
+        self.engine.set_transfer_status(
+            engine_path, constants.TRANSFERING_FROM_CLIENT_TO_CR)
+        self.assertEqual(self.engine.transfer_progressions([engine_path]),
+                         [None])
+        self.engine.set_transfer_size(engine_path, 3000)
+        transfer = PortableRemoteTransfer(self.engine)
+        transfer.transfer_to_remote(path, engine_path, buffer_size=1000,
+                                    transfer_id=engine_path)
+        self.assertEqual(self.engine.transfer_progressions([engine_path]),
+                         [(3000, 3000)])
+        self.assertEqual(self.engine.transfer_transmitted(engine_path), 3000)
+        self.engine.set_transfer_status(engine_path,
+                                        constants.FILES_ON_CLIENT_AND_CR)
+        self.assertEqual(self.engine.transfer_progressions([engine_path]),
+                         [None])
+
+    def test_transfer_files_error(self):
+        transfer_ids = []
+        for name, size in (("failing", 3000), ("a", 2000), ("b", 1000)):
+            path = os.path.join(self.directory, name)
+            with open(path, 'wb') as f:
+                f.write(os.urandom(size))
+            engine_transfer = EngineTransfer(
+                FileTransfer(True, path, name=name))
+            engine_transfer.workflow_id = -1
+            transfer_ids.append(self.database_server.add_transfer(
+                engine_transfer, self.engine._user_id,
+                datetime.datetime.now()
+                + datetime.timedelta(hours=1)).engine_path)
+        transfer = PortableRemoteTransfer(self.engine)
+        transfer_to_remote = transfer.transfer_to_remote
+
+        def failing_transfer_to_remote(path, remote_path, **kwargs):
+            if os.path.basename(path) == "failing":
+                raise TransferError("transfer failed")
+            return transfer_to_remote(path, remote_path, **kwargs)
+
+        transfer.transfer_to_remote = failing_transfer_to_remote
+        controller = WorkflowController.__new__(WorkflowController)
+        controller._engine_proxy = self.engine
+        controller._transfer = transfer
+        # one stream: the transfers run one after the other, the failing
+        # one first
+        controller._transfer_streams = 1
+        self.assertRaises(TransferError, controller.transfer_files,
+                          transfer_ids)
+        statuses = [self.engine.transfer_information(transfer_id)[6]
+                    for transfer_id in transfer_ids]
+        self.assertNotEqual(statuses[0], constants.FILES_ON_CLIENT_AND_CR)
+        self.assertEqual(statuses[1:], [constants.FILES_ON_CLIENT_AND_CR] * 2)
+        for transfer_id, name in zip(transfer_ids[1:], ("a", "b")):
+            with open(transfer_id, 'rb') as f:
+                with open(os.path.join(self.directory, name), 'rb') as g:
+                    self.assertEqual(f.read(), g.read())
+
+    def test_store_cleaning(self):
+        store = self.engine.transfer_store
+        with open(self.engine_path, 'wb') as f:
+            f.write(b'data')
+        os.makedirs(os.path.join(store, "md5", "ab"))
+        stored = os.path.join(store, "md5", "ab", "abcd")
+        orphan = os.path.join(store, "md5", "ab", "abce")
+        os.link(self.engine_path, stored)
+        open(orphan, 'wb').close()
+        # the store is cleaned in an other thread, from time to time
+        self.database_server.clean()
+        cleaning = self.database_server._store_cleaning
+        cleaning.join()
+        self.assertEqual(os.listdir(os.path.join(store, "md5", "ab")),
+                         ["abcd"])
+        self.database_server.clean()
+        self.assertTrue(self.database_server._store_cleaning is cleaning)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+from __future__ import print_function
+
+import os
+import sys
+import shutil
+import tempfile
+import time
+import unittest
+
+from soma_workflow.client import PythonJob, Job, Workflow, Helper
+from soma_workflow.engine_types import EngineJob
+from soma_workflow.scheduler import LocalScheduler
+import soma_workflow.constants as constants
+
+
+def say(word, times=1):
+    print(word * times)
+
+
+def exit_with(code):
+    sys.exit(code)
+
+
+def fail():
+    raise ValueError("failure")
+
+
+class PythonJobTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="swf_pyjob")
+        self.scheduler = LocalScheduler(proc_nb=2, interval=0.05)
+        self.job_id = 0
+
+    def tearDown(self):
+        self.scheduler.end_scheduler_thread()
+        shutil.rmtree(self.directory)
+
+    def run_job(self, client_job):
+        self.job_id += 1
+        job = EngineJob(client_job, queue=None)
+        job.job_id = self.job_id
+        self.scheduler.job_submission(job)
+        status = self.scheduler.get_job_status(job.job_id)
+        while status not in (constants.DONE, constants.FAILED):
+            time.sleep(0.05)
+            status = self.scheduler.get_job_status(job.job_id)
+        return self.scheduler.get_job_exit_info(job.job_id)
+
+    def test_worker_reuse(self):
+        callable_name = __name__ + ":say"
+        pids = set()
+        for i in range(3):
+            stdout = os.path.join(self.directory, "out%d" % i)
+            exit_info = self.run_job(PythonJob(callable_name,
+                                               args=["ab"],
+                                               kwargs={"times": 2},
+                                               stdout_file=stdout))
+            self.assertEqual(exit_info[0], constants.FINISHED_REGULARLY)
+            self.assertEqual(exit_info[1], 0)
+            self.assertTrue("wallclock=" in exit_info[3])
+            with open(stdout) as f:
+                self.assertEqual(f.read(), "abab\n")
+            pids.update(w.pid for w in self.scheduler._python_pool._idle_workers)
+        self.assertEqual(len(pids), 1)
+
+    def test_exit_values(self):
+        exit_info = self.run_job(PythonJob(__name__ + ":exit_with", args=[3]))
+        self.assertEqual(exit_info[1], 3)
+        stderr = os.path.join(self.directory, "err")
+        exit_info = self.run_job(PythonJob(__name__ + ":fail",
+                                           stderr_file=stderr))
+        self.assertEqual(exit_info[1], 1)
+        with open(stderr) as f:
+            self.assertTrue("ValueError" in f.read())
+
+    def test_serialization(self):
+        job = PythonJob(__name__ + ":say", args=["a"], kwargs={"times": 3})
+        workflow = Workflow([job, Job(command=["ls"])])
+        file_path = os.path.join(self.directory, "workflow")
+        Helper.serialize(file_path, workflow)
+        new_workflow = Helper.unserialize(file_path)
+        self.assertTrue(new_workflow.attributs_equal(workflow))
+        new_jobs = [j for j in new_workflow.jobs if isinstance(j, PythonJob)]
+        self.assertEqual(len(new_jobs), 1)
+        self.assertEqual(new_jobs[0].kwargs, {"times": 3})
+
+
+if __name__ == '__main__':
+    unittest.main()
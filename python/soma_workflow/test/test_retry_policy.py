@@ -0,0 +1,209 @@
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from soma_workflow.client import Job, RetryPolicy, Workflow
+from soma_workflow.engine import WorkflowEngineLoop
+from soma_workflow.engine_types import EngineWorkflow
+from soma_workflow.database_server import WorkflowDatabaseServer
+from soma_workflow.errors import DRMError
+from soma_workflow.scheduler import LocalScheduler, DrmaaCTypes
+from soma_workflow.fake_drmaa import FakeSessionFactory, \
+    DrmCommunicationException
+import soma_workflow.constants as constants
+
+
+class FailingSubmissionFactory(FakeSessionFactory):
+
+    '''
+    Fake DRMAA sessions whose first runJob call fails.
+    '''
+
+    def __init__(self):
+        super(FailingSubmissionFactory, self).__init__()
+        self.submission_failures = 0
+
+    def __call__(self):
+        session = super(FailingSubmissionFactory, self).__call__()
+        run_job = session.runJob
+
+        def runJob(job_template):
+            if not self.submission_failures:
+                self.submission_failures += 1
+                raise DrmCommunicationException("submission refused")
+            return run_job(job_template)
+
+        session.runJob = runJob
+        return session
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="swf_retry")
+        transfer_dir = os.path.join(self.directory, "transfered_files")
+        os.mkdir(transfer_dir)
+        self.database_server = WorkflowDatabaseServer(
+            os.path.join(self.directory, "soma_workflow.db"), transfer_dir)
+        self.scheduler = LocalScheduler(proc_nb=1, interval=0.01)
+        self.engine_loop = WorkflowEngineLoop(self.database_server,
+                                              self.scheduler)
+        self.thread = threading.Thread(target=self.engine_loop.start_loop,
+                                       args=(0.01,))
+        self.thread.start()
+
+    def tearDown(self):
+        self.engine_loop.stop_loop()
+        self.thread.join()
+        self.scheduler.end_scheduler_thread()
+        shutil.rmtree(self.directory)
+
+    def flaky_job(self, failures, **kwargs):
+        '''
+        Job failing the first failures times it runs.
+        '''
+        counter = os.path.join(self.directory, "counter")
+        script = os.path.join(self.directory, "flaky.py")
+        with open(script, "w") as f:
+            f.write("import os, sys\n"
+                    "n = os.path.exists(%r) and int(open(%r).read()) or 0\n"
+                    "open(%r, 'w').write(str(n + 1))\n"
+                    "sys.exit(n < %d and 3 or 0)\n"
+                    % (counter, counter, counter, failures))
+        return Job(command=[sys.executable, script],
+                   stdout_file=os.path.join(self.directory, "out"),
+                   stderr_file=os.path.join(self.directory, "err"),
+                   **kwargs)
+
+    def wait(self, job, timeout=20.):
+        start = time.time()
+        while True:
+            # the loop updates the job while holding its lock
+            with self.engine_loop._lock:
+                if job.status in (constants.DONE, constants.FAILED):
+                    return
+            self.assertTrue(time.time() - start < timeout)
+            time.sleep(0.02)
+
+    def test_should_retry(self):
+        policy = RetryPolicy(max_attempts=3, exit_values=[3],
+                             signals=["SIGKILL"], retry_aborted=False)
+        self.assertTrue(policy.should_retry(
+            1, constants.FINISHED_REGULARLY, 3, None))
+        self.assertFalse(policy.should_retry(
+            3, constants.FINISHED_REGULARLY, 3, None))
+        self.assertFalse(policy.should_retry(
+            1, constants.FINISHED_REGULARLY, 1, None))
+        self.assertTrue(policy.should_retry(
+            1, constants.FINISHED_TERM_SIG, None, "SIGKILL"))
+        self.assertFalse(policy.should_retry(
+            1, constants.FINISHED_TERM_SIG, None, "SIGSEGV"))
+        self.assertFalse(policy.should_retry(
+            1, constants.EXIT_ABORTED, None, None))
+        self.assertFalse(policy.should_retry(
+            1, constants.USER_KILLED, None, None))
+        policy = RetryPolicy(delay=1., backoff=3., max_delay=5.)
+        self.assertEqual([policy.retry_delay(attempt)
+                          for attempt in (1, 2, 3)], [1., 3., 5.])
+
+    def test_retry(self):
+        engine_job = self.engine_loop.add_job(
+            self.flaky_job(2, retry_policy=RetryPolicy(max_attempts=3)),
+            queue=None)
+        self.wait(engine_job)
+        self.assertEqual(engine_job.exit_value, 0)
+        self.assertEqual(engine_job.attempt, 3)
+        attempts = self.database_server.get_job_attempts(
+            engine_job.job_id, self.engine_loop._user_id)
+        self.assertEqual([(attempt[0], attempt[2], attempt[3])
+                          for attempt in attempts],
+                         [(1, constants.FINISHED_REGULARLY, 3),
+                          (2, constants.FINISHED_REGULARLY, 3)])
+
+    def test_attempts_exhausted(self):
+        engine_job = self.engine_loop.add_job(
+            self.flaky_job(5, retry_policy=RetryPolicy(max_attempts=2)),
+            queue=None)
+        self.wait(engine_job)
+        self.assertEqual(engine_job.exit_value, 3)
+        self.assertEqual(engine_job.attempt, 2)
+
+    def test_submission_error(self):
+        job_submission = self.scheduler.job_submission
+        failures = []
+
+        def flaky_submission(job):
+            if not failures:
+                failures.append(job)
+                raise DRMError("submission refused")
+            return job_submission(job)
+
+        self.scheduler.job_submission = flaky_submission
+        engine_job = self.engine_loop.add_job(
+            self.flaky_job(0, retry_policy=RetryPolicy(max_attempts=2)),
+            queue=None)
+        self.wait(engine_job)
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(engine_job.status, constants.DONE)
+        self.assertEqual(engine_job.exit_value, 0)
+        self.assertEqual(engine_job.attempt, 2)
+        attempts = self.database_server.get_job_attempts(
+            engine_job.job_id, self.engine_loop._user_id)
+        self.assertEqual([(attempt[0], attempt[2]) for attempt in attempts],
+                         [(1, constants.EXIT_ABORTED)])
+        # the job was followed up to its end
+        start = time.time()
+        while self.database_server.get_job_status(
+                engine_job.job_id, self.engine_loop._user_id)[0] \
+                != constants.DONE:
+            self.assertTrue(time.time() - start < 20.)
+            time.sleep(0.02)
+
+    def test_drmaa_submission_error(self):
+        factory = FailingSubmissionFactory()
+        scheduler = DrmaaCTypes(None, None, self.directory,
+                                session_factory=factory)
+        engine_loop = WorkflowEngineLoop(self.database_server, scheduler)
+        thread = threading.Thread(target=engine_loop.start_loop,
+                                  args=(0.01,))
+        thread.start()
+        try:
+            engine_job = engine_loop.add_job(
+                self.flaky_job(0, retry_policy=RetryPolicy(max_attempts=2)),
+                queue=None)
+            start = time.time()
+            while True:
+                with engine_loop._lock:
+                    if engine_job.status in (constants.DONE,
+                                             constants.FAILED):
+                        break
+                self.assertTrue(time.time() - start < 20.)
+                time.sleep(0.02)
+        finally:
+            engine_loop.stop_loop()
+            thread.join()
+        self.assertEqual(factory.submission_failures, 1)
+        self.assertEqual(engine_job.status, constants.DONE)
+        self.assertEqual(engine_job.attempt, 2)
+
+    def test_workflow_policy(self):
+        policy = RetryPolicy(max_attempts=2)
+        job = self.flaky_job(1)
+        own_policy_job = self.flaky_job(1, retry_policy=RetryPolicy())
+        workflow = Workflow([job, own_policy_job], retry_policy=policy)
+        engine_workflow = EngineWorkflow(workflow, None, None, None, "retry")
+        self.assertTrue(
+            engine_workflow.job_mapping[job].retry_policy is policy)
+        self.assertTrue(
+            engine_workflow.job_mapping[own_policy_job].retry_policy
+            is own_policy_job.retry_policy)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+from __future__ import print_function
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from soma_workflow.client import Job, BarrierJob
+from soma_workflow.engine_types import EngineJob
+from soma_workflow.scheduler import SimulatedScheduler, parse_resource_usage
+import soma_workflow.constants as constants
+
+
+class SimulatedSchedulerTest(unittest.TestCase):
+
+    def submit(self, scheduler, client_job, job_id):
+        job = EngineJob(client_job, queue=None)
+        job.job_id = job_id
+        return scheduler.job_submission(job)
+
+    def run_all(self, scheduler, job_ids):
+        '''
+        Poll the jobs as the engine does, and return their exit info.
+        '''
+        exit_info = {}
+        job_ids = list(job_ids)
+        while job_ids:
+            for job_id in list(job_ids):
+                status = scheduler.get_job_status(job_id)
+                if status in (constants.DONE, constants.FAILED):
+                    exit_info[job_id] = scheduler.get_job_exit_info(job_id)
+                    job_ids.remove(job_id)
+        return exit_info
+
+    def test_slots_and_latency(self):
+        scheduler = SimulatedScheduler(proc_nb=2, queue_latency=5.,
+                                       default_duration=10.)
+        job_ids = [self.submit(scheduler, Job(command=['ls']), job_id)
+                   for job_id in range(1, 6)]
+        job_ids.append(self.submit(scheduler, BarrierJob(), 6))
+        exit_info = self.run_all(scheduler, job_ids)
+        # 5 jobs of 10s on 2 slots after 5s of latency
+        self.assertEqual(scheduler.current_time(), 35.)
+        end_times = sorted(
+            float(parse_resource_usage(exit_info[job_id][3])['end_time'])
+            for job_id in range(1, 6))
+        self.assertEqual(end_times, [15., 15., 25., 25., 35.])
+        self.assertEqual(exit_info[6][0], constants.FINISHED_REGULARLY)
+        self.assertEqual(len(scheduler._jobs), 0)
+
+    def test_durations(self):
+        directory = tempfile.mkdtemp(prefix="swf_simulation")
+        try:
+            history_file = os.path.join(directory, "history.json")
+            with open(history_file, "w") as f:
+                json.dump({"long": [100., 200.], "short": 3}, f)
+            scheduler = SimulatedScheduler(proc_nb=4,
+                                           durations_file=history_file)
+            jobs = [Job(command=['ls'], name="long"),
+                    Job(command=['ls'], name="short"),
+                    Job(command=['ls'], name="other"),
+                    Job(command=['ls'], name="long",
+                        user_storage={"duration": 7})]
+            for job_id, job in enumerate(jobs, 1):
+                self.submit(scheduler, job, job_id)
+            exit_info = self.run_all(scheduler, range(1, 5))
+            wallclocks = [
+                float(parse_resource_usage(exit_info[job_id][3])['wallclock'])
+                for job_id in range(1, 5)]
+            self.assertEqual(wallclocks, [150., 3., 1., 7.])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_kill(self):
+        scheduler = SimulatedScheduler(proc_nb=1, default_duration=10.)
+        self.submit(scheduler, Job(command=['ls']), 1)
+        self.submit(scheduler, Job(command=['ls']), 2)
+        self.assertEqual(scheduler.get_job_status(2), constants.QUEUED_ACTIVE)
+        scheduler.kill_job(1)
+        self.assertEqual(scheduler.get_job_exit_info(1)[0],
+                         constants.USER_KILLED)
+        exit_info = self.run_all(scheduler, [2])
+        self.assertEqual(exit_info[2][0], constants.FINISHED_REGULARLY)
+        # the slot was given to the next job at once
+        self.assertEqual(
+            float(parse_resource_usage(exit_info[2][3])['start_time']), 0.)
+        self.assertEqual(scheduler.current_time(), 10.)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from soma_workflow.client import Job
+from soma_workflow.engine import SpeculativeExecution
+from soma_workflow.engine_types import EngineJob
+from soma_workflow.scheduler import Scheduler
+import soma_workflow.constants as constants
+
+
+class ScriptedScheduler(Scheduler):
+
+    '''
+    Scheduler whose jobs statuses are set by the test.
+    '''
+
+    def __init__(self):
+        super(ScriptedScheduler, self).__init__()
+        self.status = {}
+        self.exit_info = {}
+        self.killed = []
+
+    def job_submission(self, job):
+        self.status[job.job_id] = constants.RUNNING
+        return job.job_id
+
+    def end(self, scheduler_job_id, exit_value=0):
+        self.status[scheduler_job_id] = constants.DONE
+        self.exit_info[scheduler_job_id] = (constants.FINISHED_REGULARLY,
+                                            exit_value, None, None)
+
+    def get_job_status(self, scheduler_job_id):
+        return self.status[scheduler_job_id]
+
+    def get_job_exit_info(self, scheduler_job_id):
+        return self.exit_info.pop(scheduler_job_id)
+
+    def kill_job(self, scheduler_job_id):
+        self.killed.append(scheduler_job_id)
+        self.status[scheduler_job_id] = constants.FAILED
+
+
+class SpeculativeExecutionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="swf_speculation")
+        self.scheduler = ScriptedScheduler()
+        self.speculation = SpeculativeExecution(self.scheduler, factor=2.,
+                                                min_samples=3)
+        self.job_id = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def running_job(self, idempotent=True):
+        self.job_id += 1
+        job = EngineJob(Job(command=['ls'], name='step',
+                            idempotent=idempotent),
+                        queue=None)
+        job.job_id = self.job_id
+        job.stdout_file = os.path.join(self.directory, 'out%d' % self.job_id)
+        job.drmaa_id = self.scheduler.job_submission(job)
+        job.status = constants.RUNNING
+        return job
+
+    def end_job(self, job, now):
+        job.status = constants.DONE
+        (job.exit_status, job.exit_value, job.terminating_signal,
+         job.str_rusage) = self.scheduler.exit_info.pop(job.drmaa_id,
+                                                        (constants.FINISHED_REGULARLY,
+                                                         0, None, None))
+        self.speculation.job_ended(job, now)
+
+    def learn_durations(self):
+        for i in range(3):
+            job = self.running_job()
+            self.speculation.check(job, now=0.)
+            self.end_job(job, now=10.)
+
+    def test_duplicate_wins(self):
+        self.learn_durations()
+        job = self.running_job()
+        self.assertEqual(self.speculation.check(job, now=100.), None)
+        self.assertEqual(self.speculation.check(job, now=115.), None)
+        self.assertEqual(len(self.speculation._duplicates), 0)
+        # more than twice the median duration
+        self.assertEqual(self.speculation.check(job, now=121.), None)
+        duplicate = self.speculation._duplicates[job.job_id]
+        with open(duplicate.stdout_file, 'w') as f:
+            f.write('duplicate output')
+        self.scheduler.end(duplicate.drmaa_id)
+        exit_info = self.speculation.check(job, now=122.)
+        self.assertEqual(exit_info[:2], (constants.FINISHED_REGULARLY, 0))
+        self.assertEqual(self.scheduler.killed, [job.drmaa_id])
+        with open(job.stdout_file) as f:
+            self.assertEqual(f.read(), 'duplicate output')
+        self.assertFalse(os.path.exists(duplicate.stdout_file))
+
+    def test_job_wins(self):
+        self.learn_durations()
+        job = self.running_job()
+        self.speculation.check(job, now=0.)
+        self.speculation.check(job, now=30.)
+        duplicate = self.speculation._duplicates[job.job_id]
+        self.scheduler.end(job.drmaa_id)
+        self.end_job(job, now=31.)
+        self.assertEqual(self.scheduler.killed, [duplicate.drmaa_id])
+        self.assertEqual(self.speculation._duplicates, {})
+
+    def test_not_idempotent(self):
+        self.learn_durations()
+        job = self.running_job(idempotent=False)
+        self.speculation.check(job, now=0.)
+        self.speculation.check(job, now=1000.)
+        self.assertEqual(self.speculation._duplicates, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
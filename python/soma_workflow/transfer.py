@@ -11,16 +11,857 @@
 from __future__ import print_function
 
 import os
+import io
+import bisect
+import copy
 import hashlib
+import tarfile
 import stat
 import operator
 import shutil
 import time
+import itertools
+import threading
+import zlib
 import six
+from six.moves import queue
+
+from soma_workflow.errors import TransferError
+
+
+def file_hash(path, algorithm='md5', buffer_size=512 ** 2):
+    '''
+    Hex digest of the file content, read by chunks of buffer_size bytes.
+
+    * algorithm *string*
+        hashlib algorithm name: "md5", "sha1", "blake2b"...
+    '''
+    content_hash = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        data = f.read(buffer_size)
+        while data:
+            content_hash.update(data)
+            data = f.read(buffer_size)
+    return content_hash.hexdigest()
+
+
+class StreamHash(object):
+
+    '''
+    Hash of a file computed from its chunks while they are transfered.
+
+    The chunks may be given in any order (several chunks are in flight at
+    the same time, see ChunkPipeline): a chunk following a missing one is
+    kept until the missing one is given, which bounds the memory use by the
+    number of chunks in flight.
+
+    When a transfer is resumed, the hash covers the data from the offset
+    where it resumed.
+    '''
+
+    def __init__(self, algorithm='md5', offset=0):
+        self._hash = hashlib.new(algorithm)
+        self._offset = offset
+        self._pending = {}
+
+    def update(self, offset, data):
+        if offset != self._offset:
+            self._pending[offset] = data
+            return
+        self._hash.update(data)
+        self._offset += len(data)
+        while self._offset in self._pending:
+            data = self._pending.pop(self._offset)
+            self._hash.update(data)
+            self._offset += len(data)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+class RangesHash(object):
+
+    '''
+    Hashes of the byte ranges of a file transfered concurrently, each range
+    having its own StreamHash. The ranges are contiguous, so the file is
+    checked when all the range hashes are.
+
+    * ranges *list of tuple(int, int)*
+        (start, end) of each range.
+    '''
+
+    def __init__(self, algorithm, ranges):
+        self._starts = [start for start, end in ranges]
+        self._hashes = [StreamHash(algorithm, start) for start, end in ranges]
+
+    def update(self, offset, data):
+        index = bisect.bisect_right(self._starts, offset) - 1
+        self._hashes[index].update(offset, data)
+
+    def hexdigest(self):
+        '''
+        * returns: *list of string*
+            The hex digest of each range.
+        '''
+        return [stream_hash.hexdigest() for stream_hash in self._hashes]
+
+
+def chunk_hashes(path, offset, buffer_size, count, algorithm='md5'):
+    '''
+    Hex digests of count chunks of buffer_size bytes of the file, from
+    offset. The list is shorter if the file ends before.
+    '''
+    hashes = []
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for i in six.moves.range(count):
+            data = f.read(buffer_size)
+            if len(data) < buffer_size:
+                break
+            hashes.append(hashlib.new(algorithm, data).hexdigest())
+    return hashes
+
+
+def block_signatures(path, block_size):
+    '''
+    Signatures of the blocks of block_size bytes of the file, for an
+    rsync-like delta transfer (see file_delta): list of (adler32 checksum,
+    md5 hex digest).
+    '''
+    signatures = []
+    with open(path, 'rb') as f:
+        data = f.read(block_size)
+        while data:
+            signatures.append((zlib.adler32(data) & 0xffffffff,
+                               hashlib.md5(data).hexdigest()))
+            data = f.read(block_size)
+    return signatures
+
+
+def file_delta(path, signatures, block_size, max_misses=8,
+               probe_interval=16):
+    '''
+    rsync-like delta of the file against an other version of it, whose
+    block_signatures are given.
+
+    The blocks of the other version are searched at every offset of the
+    file, thanks to the adler32 rolling checksum. After max_misses blocks
+    without match in a row (very different files), the search only looks
+    at the offset following the previous block, except for one block out
+    of probe_interval, so that the time is not lost rolling through the
+    whole file.
+
+    * returns: *generator of tuple(int or None, bytes)*
+        The index of the block of the other version equal to the data, or
+        None if the data must be sent (at most 2 * block_size bytes).
+    '''
+    blocks = {}
+    for index, (weak, strong) in enumerate(signatures):
+        blocks.setdefault(weak, {}).setdefault(strong, index)
+
+    def match(window, weak):
+        strong_hashes = blocks.get(weak)
+        if strong_hashes:
+            return strong_hashes.get(hashlib.md5(window).hexdigest())
+        return None
+
+    misses = 0
+    skipped = 0
+    literal = bytearray()
+    buf = bytearray()
+    pos = 0
+    eof = False
+    with open(path, 'rb') as f:
+        while True:
+            if not eof and len(buf) - pos < 2 * block_size:
+                data = f.read(4 * block_size)
+                eof = len(data) < 4 * block_size
+                buf = buf[pos:] + data
+                pos = 0
+            window = bytes(buf[pos:pos + block_size])
+            if not window:
+                break
+            weak = zlib.adler32(window) & 0xffffffff
+            index = match(window, weak)
+            shift = 0
+            if index is None and len(window) == block_size:
+                if misses < max_misses or skipped >= probe_interval:
+                    skipped = 0
+                    a = weak & 0xffff
+                    b = weak >> 16
+                    end = min(len(buf) - block_size, pos + block_size - 1)
+                    for start in six.moves.range(pos + 1, end + 1):
+                        x_out = buf[start - 1]
+                        a = (a - x_out + buf[start + block_size - 1]) % 65521
+                        b = (b - block_size * x_out + a - 1) % 65521
+                        if (b << 16) | a in blocks:
+                            index = match(buf[start:start + block_size],
+                                          (b << 16) | a)
+                            if index is not None:
+                                shift = start - pos
+                                break
+                else:
+                    skipped += 1
+            if index is None:
+                literal += window
+                pos += len(window)
+                misses += 1
+                if len(literal) >= block_size:
+                    yield (None, bytes(literal))
+                    literal = bytearray()
+                continue
+            literal += buf[pos:pos + shift]
+            if literal:
+                yield (None, bytes(literal))
+                literal = bytearray()
+            pos += shift
+            window = bytes(buf[pos:pos + block_size])
+            yield (index, window)
+            pos += len(window)
+            misses = 0
+    if literal:
+        yield (None, bytes(literal))
+
+
+def pack_files(path, relative_paths):
+    '''
+    tar archive of files of the directory path, used to transfer many small
+    files at once (see unpack_files).
+
+    * returns: *tuple(bytes, int)*
+        The archive, and the size of the files.
+    '''
+    buf = io.BytesIO()
+    size = 0
+    tar = tarfile.open(fileobj=buf, mode='w')
+    try:
+        for relative_path in relative_paths:
+            with open(os.path.join(path, relative_path), 'rb') as f:
+                file_stat = os.fstat(f.fileno())
+                info = tarfile.TarInfo('/'.join(relative_path.split(os.sep)))
+                info.size = file_stat.st_size
+                info.mtime = file_stat.st_mtime
+                info.mode = stat.S_IMODE(file_stat.st_mode)
+                tar.addfile(info, f)
+                size += info.size
+    finally:
+        tar.close()
+    return (buf.getvalue(), size)
+
+
+def unpack_files(data, path):
+    '''
+    Write the files of a tar archive made by pack_files in the directory
+    path. Only regular files are accepted, and they must stay inside path
+    (no absolute path, no "..", no symbolic link leading out of path).
+
+    * returns: *int*
+        The size of the files.
+    '''
+    root = os.path.realpath(path)
+    size = 0
+    tar = tarfile.open(fileobj=io.BytesIO(data), mode='r:')
+    try:
+        for member in tar:
+            parts = member.name.split('/')
+            if not member.isfile() or \
+                    [part for part in parts if part in ('', '.', '..')]:
+                raise TransferError("%s: invalid member in the transfered "
+                                    "archive: %s" % (path, repr(member.name)))
+            file_path = os.path.join(root, *parts)
+            directory = os.path.realpath(os.path.dirname(file_path))
+            if directory != root and \
+                    not directory.startswith(os.path.join(root, '')):
+                raise TransferError("%s: the transfered file %s is outside "
+                                    "the directory"
+                                    % (path, repr(member.name)))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            if os.path.lexists(file_path):
+                # new file: a link or a file of the transfer store is not
+                # modified
+                os.remove(file_path)
+            source = tar.extractfile(member)
+            with open(file_path, 'wb') as f:
+                shutil.copyfileobj(source, f)
+            os.chmod(file_path, member.mode)
+            size += member.size
+    finally:
+        tar.close()
+    return size
+
+
+def clean_transfer_store(store):
+    '''
+    Remove from the transfer store (see RemoteFileController.store_file)
+    the files which are not linked to any transfered file anymore: the
+    number of hard links of a file is its reference count.
+    '''
+    if not os.path.isdir(store):
+        return
+    for directory, dirs, files in os.walk(store, topdown=False):
+        for name in files:
+            path = os.path.join(directory, name)
+            if os.stat(path).st_nlink <= 1:
+                os.remove(path)
+        if directory != store and not os.listdir(directory):
+            os.rmdir(directory)
+
+
+class ChunkCompressor(object):
+
+    '''
+    zlib compression of the chunks of a transfer.
+
+    A chunk is sent compressed only if it shrinks to min_ratio of its size
+    at least. After max_failures incompressible chunks in a row (already
+    compressed images, archives...), only one chunk out of probe_interval
+    is tried, so that the time is not lost compressing them all.
+
+    raw_size counts the bytes of the chunks, wire_size the bytes actually
+    sent.
+    '''
+
+    # compressed chunks must be at most min_ratio of their size
+    min_ratio = 0.9
+
+    max_failures = 4
+
+    probe_interval = 16
+
+    # bytes of the chunks
+    raw_size = None
+
+    # bytes sent, compressed or not
+    wire_size = None
+
+    def __init__(self, level=6):
+        self.level = level
+        self.raw_size = 0
+        self.wire_size = 0
+        self._failures = 0
+        self._skipped = 0
+        self._lock = threading.Lock()
+
+    def compress(self, data):
+        '''
+        * returns: *tuple(bool, bytes)*
+            The data is compressed, and the data to send.
+        '''
+        with self._lock:
+            probe = self._failures < self.max_failures or \
+                self._skipped >= self.probe_interval
+            if not probe:
+                self._skipped += 1
+        compressed = False
+        if probe:
+            compressed_data = zlib.compress(data, self.level)
+            compressed = len(compressed_data) <= len(data) * self.min_ratio
+        with self._lock:
+            if probe:
+                self._skipped = 0
+                if compressed:
+                    self._failures = 0
+                else:
+                    self._failures += 1
+            self.raw_size += len(data)
+            if compressed:
+                self.wire_size += len(compressed_data)
+            else:
+                self.wire_size += len(data)
+        if compressed:
+            return (True, compressed_data)
+        return (False, data)
+
+    @staticmethod
+    def decompress(compressed, data):
+        if compressed:
+            return zlib.decompress(data)
+        return data
+
+
+class TransferSession(object):
+
+    '''
+    File open by RemoteFileController.open_transfer.
+    '''
+
+    # file object
+    file = None
+
+    # lock protecting the file position
+    lock = None
+
+    # StreamHash or None
+    stream_hash = None
+
+    # engine path of the transfer the file belongs to, or None
+    transfer_id = None
+
+    # ChunkCompressor of the chunks read, or None
+    compressor = None
+
+    def __init__(self, f, stream_hash=None, transfer_id=None,
+                 compressor=None):
+        self.file = f
+        self.lock = threading.Lock()
+        self.stream_hash = stream_hash
+        self.transfer_id = transfer_id
+        self.compressor = compressor
+
+
+class DeltaTransferSession(TransferSession):
+
+    '''
+    File rebuilt by RemoteFileController.open_delta_transfer: it is written
+    in a temporary file from the blocks of the previous version (basis)
+    and the data sent, and replaces the previous version when the session
+    is closed.
+    '''
+
+    # path of the file
+    path = None
+
+    # path of the file being rebuilt
+    temp_path = None
+
+    # previous version of the file
+    basis = None
+
+    block_size = None
+
+    # size written
+    offset = None
+
+    def __init__(self, path, block_size, stream_hash=None, transfer_id=None):
+        self.path = path
+        self.temp_path = path + '.swf_delta'
+        self.basis = open(path, 'rb')
+        self.block_size = block_size
+        self.offset = 0
+        super(DeltaTransferSession, self).__init__(
+            open(self.temp_path, 'wb'), stream_hash, transfer_id)
 
 
 class RemoteFileController(object):
 
+    # compressions of the chunks supported by the transfer sessions
+    transfer_compressions = ['zlib']
+
+    # directory of the content-addressed store of the files transfered
+    # (see link_stored_file), None if there is no store
+    transfer_store = None
+
+    # open transfer sessions
+    # dictionary session id -> TransferSession
+    _transfer_sessions = None
+
+    def __init__(self):
+        self._transfer_sessions = {}
+        self._transfer_sessions_lock = threading.Lock()
+        self._transfer_session_ids = itertools.count(1)
+
+    def open_transfer(self, path, mode, hash_algorithm=None, offset=0,
+                      transfer_id=None, compression_level=None, ranges=None):
+        '''
+        Open a transfer session: the file stays open until close_transfer,
+        and the chunks are read and written at given offsets, so that
+        several of them can be transfered at the same time.
+
+        * path *string*
+
+        * mode *string*
+            'w' to write the file (it is created or truncated), 'r' to
+            read it.
+
+        * hash_algorithm *string or None*
+            If set, the hash of the data written or read from offset is
+            computed along the transfer (see StreamHash), and returned by
+            close_transfer.
+
+        * offset *int*
+            Resume a transfer: the offset first bytes of the file are
+            already transfered (see get_chunk_hashes). In 'w' mode, the
+            file is truncated to offset instead of being emptied.
+
+        * transfer_id *string or None*
+            Engine path of the transfer the file belongs to, for the
+            progress of the transfer to be recorded (see
+            _transfer_progress).
+
+        * compression_level *int or None*
+            In 'r' mode, zlib level of the compression of the chunks read
+            (see ChunkCompressor and read_chunk). The compressions supported
+            are given by get_transfer_compressions.
+
+        * ranges *list of tuple(int, int) or None*
+            In 'w' mode, (start, end) of contiguous byte ranges of the file
+            written concurrently: the file is preallocated, and each range
+            has its own hash (see RangesHash). close_transfer then returns
+            the list of the range hashes.
+
+        * returns: *int*
+            session id
+        '''
+        if mode == 'w':
+            if offset:
+                self._unshare(path)
+                f = open(path, 'r+b')
+                f.truncate(offset)
+            else:
+                if os.path.lexists(path):
+                    # new file: a file of the transfer store is not modified
+                    os.remove(path)
+                f = open(path, 'wb')
+                if ranges:
+                    self._preallocate(f, ranges[-1][1])
+        elif mode == 'r':
+            f = open(path, 'rb')
+        else:
+            raise TransferError("Unknown transfer mode: %s" % repr(mode))
+        stream_hash = None
+        if hash_algorithm and ranges:
+            stream_hash = RangesHash(hash_algorithm, ranges)
+        elif hash_algorithm:
+            stream_hash = StreamHash(hash_algorithm, offset)
+        compressor = None
+        if mode == 'r' and compression_level:
+            compressor = ChunkCompressor(compression_level)
+        with self._transfer_sessions_lock:
+            session_id = next(self._transfer_session_ids)
+            self._transfer_sessions[session_id] = TransferSession(
+                f, stream_hash, transfer_id, compressor)
+        if transfer_id is not None and offset:
+            self._transfer_progress(transfer_id, offset)
+        return session_id
+
+    @staticmethod
+    def _unshare(path):
+        '''
+        Replace the file by a writable copy of it if it has other hard links
+        (it is in the transfer store, read-only), before it is modified.
+        '''
+        if os.path.isfile(path) and (
+                os.stat(path).st_nlink > 1 or
+                not os.stat(path).st_mode & stat.S_IWUSR):
+            temp_path = path + '.swf_unshare'
+            shutil.copyfile(path, temp_path)
+            if os.name == 'nt':
+                os.remove(path)
+            os.rename(temp_path, path)
+
+    def _store_path(self, algorithm, digest):
+        '''
+        Path of the file of the given content in the transfer store, None
+        if there is no store or the hash is not valid.
+        '''
+        if self.transfer_store is None or os.name == 'nt':
+            # the read-only files of the store could not be removed on
+            # Windows
+            return None
+        if algorithm not in hashlib.algorithms_available or not digest or \
+                [c for c in digest if c not in '0123456789abcdef']:
+            return None
+        return os.path.join(self.transfer_store, algorithm, digest[:2],
+                            digest)
+
+    def link_stored_file(self, path, algorithm, digest, transfer_id=None):
+        '''
+        If the transfer store holds a file of the given hash, hard link it
+        (copy it if hard links are not supported) to path: the file does
+        not need to be transfered.
+
+        * algorithm *string*
+            hashlib algorithm name.
+
+        * digest *string*
+            hex digest of the file content.
+
+        * returns: *bool*
+            The file was found in the store and linked to path.
+        '''
+        store_path = self._store_path(algorithm, digest)
+        if store_path is None or not os.path.isfile(store_path):
+            return False
+        self.create_dirs(path)
+        if os.path.lexists(path):
+            os.remove(path)
+        try:
+            os.link(store_path, path)
+        except OSError:
+            # other file system
+            try:
+                shutil.copyfile(store_path, path)
+            except (IOError, OSError):
+                # removed from the store meanwhile
+                return False
+        if transfer_id is not None:
+            self._transfer_progress(transfer_id, os.path.getsize(path),
+                                    ended=True)
+        return True
+
+    def store_file(self, path, algorithm, digest):
+        '''
+        Add a file which has just been transfered to the transfer store,
+        for the next transfers of the same content to be linked to it
+        instead (see link_stored_file). The hash is checked.
+
+        The files of the store are hard links: a file is removed from the
+        store by clean_transfer_store once it is its only link. The linked
+        files share their data: they are made read-only, so that a job
+        writing to one of them in place fails instead of modifying the other
+        transfers and the stored content. The transfers replace the file
+        instead (see open_transfer).
+
+        * returns: *bool*
+            The file is in the store.
+        '''
+        store_path = self._store_path(algorithm, digest)
+        if store_path is None or not os.path.isfile(path):
+            return False
+        if os.path.isfile(store_path):
+            return True
+        if file_hash(path, algorithm) != digest:
+            return False
+        self.create_dirs(store_path)
+        try:
+            os.link(path, store_path)
+        except OSError:
+            return False
+        mode = stat.S_IMODE(os.stat(store_path).st_mode)
+        os.chmod(store_path,
+                 mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+        return True
+
+    @staticmethod
+    def _preallocate(f, size):
+        '''
+        Allocate the disk space of the file at once, instead of growing it
+        from the ranges written concurrently.
+        '''
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+                return
+            except OSError:
+                # not supported by the file system
+                pass
+        f.truncate(size)
+
+    def _transfer_session(self, session_id):
+        with self._transfer_sessions_lock:
+            session = self._transfer_sessions.get(session_id)
+        if session is None:
+            raise TransferError("Unknown transfer session: %s"
+                                % repr(session_id))
+        return session
+
+    def _transfer_progress(self, transfer_id, size, ended=False):
+        '''
+        Called with the number of bytes of each chunk transfered within a
+        transfer session associated to a transfer, and with ended=True
+        when the session is closed. Does nothing here, the engine records
+        the progress of the transfers.
+        '''
+        pass
+
+    def get_block_signatures(self, path, block_size):
+        '''
+        Signatures of the blocks of the file, for an rsync-like delta
+        transfer (see block_signatures and open_delta_transfer).
+        '''
+        return block_signatures(path, block_size)
+
+    def open_delta_transfer(self, path, block_size, hash_algorithm=None,
+                            transfer_id=None):
+        '''
+        Open a transfer session rebuilding the file path from the blocks of
+        block_size bytes of its current version and the data sent, given
+        by write_delta (see file_delta). The file is replaced when the
+        session is closed.
+
+        * returns: *int*
+            session id
+        '''
+        stream_hash = None
+        if hash_algorithm:
+            stream_hash = StreamHash(hash_algorithm)
+        session = DeltaTransferSession(path, block_size, stream_hash,
+                                       transfer_id)
+        with self._transfer_sessions_lock:
+            session_id = next(self._transfer_session_ids)
+            self._transfer_sessions[session_id] = session
+        return session_id
+
+    def write_delta(self, session_id, operations):
+        '''
+        Append to the file of a delta transfer session.
+
+        * operations *list*
+            Index of a block of the previous version of the file to copy,
+            or tuple (compressed, data) of data to write, compressed by a
+            ChunkCompressor if compressed.
+
+        * returns: *int*
+            The number of bytes written.
+        '''
+        session = self._transfer_session(session_id)
+        size = 0
+        with session.lock:
+            for operation in operations:
+                if isinstance(operation, tuple):
+                    data = ChunkCompressor.decompress(*operation)
+                else:
+                    session.basis.seek(operation * session.block_size)
+                    data = session.basis.read(session.block_size)
+                session.file.write(data)
+                if session.stream_hash is not None:
+                    session.stream_hash.update(session.offset, data)
+                session.offset += len(data)
+                size += len(data)
+        if session.transfer_id is not None:
+            self._transfer_progress(session.transfer_id, size)
+        return size
+
+    def get_transfer_compressions(self):
+        return self.transfer_compressions
+
+    def write_chunk(self, session_id, offset, data, compressed=False):
+        '''
+        Write data at the offset of the file of the transfer session.
+        If compressed, the data was compressed by a ChunkCompressor.
+        Returns the number of bytes written.
+        '''
+        data = ChunkCompressor.decompress(compressed, data)
+        session = self._transfer_session(session_id)
+        with session.lock:
+            session.file.seek(offset)
+            session.file.write(data)
+            if session.stream_hash is not None:
+                session.stream_hash.update(offset, data)
+        if session.transfer_id is not None:
+            self._transfer_progress(session.transfer_id, len(data))
+        return len(data)
+
+    def read_chunk(self, session_id, offset, buffer_size):
+        '''
+        Read at most buffer_size bytes at the offset of the file of the
+        transfer session.
+
+        If the session has a compression level, returns a tuple (the data is
+        compressed, data), see ChunkCompressor.
+        '''
+        session = self._transfer_session(session_id)
+        with session.lock:
+            session.file.seek(offset)
+            data = session.file.read(buffer_size)
+            if session.stream_hash is not None:
+                session.stream_hash.update(offset, data)
+        if session.transfer_id is not None:
+            self._transfer_progress(session.transfer_id, len(data))
+        if session.compressor is not None:
+            return session.compressor.compress(data)
+        return data
+
+    def close_transfer(self, session_id, discard=False):
+        '''
+        Close the transfer session.
+
+        * discard *bool*
+            The transfer failed: the file of a delta transfer session is
+            not replaced.
+
+        * returns: *tuple(int, string or None)*
+            The file size, and the hash of the data transfered if the
+            session has a hash algorithm.
+        '''
+        with self._transfer_sessions_lock:
+            session = self._transfer_sessions.pop(session_id)
+        with session.lock:
+            session.file.seek(0, os.SEEK_END)
+            size = session.file.tell()
+            session.file.close()
+            if isinstance(session, DeltaTransferSession):
+                session.basis.close()
+                if discard:
+                    os.remove(session.temp_path)
+                else:
+                    if os.name == 'nt':
+                        os.remove(session.path)
+                    os.rename(session.temp_path, session.path)
+        if session.transfer_id is not None:
+            self._transfer_progress(session.transfer_id, 0, ended=True)
+        if session.stream_hash is None:
+            return (size, None)
+        return (size, session.stream_hash.hexdigest())
+
+    def write_files(self, path, data, compressed=False, hash_algorithm=None,
+                    digest=None, transfer_id=None):
+        '''
+        Write the files of a tar archive made by pack_files in the
+        directory path: many small files are transfered in one call.
+
+        * compressed *bool*
+            The archive was compressed by a ChunkCompressor.
+
+        * hash_algorithm, digest *string or None*
+            If set, hash of the archive, checked before writing the files.
+
+        * returns: *int*
+            The size of the files.
+        '''
+        data = ChunkCompressor.decompress(compressed, data)
+        if hash_algorithm and \
+                hashlib.new(hash_algorithm, data).hexdigest() != digest:
+            raise TransferError("%s: the %s hash of the transfered files "
+                                "differs" % (path, hash_algorithm))
+        size = unpack_files(data, path)
+        if transfer_id is not None:
+            self._transfer_progress(transfer_id, size, ended=True)
+        return size
+
+    def read_files(self, path, relative_paths, hash_algorithm=None,
+                   transfer_id=None, compression_level=None):
+        '''
+        tar archive of files of the directory path (see pack_files), to
+        transfer many small files in one call.
+
+        * returns: *tuple(bool, bytes, string or None, int)*
+            The archive is compressed (if compression_level is set, see
+            ChunkCompressor), the archive, its hash if hash_algorithm is
+            set, and the size of the files.
+        '''
+        data, size = pack_files(path, relative_paths)
+        digest = None
+        if hash_algorithm:
+            digest = hashlib.new(hash_algorithm, data).hexdigest()
+        compressed = False
+        if compression_level:
+            compressed, data = ChunkCompressor(
+                compression_level).compress(data)
+        if transfer_id is not None:
+            self._transfer_progress(transfer_id, size, ended=True)
+        return (compressed, data, digest, size)
+
+    def _close_transfer_sessions(self, transfer_id):
+        '''
+        Close the sessions left open by an interrupted transfer.
+        '''
+        with self._transfer_sessions_lock:
+            sessions = [session_id for session_id, session
+                        in six.iteritems(self._transfer_sessions)
+                        if session.transfer_id == transfer_id]
+        for session_id in sessions:
+            self.close_transfer(session_id, discard=True)
+
+    def get_chunk_hashes(self, path, offset, buffer_size, count,
+                         algorithm='md5'):
+        '''
+        Hashes of the chunks of an existing file, used to find where to
+        resume an interrupted transfer (see chunk_hashes).
+        '''
+        return chunk_hashes(path, offset, buffer_size, count, algorithm)
+
     def create_file(self, path):
         f = open(path, 'wb')
         f.close()
@@ -46,6 +887,9 @@ class RemoteFileController(object):
             size = 0
         return size
 
+    def get_file_sizes(self, paths):
+        return [self.get_file_size(path) for path in paths]
+
     def is_file(self, path):
         return os.path.isfile(path)
 
@@ -56,8 +900,10 @@ class RemoteFileController(object):
         return Transfer.get_dir_size(path)
 
     def get_md5_hash(self, path):
-        md5_hash = hashlib.md5(open(path, 'rb').read()).hexdigest()
-        return md5_hash
+        return file_hash(path, 'md5')
+
+    def get_file_hash(self, path, algorithm='md5'):
+        return file_hash(path, algorithm)
 
     def top_down_dir_list(self, path):
         return Transfer.top_down_dir_list(path)
@@ -72,6 +918,13 @@ class RemoteFileController(object):
 
 class TransferMonitoring(object):
 
+    '''
+    Progression of the transfers computed from the sizes of the files on
+    both sides. The transfers made through transfer sessions are followed
+    by the counters of the engine instead (see
+    WorkflowEngine.transfer_progressions), which do not read the files.
+    '''
+
     remote_file_controller = None
 
     def __init__(self, remote_file_controller):
@@ -123,10 +976,26 @@ class TransferMonitoring(object):
 
 class Transfer(object):
 
-    remote_file_controller = None
-
     def __init__(self, remote_file_controller):
-        self.remote_file_controller = remote_file_controller
+        self._remote_file_controller = remote_file_controller
+        self._owner_thread = threading.current_thread()
+        self._thread_data = threading.local()
+
+    @property
+    def remote_file_controller(self):
+        '''
+        The remote file controller, or a copy of its proxy when used from
+        another thread than the one which created the transfer object (see
+        thread_file_controller).
+        '''
+        if threading.current_thread() is self._owner_thread:
+            return self._remote_file_controller
+        controller = getattr(self._thread_data, 'remote_file_controller',
+                             None)
+        if controller is None:
+            controller = thread_file_controller(self._remote_file_controller)
+            self._thread_data.remote_file_controller = controller
+        return controller
 
     def transfer_to_remote(self, path, remote_path):
         '''
@@ -177,10 +1046,10 @@ class Transfer(object):
             r_root = root[len(abs_path) + 1:]
             if r_root:
                 dir_list.append(r_root)
-                file_list = []
-                for name in files:
-                    file_list.append(name)
-                file_path_dict[r_root] = file_list
+            file_list = []
+            for name in files:
+                file_list.append(name)
+            file_path_dict[r_root] = file_list
         return (dir_list, file_path_dict)
 
     @staticmethod
@@ -394,44 +1263,404 @@ class TransferLocal(Transfer):
         # time.sleep(4)
 
 
+class ChunkPipeline(object):
+
+    '''
+    Calls the chunk methods of a RemoteFileController from several threads,
+    so that several chunks are in flight at the same time instead of one
+    round-trip per chunk.
+
+    A Pyro proxy cannot be shared between threads: each thread uses its own
+    copy of the remote file controller proxy (its own connection). The
+    pipelines are kept and reused from one file to the next, so that the
+    connections are not opened again for each file (see
+    PortableRemoteTransfer).
+
+    The caller keeps at most window calls pending (see PortableRemoteTransfer)
+    so that the memory use is bounded by window * buffer_size.
+    '''
+
+    def __init__(self, remote_file_controller, window):
+        self._calls = queue.Queue()
+        self._results = queue.Queue()
+        self._threads = []
+        for i in range(window):
+            thread = threading.Thread(
+                target=self._run,
+                args=(thread_file_controller(remote_file_controller),))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self, remote_file_controller):
+        while True:
+            call = self._calls.get()
+            if call is None:
+                break
+            method_name, args = call
+            try:
+                result = getattr(remote_file_controller, method_name)(*args)
+            except Exception as e:
+                self._results.put((args, None, e))
+            else:
+                self._results.put((args, result, None))
+
+    def call(self, method_name, *args):
+        self._calls.put((method_name, args))
+
+    def result(self):
+        '''
+        Wait for the end of a call, and return its arguments and its result.
+        The exceptions raised by the calls are raised here.
+        '''
+        args, result, exception = self._results.get()
+        if exception is not None:
+            raise exception
+        return args, result
+
+    def close(self):
+        for thread in self._threads:
+            self._calls.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+class ParallelTransferExecutor(object):
+
+    '''
+    Runs file transfers nb_streams at the same time, the largest first, so
+    that a large file does not end alone at the end of the transfer.
+
+    The transfer functions are called with their arguments and a progress
+    keyword argument: a function which they may call with the number of
+    bytes of each chunk transfered. The progress of the transfers is
+    aggregated in transfered_size (the size of a transfer which does not
+    report its progress is added at its end), and passed to the progress
+    function of the executor, if any.
+    '''
+
+    # total size of the transfers (bytes)
+    total_size = None
+
+    # size of the data transfered (bytes)
+    transfered_size = None
+
+    def __init__(self, nb_streams=4, progress=None):
+        self.nb_streams = max(1, nb_streams)
+        self.total_size = 0
+        self.transfered_size = 0
+        self._progress = progress
+        self._transfers = []
+        self._lock = threading.Lock()
+
+    def add(self, size, function, *args):
+        self._transfers.append((size, function, args))
+        self.total_size += size
+
+    def _add_progress(self, size):
+        with self._lock:
+            self.transfered_size += size
+        if self._progress is not None:
+            self._progress(size)
+
+    def _run_transfer(self, size, function, args):
+        reported = [0]
+
+        def progress(chunk_size):
+            reported[0] += chunk_size
+            self._add_progress(chunk_size)
+
+        function(*args, progress=progress)
+        if reported[0] < size:
+            self._add_progress(size - reported[0])
+
+    def run(self):
+        '''
+        Run all the transfers added. The first exception raised by a
+        transfer is raised once all the transfers are over.
+        '''
+        transfers = sorted(self._transfers, key=operator.itemgetter(0),
+                           reverse=True)
+        self._transfers = []
+        errors = []
+        if self.nb_streams == 1 or len(transfers) <= 1:
+            for size, function, args in transfers:
+                try:
+                    self._run_transfer(size, function, args)
+                except Exception as e:
+                    errors.append(e)
+            if errors:
+                raise errors[0]
+            return
+
+        to_run = queue.Queue()
+        for transfer in transfers:
+            to_run.put(transfer)
+
+        def run_transfers():
+            while True:
+                try:
+                    size, function, args = to_run.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    self._run_transfer(size, function, args)
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=run_transfers)
+                   for i in range(min(self.nb_streams, len(transfers)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+
+def thread_file_controller(remote_file_controller):
+    '''
+    Pyro proxies are bound to the thread using them: return a copy of the
+    proxy to be used in a new thread, or the remote file controller itself
+    if it is a local object.
+    '''
+    if type(remote_file_controller).__module__.startswith('Pyro'):
+        return copy.copy(remote_file_controller)
+    return remote_file_controller
+
+
 class PortableRemoteTransfer(Transfer):
 
-    def __init__(self, remote_file_controller):
+    '''
+    Transfer through the RemoteFileController methods (through Pyro in
+    remote mode). The files are transfered in chunks of buffer_size bytes,
+    window chunks being in flight at the same time.
+
+    The files of a directory are transfered nb_streams at the same time,
+    the largest first (see ParallelTransferExecutor). Its small files are
+    packed in tar archives (see pack_files), a batch of them being
+    transfered in one call instead of several calls per file.
+
+    The transfers are checked with a hash (hash_algorithm, a hashlib
+    algorithm name) computed on both sides along the transfer.
+
+    If resume is set and the destination file already exists, its chunks
+    are compared with the source ones by hash, and the transfer continues
+    after the last identical chunk: an interrupted transfer does not start
+    over.
+
+    If delta is set and an other version of a file larger than
+    delta_min_size exists on the remote side, only the data which differs
+    is sent: the remote side gives the signatures of the blocks of its
+    version, and the file is rebuilt there from the blocks found in the
+    local file (see file_delta) and the data sent.
+
+    If dedup is set, the hash of a file larger than dedup_min_size is sent
+    first: if the transfer store of the remote side holds the same content
+    (uploaded by a previous transfer), it is linked to the destination and
+    the file is not sent. The files sent are added to the store (see
+    RemoteFileController.link_stored_file). The linked files are read-only:
+    the jobs can not modify them in place, in particular a FileTransfer
+    which is both an input and an output of a job.
+
+    A file larger than range_min_size is split in nb_streams byte ranges
+    transfered concurrently, each range being checked by its own hash (see
+    RangesHash).
+
+    If compression_level is set (zlib level, 1 to 9) and the remote file
+    controller supports it, the chunks are compressed (see
+    ChunkCompressor). raw_size counts the bytes of the files transfered,
+    wire_size the bytes actually sent.
+    '''
+
+    # maximum number of chunks transfered at the same time
+    window = None
+
+    # number of files of a directory transfered at the same time
+    nb_streams = None
+
+    # hashlib algorithm name
+    hash_algorithm = None
+
+    # resume the interrupted transfers
+    resume = None
+
+    # number of chunk hashes compared at once when resuming a transfer
+    resume_batch = 1024
+
+    # the files of a directory smaller than small_file_size bytes are
+    # packed together in batches of batch_size bytes at most
+    small_file_size = 256 * 1024
+
+    batch_size = 4 * 1024 ** 2
+
+    # send the differences with the remote version of a file
+    delta = None
+
+    # minimum size of the remote version of a file for a delta transfer
+    delta_min_size = 4 * 1024 ** 2
+
+    # size of the blocks compared by a delta transfer
+    delta_block_size = 64 * 1024
+
+    # the files larger than range_min_size bytes are split in nb_streams
+    # ranges transfered concurrently
+    range_min_size = 64 * 1024 ** 2
+
+    # look for the files in the transfer store of the remote side before
+    # sending them
+    dedup = None
+
+    # minimum size of the files looked for in the transfer store
+    dedup_min_size = 1024 ** 2
+
+    # zlib level of the compression of the chunks, or None
+    compression_level = None
+
+    # bytes of the files transfered
+    raw_size = None
+
+    # bytes sent, compressed or not
+    wire_size = None
+
+    def __init__(self, remote_file_controller, window=4,
+                 hash_algorithm='md5', nb_streams=4, resume=True,
+                 compression_level=None, delta=True, dedup=False):
         super(PortableRemoteTransfer, self).__init__(remote_file_controller)
+        # idle chunk pipelines, one per thread transfering at the same time
+        self._pipelines = []
+        self._pipelines_lock = threading.Lock()
+        self.window = window
+        self.hash_algorithm = hash_algorithm
+        self.nb_streams = nb_streams
+        self.resume = resume
+        self.delta = delta
+        self.dedup = dedup
+        self.compression_level = compression_level
+        self.raw_size = 0
+        self.wire_size = 0
+        self._size_lock = threading.Lock()
+        # the remote file controller supports the compression
+        self._compression_supported = None
         # print("Portable transfer")
 
+    def _compression(self):
+        '''
+        zlib level of the compression of the chunks, None if the
+        compression is disabled or not supported by the remote side (older
+        version).
+        '''
+        if not self.compression_level:
+            return None
+        if self._compression_supported is None:
+            try:
+                self._compression_supported = 'zlib' in \
+                    self.remote_file_controller.get_transfer_compressions()
+            except Exception:
+                self._compression_supported = False
+        if self._compression_supported:
+            return self.compression_level
+        return None
+
+    def _count(self, raw_size, wire_size):
+        with self._size_lock:
+            self.raw_size += raw_size
+            self.wire_size += wire_size
+
+    def _pipelined_calls(self, method_name, calls, on_result):
+        '''
+        Make the calls (sequence of arguments tuples) of the method of the
+        remote file controller, at most window at the same time, and pass
+        each (arguments, result) to on_result as soon as it is available.
+        '''
+        with self._pipelines_lock:
+            if self._pipelines:
+                pipeline = self._pipelines.pop()
+            else:
+                pipeline = None
+        if pipeline is None:
+            pipeline = ChunkPipeline(self.remote_file_controller, self.window)
+        pending = 0
+        try:
+            for args in calls:
+                if pending == self.window:
+                    pending -= 1
+                    on_result(*pipeline.result())
+                pipeline.call(method_name, *args)
+                pending += 1
+            while pending:
+                pending -= 1
+                on_result(*pipeline.result())
+        finally:
+            # after an error, the results of the pending calls are dropped
+            # for the pipeline to be reused
+            while pending:
+                pending -= 1
+                try:
+                    pipeline.result()
+                except Exception:
+                    pass
+            with self._pipelines_lock:
+                self._pipelines.append(pipeline)
+
+    def close(self):
+        '''
+        Stop the threads of the chunk pipelines, and close their
+        connections. The transfer object can still be used afterwards.
+        '''
+        with self._pipelines_lock:
+            pipelines = self._pipelines
+            self._pipelines = []
+        for pipeline in pipelines:
+            pipeline.close()
+
+    def _verified_prefix(self, path, remote_path, size, remote_size,
+                         buffer_size):
+        '''
+        Size of the identical beginning of the local and the remote files,
+        compared by chunks of buffer_size bytes. The transfer is resumed
+        from there.
+        '''
+        if not self.resume:
+            return 0
+        count = min(size, remote_size) // buffer_size
+        offset = 0
+        while count:
+            batch = min(count, self.resume_batch)
+            local_hashes = chunk_hashes(path, offset, buffer_size, batch,
+                                        self.hash_algorithm)
+            remote_hashes = self.remote_file_controller.get_chunk_hashes(
+                remote_path, offset, buffer_size, batch, self.hash_algorithm)
+            for local_hash, remote_hash in zip(local_hashes, remote_hashes):
+                if local_hash != remote_hash:
+                    return offset
+                offset += buffer_size
+            if len(local_hashes) < batch or len(remote_hashes) < batch:
+                # a file was modified meanwhile
+                break
+            count -= batch
+        return offset
+
     def transfer_to_remote(self,
                            path,
                            remote_path,
-                           buffer_size=512 ** 2):
+                           buffer_size=512 ** 2,
+                           progress=None,
+                           transfer_id=None):
         '''
-        return Transfered_with_success
+        * progress *function or None*
+            Called with the number of bytes of each chunk transfered.
+
+        * transfer_id *string or None*
+            Engine path of the transfer, for the engine to record its
+            progress.
         '''
         print("copy " + repr(path) + " to " + repr(remote_path))
         if os.path.isfile(path):
             self.remote_file_controller.create_dirs(remote_path)
-            # TBI in case the file were already transfered
-            transmitted = 0
-
-            f = open(path, 'rb')
-            self.remote_file_controller.create_file(remote_path)
-            file_size = os.path.getsize(path)
-            if transmitted:
-                f.seek(transmitted)
-            r_file_size = transmitted
-            while r_file_size < file_size:
-                r_file_size = self.remote_file_controller.write(remote_path,
-                                                                f.read(buffer_size))
-            f.close()
-
-            if r_file_size != file_size:
-                pass
-                # TBI error
-
-            md5_hash = hashlib.md5(open(path, 'rb').read()).hexdigest()
-            if md5_hash != self.remote_file_controller.get_md5_hash(remote_path):
-                # TBI error
-                pass
+            self._file_to_remote(path, remote_path, buffer_size,
+                                 transfer_id, progress)
 
         elif os.path.isdir(path):
             self.remote_file_controller.create_dirs(remote_path)
@@ -439,59 +1668,296 @@ class PortableRemoteTransfer(Transfer):
             (dir_list, file_path_dict) = self.top_down_dir_list(path)
             self.remote_file_controller.create_dir_structure(remote_path,
                                                              dir_list)
+            files = []
             for relative_dir_path, file_list in six.iteritems(file_path_dict):
-                dir_path = os.path.join(path, relative_dir_path)
-                r_dir_path = os.path.join(remote_path, relative_dir_path)
                 for file_name in file_list:
-                    remote_file_path = os.path.join(r_dir_path, file_name)
-                    file_path = os.path.join(dir_path, file_name)
-                    self.transfer_to_remote(file_path,
-                                            remote_file_path,
-                                            buffer_size=buffer_size)
+                    relative_path = os.path.join(relative_dir_path, file_name)
+                    files.append((os.path.getsize(os.path.join(
+                                  path, relative_path)), relative_path))
+            files, batches = self._batch_files(files)
+            executor = ParallelTransferExecutor(self.nb_streams, progress)
+            for size, relative_path in files:
+                executor.add(size,
+                             self._file_to_remote,
+                             os.path.join(path, relative_path),
+                             os.path.join(remote_path, relative_path),
+                             buffer_size,
+                             transfer_id)
+            for size, relative_paths in batches:
+                executor.add(size,
+                             self._files_to_remote,
+                             path,
+                             remote_path,
+                             relative_paths,
+                             transfer_id)
+            executor.run()
+
+    def _batch_files(self, files):
+        '''
+        Split the files of a directory, list of (size, relative path), into
+        the files transfered one by one, and batches of files smaller than
+        small_file_size transfered in one call each (list of
+        (size, relative paths)).
+        '''
+        single_files = []
+        batches = []
+        batch = []
+        batch_size = 0
+        for size, relative_path in sorted(files, key=operator.itemgetter(1)):
+            if size >= self.small_file_size:
+                single_files.append((size, relative_path))
+                continue
+            if batch and batch_size + size > self.batch_size:
+                batches.append((batch_size, batch))
+                batch = []
+                batch_size = 0
+            batch.append(relative_path)
+            batch_size += size
+        if batch:
+            batches.append((batch_size, batch))
+        return (single_files, batches)
+
+    def _files_to_remote(self, path, remote_path, relative_paths,
+                         transfer_id=None, progress=None):
+        data, size = pack_files(path, relative_paths)
+        digest = hashlib.new(self.hash_algorithm, data).hexdigest()
+        compressed = False
+        compression_level = self._compression()
+        if compression_level:
+            compressed, data = ChunkCompressor(
+                compression_level).compress(data)
+        self.remote_file_controller.write_files(remote_path, data, compressed,
+                                                self.hash_algorithm, digest,
+                                                transfer_id)
+        self._count(size, len(data))
+        if progress is not None:
+            progress(size)
+
+    def _file_to_remote(self, path, remote_path, buffer_size,
+                        transfer_id=None, progress=None):
+        file_size = os.path.getsize(path)
+        if not self.dedup or file_size < self.dedup_min_size:
+            self._send_file(path, remote_path, buffer_size, transfer_id,
+                            progress)
+            return
+        digest = file_hash(path, self.hash_algorithm, buffer_size)
+        if self.remote_file_controller.link_stored_file(
+                remote_path, self.hash_algorithm, digest, transfer_id):
+            self._count(file_size, 0)
+            if progress is not None:
+                progress(file_size)
+            return
+        self._send_file(path, remote_path, buffer_size, transfer_id,
+                        progress)
+        self.remote_file_controller.store_file(remote_path,
+                                               self.hash_algorithm, digest)
+
+    def _send_file(self, path, remote_path, buffer_size, transfer_id=None,
+                   progress=None):
+        file_size = os.path.getsize(path)
+        remote_file_size = self.remote_file_controller.get_file_size(
+            remote_path)
+        transmitted = self._verified_prefix(
+            path, remote_path, file_size, remote_file_size, buffer_size)
+        if self.delta and remote_file_size >= self.delta_min_size and \
+                transmitted < remote_file_size:
+            # the remote file is an other version, not an interrupted
+            # transfer
+            self._delta_to_remote(path, remote_path, buffer_size,
+                                  transfer_id, progress)
+            return
+        if not transmitted and self.nb_streams > 1 and \
+                file_size >= self.range_min_size:
+            self._ranges_to_remote(path, remote_path, buffer_size,
+                                   transfer_id, progress)
+            return
+        if transmitted and progress is not None:
+            progress(transmitted)
+
+        compression_level = self._compression()
+        compressor = None
+        if compression_level:
+            compressor = ChunkCompressor(compression_level)
+        session_id = self.remote_file_controller.open_transfer(
+            remote_path, 'w', self.hash_algorithm, transmitted, transfer_id)
+        written = [transmitted]
+        local_hash = StreamHash(self.hash_algorithm, transmitted)
+
+        def chunks(f):
+            f.seek(transmitted)
+            for offset in six.moves.range(transmitted, file_size,
+                                          buffer_size):
+                data = f.read(buffer_size)
+                local_hash.update(offset, data)
+                if compressor is None:
+                    yield (session_id, offset, data)
+                else:
+                    compressed, data = compressor.compress(data)
+                    yield (session_id, offset, data, compressed)
+
+        def chunk_written(args, size):
+            written[0] += size
+            self._count(size, len(args[2]))
+            if progress is not None:
+                progress(size)
+
+        try:
+            with open(path, 'rb') as f:
+                self._pipelined_calls('write_chunk', chunks(f),
+                                      chunk_written)
+        finally:
+            (r_file_size,
+             r_hash) = self.remote_file_controller.close_transfer(session_id)
+
+        if r_file_size != file_size or written[0] != file_size:
+            raise TransferError("%s: %d bytes transfered out of %d"
+                                % (path, r_file_size, file_size))
+        if r_hash != local_hash.hexdigest():
+            raise TransferError("%s: the %s hash of the transfered file "
+                                "differs" % (path, self.hash_algorithm))
+
+    def _ranges_to_remote(self, path, remote_path, buffer_size,
+                          transfer_id=None, progress=None):
+        file_size = os.path.getsize(path)
+        # ranges of whole chunks
+        range_size = -(-file_size // (self.nb_streams * buffer_size)) \
+            * buffer_size
+        ranges = [(start, min(start + range_size, file_size))
+                  for start in six.moves.range(0, file_size, range_size)]
+        compressor = None
+        compression_level = self._compression()
+        if compression_level:
+            compressor = ChunkCompressor(compression_level)
+        session_id = self.remote_file_controller.open_transfer(
+            remote_path, 'w', self.hash_algorithm, 0, transfer_id, None,
+            ranges)
+        local_hash = RangesHash(self.hash_algorithm, ranges)
+        written = [0]
+        lock = threading.Lock()
+
+        def chunk_written(args, size):
+            with lock:
+                written[0] += size
+                self._count(size, len(args[2]))
+                if progress is not None:
+                    progress(size)
+
+        def range_to_remote(start, end, progress=None):
+            with open(path, 'rb') as f:
+                f.seek(start)
+
+                def chunks():
+                    for offset in six.moves.range(start, end, buffer_size):
+                        data = f.read(min(buffer_size, end - offset))
+                        local_hash.update(offset, data)
+                        if compressor is None:
+                            yield (session_id, offset, data)
+                        else:
+                            compressed, data = compressor.compress(data)
+                            yield (session_id, offset, data, compressed)
+
+                self._pipelined_calls('write_chunk', chunks(), chunk_written)
+
+        executor = ParallelTransferExecutor(len(ranges))
+        for start, end in ranges:
+            executor.add(end - start, range_to_remote, start, end)
+        try:
+            executor.run()
+        finally:
+            (r_file_size,
+             r_hashes) = self.remote_file_controller.close_transfer(session_id)
+
+        if r_file_size != file_size or written[0] != file_size:
+            raise TransferError("%s: %d bytes transfered out of %d"
+                                % (path, written[0], file_size))
+        for (start, end), r_hash, local_range_hash in zip(
+                ranges, r_hashes, local_hash.hexdigest()):
+            if r_hash != local_range_hash:
+                raise TransferError("%s: the %s hash of the bytes %d to %d "
+                                    "of the transfered file differs"
+                                    % (path, self.hash_algorithm, start, end))
+
+    def _delta_to_remote(self, path, remote_path, buffer_size,
+                         transfer_id=None, progress=None):
+        file_size = os.path.getsize(path)
+        signatures = self.remote_file_controller.get_block_signatures(
+            remote_path, self.delta_block_size)
+        compressor = None
+        compression_level = self._compression()
+        if compression_level:
+            compressor = ChunkCompressor(compression_level)
+        session_id = self.remote_file_controller.open_delta_transfer(
+            remote_path, self.delta_block_size, self.hash_algorithm,
+            transfer_id)
+        local_hash = StreamHash(self.hash_algorithm)
+        # operations sent in one call, their size and the data to send
+        operations = []
+        sizes = [0, 0]
+        written = [0]
+
+        def send():
+            size = self.remote_file_controller.write_delta(session_id,
+                                                           operations)
+            written[0] += size
+            self._count(sizes[0], sizes[1])
+            if progress is not None:
+                progress(size)
+            del operations[:]
+            sizes[0] = sizes[1] = 0
+
+        try:
+            offset = 0
+            for index, data in file_delta(path, signatures,
+                                          self.delta_block_size):
+                local_hash.update(offset, data)
+                offset += len(data)
+                sizes[0] += len(data)
+                if index is not None:
+                    operations.append(index)
+                else:
+                    if compressor is None:
+                        operation = (False, data)
+                    else:
+                        operation = compressor.compress(data)
+                    operations.append(operation)
+                    sizes[1] += len(operation[1])
+                if sizes[1] >= buffer_size or len(operations) >= 1024:
+                    send()
+            if operations:
+                send()
+        except Exception:
+            self.remote_file_controller.close_transfer(session_id, True)
+            raise
+        (r_file_size,
+         r_hash) = self.remote_file_controller.close_transfer(session_id)
+
+        if r_file_size != file_size or written[0] != file_size:
+            raise TransferError("%s: %d bytes transfered out of %d"
+                                % (path, r_file_size, file_size))
+        if r_hash != local_hash.hexdigest():
+            raise TransferError("%s: the %s hash of the transfered file "
+                                "differs" % (path, self.hash_algorithm))
 
     def transfer_from_remote(self,
                              remote_path,
                              path,
-                             buffer_size=512 ** 2):
+                             buffer_size=512 ** 2,
+                             progress=None,
+                             transfer_id=None):
+        '''
+        * progress *function or None*
+            Called with the number of bytes of each chunk transfered.
 
+        * transfer_id *string or None*
+            Engine path of the transfer, for the engine to record its
+            progress.
+        '''
         print("copy " + repr(remote_path) + " to " + repr(path))
         if self.remote_file_controller.is_file(remote_path):
             if not os.path.isdir(os.path.dirname(path)):
                 os.makedirs(os.path.dirname(path))
-            # TBI in case the file were already transfered
-            transmitted = 0
-
-            if transmitted:
-                f = open(path, 'ab')
-            else:
-                f = open(path, 'wb')
-
-            remote_file_size = self.remote_file_controller.get_file_size(
-                remote_path)
-
-            transmitted = os.path.getsize(path)
-            data = self.remote_file_controller.read(remote_path,
-                                                    transmitted,
-                                                    buffer_size)
-            f.write(data)
-            file_size = f.tell()
-            while data and file_size < remote_file_size:
-                data = self.remote_file_controller.read(remote_path,
-                                                        file_size,
-                                                        buffer_size)
-                f.write(data)
-                file_size = f.tell()
-
-            f.close()
-
-            if file_size != remote_file_size:
-                pass
-                # TBI error
-
-            md5_hash = hashlib.md5(open(path, 'rb').read()).hexdigest()
-            if md5_hash != self.remote_file_controller.get_md5_hash(remote_path):
-                # TBI error
-                pass
+            self._file_from_remote(remote_path, path, buffer_size,
+                                   transfer_id, progress)
 
         elif self.remote_file_controller.is_dir(remote_path):
             if not os.path.isdir(os.path.dirname(path)):
@@ -501,15 +1967,116 @@ class PortableRemoteTransfer(Transfer):
                 remote_path)
             self.create_dir_structure(path,
                                       dir_list)
+            relative_paths = []
             for relative_dir_path, file_list in six.iteritems(file_path_dict):
-                dir_path = os.path.join(path, relative_dir_path)
-                r_dir_path = os.path.join(remote_path, relative_dir_path)
                 for file_name in file_list:
-                    file_path = os.path.join(dir_path, file_name)
-                    r_file_path = os.path.join(r_dir_path, file_name)
-                    self.transfer_from_remote(r_file_path,
-                                              file_path,
-                                              buffer_size=buffer_size)
+                    relative_paths.append(os.path.join(relative_dir_path,
+                                                       file_name))
+            sizes = self.remote_file_controller.get_file_sizes(
+                [os.path.join(remote_path, relative_path)
+                 for relative_path in relative_paths])
+            files, batches = self._batch_files(zip(sizes, relative_paths))
+            executor = ParallelTransferExecutor(self.nb_streams, progress)
+            for size, relative_path in files:
+                executor.add(size,
+                             self._file_from_remote,
+                             os.path.join(remote_path, relative_path),
+                             os.path.join(path, relative_path),
+                             buffer_size,
+                             transfer_id)
+            for size, relative_paths in batches:
+                executor.add(size,
+                             self._files_from_remote,
+                             remote_path,
+                             path,
+                             relative_paths,
+                             transfer_id)
+            executor.run()
+
+    def _files_from_remote(self, remote_path, path, relative_paths,
+                           transfer_id=None, progress=None):
+        args = (remote_path, relative_paths, self.hash_algorithm, transfer_id)
+        compression_level = self._compression()
+        if compression_level:
+            args += (compression_level,)
+        (compressed,
+         data,
+         digest,
+         size) = self.remote_file_controller.read_files(*args)
+        wire_size = len(data)
+        data = ChunkCompressor.decompress(compressed, data)
+        if hashlib.new(self.hash_algorithm, data).hexdigest() != digest:
+            raise TransferError("%s: the %s hash of the transfered files "
+                                "differs" % (remote_path,
+                                             self.hash_algorithm))
+        unpack_files(data, path)
+        self._count(size, wire_size)
+        if progress is not None:
+            progress(size)
+
+    def _file_from_remote(self, remote_path, path, buffer_size,
+                          transfer_id=None, progress=None):
+        remote_file_size = self.remote_file_controller.get_file_size(
+            remote_path)
+        transmitted = 0
+        if os.path.isfile(path):
+            transmitted = self._verified_prefix(
+                path, remote_path, os.path.getsize(path), remote_file_size,
+                buffer_size)
+        if transmitted:
+            f = open(path, 'r+b')
+            f.truncate(transmitted)
+            if progress is not None:
+                progress(transmitted)
+        else:
+            f = open(path, 'wb')
+
+        compression_level = self._compression()
+        args = (remote_path, 'r', self.hash_algorithm, transmitted,
+                transfer_id)
+        if compression_level:
+            args += (compression_level,)
+        session_id = self.remote_file_controller.open_transfer(*args)
+        received = [transmitted]
+        local_hash = StreamHash(self.hash_algorithm, transmitted)
+
+        def chunk_read(args, data):
+            if compression_level:
+                compressed, data = data
+                wire_size = len(data)
+                data = ChunkCompressor.decompress(compressed, data)
+            else:
+                wire_size = len(data)
+            self._count(len(data), wire_size)
+            f.seek(args[1])
+            f.write(data)
+            local_hash.update(args[1], data)
+            received[0] += len(data)
+            if progress is not None:
+                progress(len(data))
+
+        try:
+            self._pipelined_calls(
+                'read_chunk',
+                ((session_id, offset, buffer_size)
+                 for offset in six.moves.range(transmitted,
+                                               remote_file_size,
+                                               buffer_size)),
+                chunk_read)
+        finally:
+            (r_file_size,
+             r_hash) = self.remote_file_controller.close_transfer(session_id)
+            f.close()
+
+        file_size = received[0]
+        if file_size != remote_file_size:
+            raise TransferError("%s: %d bytes transfered out of %d"
+                                % (remote_path, file_size,
+                                   remote_file_size))
+        if r_hash != local_hash.hexdigest():
+            raise TransferError("%s: the %s hash of the transfered file "
+                                "differs" % (remote_path,
+                                             self.hash_algorithm))
 
     def top_down_dir_list(self, path):
         return Transfer.top_down_dir_list(path)